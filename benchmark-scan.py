@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+"""
+Compare MetaStore.scan() with MetaStore.scan_by_listing().
+
+Note that for meaningful numbers on a mechanical HDD, you'll want to put the
+TempFileStore on the HDD (via TMPDIR) and drop the page cache between runs:
+
+    sudo sh -c 'echo 3 > /proc/sys/vm/drop_caches'
+"""
+
+import os
+import time
+import logging
+import optparse
+
+from usercouch.misc import TempCouch
+from microfiber import random_id
+from filestore import DIGEST_BYTES
+from filestore.misc import TempFileStore
+from dmedia.util import get_db
+from dmedia.metastore import MetaStore, BufferedSave, TimeDelta
+
+parser = optparse.OptionParser()
+parser.add_option('--count',
+    help='Number of files in the synthetic store; default=100000',
+    metavar='N',
+    default=100 * 1000,
+    type='int',
+)
+(options, args) = parser.parse_args()
+
+logging.basicConfig(level=logging.WARNING)
+
+couch = TempCouch()
+env = couch.bootstrap()
+db = get_db(env, True)
+log_db = db.database('log-1')
+log_db.ensure()
+ms = MetaStore(db, log_db)
+fs = TempFileStore()
+db.save(fs.doc)
+
+count = options.count
+buf = BufferedSave(db, 200)
+print('Creating {} files and docs...'.format(count))
+for i in range(count):
+    _id = random_id(DIGEST_BYTES)
+    filename = fs.path(_id)
+    with open(filename, 'wb') as fp:
+        fp.write(b'D' * 17)
+    mtime = int(os.stat(filename).st_mtime)
+    doc = {
+        '_id': _id,
+        'time': time.time(),
+        'type': 'dmedia/file',
+        'origin': 'user',
+        'atime': int(time.time()),
+        'bytes': 17,
+        'stored': {
+            fs.id: {
+                'copies': 1,
+                'mtime': mtime,
+            },
+        },
+    }
+    buf.save(doc)
+buf.flush()
+
+# Build the view index before timing anything:
+db.view('file', 'stored', key=fs.id, limit=1)
+
+t = TimeDelta()
+assert ms.scan(fs) == count
+scan = t.delta
+print('scan():            {:.3f}s, {} files per second'.format(
+    scan, int(count / scan))
+)
+
+t = TimeDelta()
+assert ms.scan_by_listing(fs) == count
+listing = t.delta
+print('scan_by_listing(): {:.3f}s, {} files per second'.format(
+    listing, int(count / listing))
+)
+print('Speedup: {:.2f}x'.format(scan / listing))
+print('')
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+"""
+Compare "file" design view query latency in CouchDB and in a ShadowIndex.
+"""
+
+import time
+import logging
+import optparse
+
+from usercouch.misc import TempCouch
+from microfiber import random_id
+from filestore import DIGEST_BYTES
+from dmedia.util import get_db
+from dmedia.metastore import BufferedSave, TimeDelta
+from dmedia.shadow import ShadowIndex, ShadowDatabase
+from dmedia.tests.base import TempDir
+
+parser = optparse.OptionParser()
+parser.add_option('--count',
+    help='Number of file docs; default=50000',
+    metavar='N',
+    default=50 * 1000,
+    type='int',
+)
+parser.add_option('--queries',
+    help='Number of queries per view; default=200',
+    metavar='N',
+    default=200,
+    type='int',
+)
+(options, args) = parser.parse_args()
+
+logging.basicConfig(level=logging.WARNING)
+
+couch = TempCouch()
+env = couch.bootstrap()
+db = get_db(env, True)
+store_ids = [random_id() for i in range(3)]
+
+count = options.count
+buf = BufferedSave(db, 200)
+print('Creating {} docs...'.format(count))
+for i in range(count):
+    ts = int(time.time()) - i
+    doc = {
+        '_id': random_id(DIGEST_BYTES),
+        'time': time.time(),
+        'type': 'dmedia/file',
+        'origin': 'user',
+        'atime': ts,
+        'bytes': 17,
+        'stored': {
+            store_ids[i % 3]: {'copies': 1, 'mtime': ts},
+            store_ids[(i + 1) % 3]: {'copies': 1, 'verified': ts},
+        },
+    }
+    buf.save(doc)
+buf.flush()
+
+t = TimeDelta()
+db.view('file', 'rank', limit=1)
+print('CouchDB view build: {:.3f}s'.format(t.delta))
+
+tmp = TempDir()
+index = ShadowIndex(tmp.join('shadow.sqlite3'))
+t = TimeDelta()
+index.sync(db)
+print('ShadowIndex sync:   {:.3f}s'.format(t.delta))
+sdb = ShadowDatabase(db, index)
+
+queries = [
+    ('rank', {'key': 4, 'limit': 50}),
+    ('store-mtime', {
+        'startkey': [store_ids[0], None],
+        'endkey': [store_ids[0], int(time.time())],
+        'limit': 50,
+    }),
+    ('store-verified', {
+        'startkey': [store_ids[1], None],
+        'endkey': [store_ids[1], int(time.time())],
+        'limit': 50,
+    }),
+    ('stored', {'key': store_ids[2], 'limit': 100}),
+]
+print('')
+for (view, kw) in queries:
+    t = TimeDelta()
+    for i in range(options.queries):
+        db.view('file', view, **kw)
+    couch_delta = t.delta
+    t = TimeDelta()
+    for i in range(options.queries):
+        sdb.view('file', view, **kw)
+    shadow_delta = t.delta
+    print('{:>16}: CouchDB {:.3f}s, ShadowIndex {:.3f}s, {:.2f}x'.format(
+        view, couch_delta, shadow_delta, couch_delta / shadow_delta)
+    )
+print('')
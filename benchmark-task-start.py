@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+"""
+Compare how long background tasks take to start with each start method.
+
+Each task does what a real TaskPool task does first: it imports the module
+its target lives in (dmedia.core by default).  The latency is the time from
+`dmedia.parallel.start_process()` until the task is running its target, plus
+the time until the process has exited.
+
+Runs:
+
+    default     the platform's default start method (fork on older Pythons)
+    spawn       a fresh interpreter for every task
+    forkserver  forkserver without preloading (the default as of Python 3.14)
+    launcher    `dmedia.parallel.start_launcher()`, preloaded with dmedia
+
+Each run is done in its own subprocess, as the forkserver can only be started
+once per process.
+"""
+
+import sys
+import time
+import logging
+import optparse
+import subprocess
+import importlib
+
+
+def task(q, module, start):
+    importlib.import_module(module)
+    q.put(time.monotonic() - start)
+
+
+def run(method, module, count):
+    import multiprocessing
+    from dmedia import parallel
+
+    if method == 'launcher':
+        assert parallel.start_launcher()
+    elif method != 'default':
+        parallel._context = multiprocessing.get_context(method)
+    q = parallel.create_queue()
+    running = []
+    exited = []
+    for i in range(count):
+        start = time.monotonic()
+        p = parallel.start_process(task, q, module, start)
+        running.append(q.get())
+        p.join()
+        exited.append(time.monotonic() - start)
+        assert p.exitcode == 0
+    # Throw out the first task, which pays to start the forkserver:
+    running = sorted(running[1:])
+    exited = sorted(exited[1:])
+    print('{:>12}: {:8.2f} ms running, {:8.2f} ms exited (median)'.format(
+        method,
+        running[len(running) // 2] * 1000,
+        exited[len(exited) // 2] * 1000,
+    ))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--count',
+        help='Number of tasks to start per run; default=20',
+        metavar='N',
+        default=20,
+        type='int',
+    )
+    parser.add_option('--module',
+        help='Module each task imports; default=dmedia.core',
+        default='dmedia.core',
+    )
+    parser.add_option('--method',
+        help='Do a single run with this method',
+    )
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if options.method:
+        run(options.method, options.module, options.count)
+        sys.exit()
+
+    print('Starting {} tasks that import {}:'.format(
+        options.count, options.module
+    ))
+    for method in ('default', 'spawn', 'forkserver', 'launcher'):
+        subprocess.check_call([sys.executable, sys.argv[0],
+            '--method', method,
+            '--module', options.module,
+            '--count', str(options.count),
+        ])
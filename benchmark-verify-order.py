@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+"""
+Compare shuffled with layout-ordered verification of many small files.
+
+For meaningful numbers, you'll want to put the TempFileStore on a mechanical
+HDD (via TMPDIR).  The page cache is dropped before each run, which requires
+root; without root the numbers mostly measure the page cache.
+"""
+
+import os
+import time
+import logging
+import optparse
+import subprocess
+
+from usercouch.misc import TempCouch
+from filestore import Hasher, Leaf
+from filestore.misc import TempFileStore
+from dmedia.util import get_db
+from dmedia import schema
+from dmedia.metastore import MetaStore, BufferedSave, TimeDelta
+
+parser = optparse.OptionParser()
+parser.add_option('--count',
+    help='Number of files in the synthetic store; default=10000',
+    metavar='N',
+    default=10 * 1000,
+    type='int',
+)
+parser.add_option('--size',
+    help='Size of each file in bytes; default=65536',
+    metavar='BYTES',
+    default=64 * 1024,
+    type='int',
+)
+(options, args) = parser.parse_args()
+
+logging.basicConfig(level=logging.WARNING)
+
+couch = TempCouch()
+env = couch.bootstrap()
+db = get_db(env, True)
+log_db = db.database('log-1')
+log_db.ensure()
+ms = MetaStore(db, log_db)
+fs = TempFileStore()
+doc = dict(fs.doc)
+doc['io_budget'] = {'bytes_per_sec': 0, 'iops': 0}
+db.save(doc)
+
+count = options.count
+buf = BufferedSave(db, 200)
+ids = []
+print('Creating {} files of {} bytes...'.format(count, options.size))
+for i in range(count):
+    data = os.urandom(options.size)
+    h = Hasher()
+    h.hash_leaf(Leaf(0, data))
+    ch = h.content_hash()
+    with open(fs.path(ch.id), 'wb') as fp:
+        fp.write(data)
+    mtime = int(os.stat(fs.path(ch.id)).st_mtime)
+    stored = {fs.id: {'copies': 0, 'mtime': mtime}}
+    buf.save(schema.create_file(time.time(), ch, stored))
+    ids.append(ch.id)
+buf.flush()
+os.sync()
+
+
+def downgrade_all():
+    docs = db.get_many(ids)
+    for doc in docs:
+        doc['stored'][fs.id]['copies'] = 0
+        doc['stored'][fs.id].pop('verified', None)
+    for i in range(0, len(docs), 500):
+        db.save_many(docs[i:i+500])
+    db.view('file', 'store-downgraded', key=fs.id, limit=1)
+
+
+def drop_caches():
+    try:
+        subprocess.check_call(['sync'])
+        with open('/proc/sys/vm/drop_caches', 'w') as fp:
+            fp.write('3\n')
+    except OSError:
+        pass
+
+
+results = {}
+for layout in (False, True, False, True):
+    downgrade_all()
+    drop_caches()
+    t = TimeDelta()
+    (n, size) = ms.verify_all(fs, 0, layout=layout)
+    assert n == count
+    name = ('layout' if layout else 'shuffled')
+    results.setdefault(name, []).append(t.delta)
+    print('{:>8}: {:.3f}s, {} files per second'.format(
+        name, t.delta, int(count / t.delta))
+    )
+
+shuffled = min(results['shuffled'])
+layout = min(results['layout'])
+print('Speedup: {:.2f}x'.format(shuffled / layout))
+print('')
@@ -27,6 +27,7 @@ from collections import OrderedDict, namedtuple
 import os
 from os import path
 import time
+import threading
 import logging
 import json
 
@@ -38,10 +39,14 @@ from filestore import Leaf, ContentHash, SmartQueue, _start_thread
 from .util import get_db
 from .units import bytes10
 from .metastore import MetaStore, get_dict
+from .leafcache import LeafHashCache
+from .peerstats import PeerStats
 
 
 log = logging.getLogger()
 Slice = namedtuple('Slice', 'start stop')
+SWARM_CHUNK = 4  # Leaves per range handed to a peer in swarm mode
+SWARM_MAX_FAILURES = 3  # Consecutive failures before a peer is dropped
 
 
 def check_slice(ch, start, stop):
@@ -121,6 +126,229 @@ def missing_leaves(ch, tmp_fp):
     assert leaf.index == len(ch.leaf_hashes) - 1
 
 
+class Swarm:
+    """
+    Hand out disjoint leaf ranges of a `Downloader` to several peers at once.
+
+    Each peer gets a worker thread that repeatedly claims the next range of up
+    to *chunk* missing leaves with `Swarm.claim()`, requests that range from
+    its peer, and writes each leaf whose hash checks out.
+
+    A range that fails goes back to the pool, and is retried on another peer
+    when there is one.  A peer is only dropped after ``SWARM_MAX_FAILURES``
+    consecutive failures.  A peer that returns a corrupt leaf is banned for the
+    rest of the download.
+
+    Once every missing leaf is claimed, an idle peer waits until a range held
+    by a single other peer has been outstanding for longer than the time
+    `PeerStats.estimate()` expected it to take, and then duplicates it, so a
+    slow peer can't hold up the end of the download (whichever peer delivers a
+    leaf first wins).
+    """
+
+    __slots__ = ('downloader', 'chunk', 'stats', 'lock', 'changed', 'claimed',
+        'failed', 'active', 'banned')
+
+    def __init__(self, downloader, chunk=SWARM_CHUNK, stats=None):
+        self.downloader = downloader
+        self.chunk = chunk
+        self.stats = (PeerStats() if stats is None else stats)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.claimed = {}
+        self.failed = {}
+        self.active = set()
+        self.banned = set()
+
+    def _find(self, usable):
+        start = stop = None
+        for index in self.downloader.missing:
+            if start is None:
+                if usable(index):
+                    start = stop = index
+            elif index == stop + 1 and usable(index):
+                stop = index
+            else:
+                break
+            if start is not None and stop - start + 1 >= self.chunk:
+                break
+        if start is None:
+            return None
+        return Slice(start, stop + 1)
+
+    def _usable(self, peer_id, index):
+        # A peer doesn't retry a leaf it failed on while another active peer
+        # could still try it:
+        failed = self.failed.get(index)
+        return failed is None or peer_id not in failed or self.active <= failed
+
+    def _duplicable(self, peer_id, index):
+        # Returns the deadline of a leaf held by a single other peer:
+        peers = self.claimed.get(index)
+        if peers is None or len(peers) != 1 or peer_id in peers:
+            return None
+        if not self._usable(peer_id, index):
+            return None
+        return min(peers.values())
+
+    def _claim(self, peer_id, now):
+        claimed = self.claimed
+        s = self._find(lambda i:
+            i not in claimed and self._usable(peer_id, i)
+        )
+        if s is None:
+            def overdue(i):
+                deadline = self._duplicable(peer_id, i)
+                return deadline is not None and deadline <= now
+            s = self._find(overdue)
+        if s is not None:
+            size = (s.stop - s.start) * LEAF_SIZE
+            deadline = now + self.stats.estimate(peer_id, size)
+            for i in range(s.start, s.stop):
+                claimed.setdefault(i, {})[peer_id] = deadline
+        return s
+
+    def _next_deadline(self, peer_id, now):
+        deadlines = [
+            self._duplicable(peer_id, i) for i in self.downloader.missing
+        ]
+        deadlines = [d for d in deadlines if d is not None]
+        if deadlines:
+            return max(0, min(deadlines) - now)
+        return None
+
+    def try_claim(self, peer_id, now=None):
+        """
+        Return the next `Slice` *peer_id* can download right now, or ``None``.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if peer_id in self.banned:
+                return None
+            return self._claim(peer_id, now)
+
+    def claim(self, peer_id):
+        """
+        Return the next `Slice` for *peer_id* to download, or ``None``.
+
+        This waits while every missing leaf is held by other peers and none of
+        them is overdue yet.  ``None`` is returned once the download is
+        complete, or if *peer_id* has been banned.
+        """
+        with self.lock:
+            while peer_id not in self.banned and self.downloader.missing:
+                now = time.monotonic()
+                s = self._claim(peer_id, now)
+                if s is not None:
+                    return s
+                self.changed.wait(self._next_deadline(peer_id, now))
+            return None
+
+    def release(self, peer_id, s, failed=False):
+        with self.lock:
+            for i in range(s.start, s.stop):
+                if failed:
+                    self.failed.setdefault(i, set()).add(peer_id)
+                peers = self.claimed.get(i)
+                if peers is not None:
+                    peers.pop(peer_id, None)
+                    if not peers:
+                        del self.claimed[i]
+            self.changed.notify_all()
+
+    def enter(self, peer_id):
+        with self.lock:
+            self.active.add(peer_id)
+
+    def leave(self, peer_id):
+        with self.lock:
+            self.active.discard(peer_id)
+            self.changed.notify_all()
+
+    def ban(self, peer_id):
+        with self.lock:
+            self.banned.add(peer_id)
+
+    def write(self, leaf):
+        """
+        Write an already verified *leaf*, unless another peer beat us to it.
+        """
+        dl = self.downloader
+        with self.lock:
+            if leaf.index not in dl.missing:
+                return False
+            dl.tmp_fp.seek(leaf.index * LEAF_SIZE)
+            dl.tmp_fp.write(leaf.data)
+            del dl.missing[leaf.index]
+            self.claimed.pop(leaf.index, None)
+            self.changed.notify_all()
+            return True
+
+    def download_range(self, peer_id, client, s):
+        total = 0
+        received = 0
+        leaves = client.iter_leaves(self.downloader.ch, s.start, s.stop)
+        for leaf in leaves:
+            received += 1
+            leaf_hash = self.downloader.ch.leaf_hashes[leaf.index]
+            if hash_leaf(leaf.index, leaf.data) != leaf_hash:
+                log.warning('Got corrupt leaf %s[%d] from %s, banning peer',
+                    self.downloader.id, leaf.index, peer_id
+                )
+                self.ban(peer_id)
+                for leaf in leaves:  # Drain the response
+                    pass
+                break
+            if self.write(leaf):
+                total += len(leaf.data)
+        else:
+            if received != s.stop - s.start:
+                raise ValueError('expected {} leaves, got {}'.format(
+                    s.stop - s.start, received)
+                )
+        return total
+
+    def worker(self, peer_id, client):
+        start = time.monotonic()
+        total = 0
+        failures = 0
+        try:
+            while True:
+                s = self.claim(peer_id)
+                if s is None:
+                    break
+                failed = True
+                try:
+                    total += self.download_range(peer_id, client, s)
+                    failed = False
+                    failures = 0
+                except Exception:
+                    log.exception('Error downloading %s[%d:%d] from %s',
+                        self.downloader.id, s.start, s.stop, peer_id
+                    )
+                    self.stats.record_failure(peer_id)
+                    failures += 1
+                finally:
+                    self.release(peer_id, s, failed)
+                if failures >= SWARM_MAX_FAILURES:
+                    log.warning('Swarm: giving up on %s after %d failures',
+                        peer_id, failures
+                    )
+                    break
+        finally:
+            self.leave(peer_id)
+        delta = time.monotonic() - start
+        if peer_id in self.banned:
+            client.close()
+            self.stats.record_failure(peer_id)
+        else:
+            self.stats.record_download(peer_id, total, delta)
+        log.info('Swarm: got %s of %s from %s',
+            bytes10(total), self.downloader.id, peer_id
+        )
+
+
 class Downloader:
     def __init__(self, doc, ms, fs):
         self.finished = False
@@ -183,7 +411,7 @@ class Downloader:
         assert leaf_hash == self.ch.leaf_hashes[leaf.index]
         return True
 
-    def download_from(self, client):
+    def download_from(self, client, stats=None, peer_id=None):
         start = time.monotonic()
         total = 0
 
@@ -199,9 +427,37 @@ class Downloader:
         log.info('Downloaded %s from %s at %s/s',
             bytes10(total), client.client.address, bytes10(rate)
         )
+        if stats is not None:
+            stats.record_download(peer_id, total, delta)
 
         self.finish_download()
 
+    def download_from_swarm(self, peers, stats=None, chunk=SWARM_CHUNK):
+        """
+        Download disjoint leaf ranges from several peers concurrently.
+
+        *peers* is a list of ``(peer_id, client)`` pairs.  Returns the set of
+        peer IDs that were banned for sending corrupt leaves.
+        """
+        start = time.monotonic()
+        before = len(self.missing)
+        swarm = Swarm(self, chunk, stats)
+        for (peer_id, client) in peers:
+            swarm.enter(peer_id)
+        threads = [
+            _start_thread(swarm.worker, peer_id, client)
+            for (peer_id, client) in peers
+        ]
+        for thread in threads:
+            thread.join()
+        delta = time.monotonic() - start
+        log.info('Swarm downloaded %d of %d leaves of %s from %d peers in %.2fs',
+            before - len(self.missing), before, self.id, len(peers), delta
+        )
+        if len(self.missing) == 0:
+            self.finish_download()
+        return swarm.banned
+
 
 class DeguClient:
     def __init__(self, client):
@@ -258,7 +514,82 @@ def get_client(url, sslctx):
     return DeguClient(client)
 
 
-def download_one(ms, sslctx, _id, tmpfs=None):
+def probe_peers(clients, _id, stats=None):
+    """
+    Return the set of peer IDs in *clients* that have the file *_id*.
+
+    The HEAD requests are made in parallel, one thread per peer, so a slow
+    peer doesn't hold up the others.  When *stats* is provided, the latency of
+    each request is recorded in it.
+    """
+    q = SmartQueue()
+
+    def probe(peer_id, client):
+        try:
+            start = time.monotonic()
+            has_file = client.has_file(_id)
+            if stats is not None:
+                stats.record_latency(peer_id, time.monotonic() - start)
+            q.put((peer_id, has_file))
+        except Exception:
+            log.exception('Error probing %s for %s', peer_id, _id)
+            if stats is not None:
+                stats.record_failure(peer_id)
+            q.put((peer_id, False))
+
+    for (peer_id, client) in clients.items():
+        _start_thread(probe, peer_id, client)
+    found = set()
+    for i in range(len(clients)):
+        (peer_id, has_file) = q.get()
+        if has_file:
+            found.add(peer_id)
+    return found
+
+
+def rank_peers(clients, _id, size, stats=None):
+    """
+    Return the IDs of the peers in *clients* that have *_id*, fastest first.
+
+    The peers are ranked by `PeerStats.rank()` when *stats* is provided,
+    otherwise they're simply sorted by ID.
+    """
+    candidates = probe_peers(clients, _id, stats)
+    if stats is None:
+        return sorted(candidates)
+    return stats.rank(candidates, size)
+
+
+def download_from_peers(downloader, clients, peer_ids, stats=None):
+    """
+    Download from *peer_ids* till the download is complete.
+
+    With more than one peer, the download is split between all of them with
+    `Downloader.download_from_swarm()`.  Otherwise (or to retry whatever the
+    swarm didn't get), each peer is tried in order.
+
+    Returns ``True`` if the download completed.
+    """
+    if len(peer_ids) > 1:
+        banned = downloader.download_from_swarm(
+            [(peer_id, clients[peer_id]) for peer_id in peer_ids], stats
+        )
+        if downloader.download_is_complete():
+            return True
+        peer_ids = [p for p in peer_ids if p not in banned]
+    for peer_id in peer_ids:
+        try:
+            downloader.download_from(clients[peer_id], stats, peer_id)
+        except Exception:
+            log.exception('Error downloading %s from %s', downloader.id, peer_id)
+            if stats is not None:
+                stats.record_failure(peer_id)
+        if downloader.download_is_complete():
+            return True
+    return False
+
+
+def download_one(ms, sslctx, _id, tmpfs=None, stats=None):
     try:
         doc = ms.db.get(_id)
     except NotFound:
@@ -301,27 +632,27 @@ def download_one(ms, sslctx, _id, tmpfs=None):
         log.warning('No peers on local network, cannot download %s', _id)
         return
 
-    # Try downloading from each local peer till we succeed (or give up):
-    for (machine_id, info) in peers.items():
-        url = info['url']
-        client = get_client(url, sslctx)
-        try:
-            downloader.download_from(client)
-        except Exception:
-            log.exception('Error downloading %s from %s', _id, url)
-        if downloader.download_is_complete():
-            break
+    # Try downloading from the fastest local peers till we succeed (or give up):
+    clients = dict(
+        (machine_id, get_client(info['url'], sslctx))
+        for (machine_id, info) in peers.items()
+    )
+    peer_ids = rank_peers(clients, _id, downloader.ch.file_size, stats)
+    download_from_peers(downloader, clients, peer_ids, stats)
+    if stats is not None:
+        stats.save()
 
 
 def download_worker(queue, env, sslconfig, tmpfs=None):
-    ms = MetaStore(get_db(env))
+    ms = MetaStore(get_db(env), leaf_cache=LeafHashCache.open_default())
     sslctx = build_client_sslctx(sslconfig)
+    stats = PeerStats.open_default()
     while True:
         _id = queue.get()
         if _id is None:
             break
         try:
-            download_one(ms, sslctx, _id, tmpfs)
+            download_one(ms, sslctx, _id, tmpfs, stats)
         except Exception:
             log.exception('An error occurred when downloading %s', _id)
         if tmpfs is not None:
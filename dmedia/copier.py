@@ -0,0 +1,260 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Copy a file from one FileStore to several others, without trashing the cache.
+
+``FileStore.copy()`` reads the source and writes the destinations through the
+page cache, so copying a large file evicts the working set that editors are
+using through ``Resolve()``.
+
+`copy_file()` instead reads each leaf once, hashes it, and hands it to a
+`Writer` thread for each destination.  The source is read with
+``POSIX_FADV_SEQUENTIAL`` and each leaf is dropped from the page cache with
+``POSIX_FADV_DONTNEED`` once it's been hashed.  Each destination is
+preallocated with ``posix_fallocate()``, written-back pages are likewise
+dropped as the copy progresses, and each destination is only fsync'ed once, at
+the end.
+"""
+
+import os
+import time
+import threading
+import logging
+
+from filestore import Hasher, Leaf, LEAF_SIZE
+
+from .parallel import start_thread, SmartQueue
+from .units import bytes10
+from . import metrics
+
+
+log = logging.getLogger()
+
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    Call ``os.posix_fadvise()``, ignoring any error, as it's only advice.
+    """
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except (AttributeError, OSError):
+        pass
+
+
+def fallocate(fd, size):
+    """
+    Preallocate *size* bytes for *fd*, returning ``True`` on success.
+    """
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except (AttributeError, OSError):
+        return False
+
+
+class CopyStats:
+    __slots__ = ('lock', 'count', 'size', 'read', 'write', 'fsync', 'elapsed')
+
+    def __init__(self):
+        self.lock = threading.Lock()  # Shared by the copy lanes
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.size = 0
+        self.read = 0.0
+        self.write = 0.0
+        self.fsync = 0.0
+        self.elapsed = 0.0
+
+    def add(self, size, read, write, fsync, elapsed):
+        with self.lock:
+            self.count += 1
+            self.size += size
+            self.read += read
+            self.write += write
+            self.fsync += fsync
+            self.elapsed += elapsed
+        metrics.report('copy', elapsed, 1, size)
+        metrics.observe('copy.fsync.seconds', fsync)
+
+    def rate(self, busy=None):
+        busy = (self.elapsed if busy is None else busy)
+        if busy <= 0:
+            return '{}/s'.format(bytes10(0))
+        return '{}/s'.format(bytes10(int(self.size / busy)))
+
+    def log(self, reset=False):
+        """
+        Log the totals if any files were copied, then optionally reset them.
+        """
+        with self.lock:
+            if self.count:
+                log.info(
+                    'copy: %d files in %.3fs [%s], read %s, write %s, '
+                    'fsync %.3fs',
+                    self.count, self.elapsed, self.rate(),
+                    self.rate(self.read), self.rate(self.write), self.fsync
+                )
+            if reset:
+                self.reset()
+
+
+class Writer:
+    """
+    Write leaves to one destination in a separate thread.
+    """
+
+    __slots__ = ('fp', 'budget', 'queue', 'thread', 'error', 'busy', 'fsync')
+
+    def __init__(self, fp, size, budget=None, depth=2):
+        self.fp = fp
+        self.budget = budget
+        self.queue = SmartQueue(depth)
+        self.error = None
+        self.busy = 0.0
+        self.fsync = 0.0
+        fallocate(fp.fileno(), size)
+        self.thread = start_thread(self.run)
+
+    def run(self):
+        fd = self.fp.fileno()
+        offset = 0
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is not None:
+                continue  # Keep draining so the reader never blocks
+            try:
+                start = time.perf_counter()
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                offset += len(data)
+                # Starts write-back of the new leaf and drops the pages already
+                # written back:
+                fadvise(fd, 0, offset, POSIX_FADV_DONTNEED)
+                self.busy += time.perf_counter() - start
+                if self.budget is not None:
+                    self.budget.consume(len(data))
+            except Exception as e:
+                self.error = e
+        if self.error is None:
+            try:
+                start = time.perf_counter()
+                os.fsync(fd)
+                fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+                self.fsync = time.perf_counter() - start
+            except Exception as e:
+                self.error = e
+
+    def put(self, data):
+        self.queue.put(data)
+
+    def finish(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.fp.close()
+        try:
+            os.unlink(self.fp.name)
+        except FileNotFoundError:
+            pass
+
+
+def copy_file(src, _id, dst_filestores, get_budget=None, stats=None):
+    """
+    Copy file *_id* from `FileStore` *src* to each of *dst_filestores*.
+
+    The file is only read once, and is only moved into its canonical location
+    in each destination after its content hash has been verified.  If the
+    content hash is wrong, ``FileStore.verify()`` is called on *src* so the
+    corrupt file is handled just as ``FileStore.copy()`` would.
+
+    If *get_budget* is provided, it's called with each `FileStore` to get the
+    `dmedia.iobudget.IOBudget` each leaf read or write is drawn from.  If
+    *stats* is provided, it's a `CopyStats` that this copy is added to.
+
+    Returns the `filestore.ContentHash`.
+    """
+    start = time.perf_counter()
+    src_budget = (None if get_budget is None else get_budget(src))
+    src_fp = src.open(_id)
+    writers = []
+    try:
+        fd = src_fp.fileno()
+        size = os.fstat(fd).st_size
+        fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        for dst in dst_filestores:
+            budget = (None if get_budget is None else get_budget(dst))
+            writers.append(Writer(dst.allocate_tmp(), size, budget))
+        h = Hasher()
+        read = 0.0
+        index = 0
+        offset = 0
+        while True:
+            read_start = time.perf_counter()
+            data = src_fp.read(LEAF_SIZE)
+            read += time.perf_counter() - read_start
+            if src_budget is not None:
+                src_budget.consume(len(data))
+            if not data:
+                break
+            h.hash_leaf(Leaf(index, data))
+            fadvise(fd, offset, len(data), POSIX_FADV_DONTNEED)
+            for writer in writers:
+                writer.put(data)
+            index += 1
+            offset += len(data)
+        ch = h.content_hash()
+        if ch.id != _id:
+            for writer in writers:
+                writer.abort()
+            writers = []
+            src_fp.close()
+            src.verify(_id)  # Moves the corrupt file and raises CorruptFile
+            return src.copy(_id, *dst_filestores)
+        for writer in writers:
+            writer.finish()
+        for (dst, writer) in zip(dst_filestores, writers):
+            dst.move_to_canonical(writer.fp, _id)
+        if stats is not None:
+            stats.add(size, read,
+                max((w.busy for w in writers), default=0.0),
+                max((w.fsync for w in writers), default=0.0),
+                time.perf_counter() - start,
+            )
+        writers = []
+        return ch
+    finally:
+        for writer in writers:
+            writer.abort()
+        src_fp.close()
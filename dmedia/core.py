@@ -29,9 +29,12 @@ For background, please see:
 """
 
 import logging
+import os
 from os import path
 import time
 import queue
+import threading
+from multiprocessing.connection import wait
 from subprocess import check_call, CalledProcessError
 from base64 import b64encode
 from collections import namedtuple
@@ -42,13 +45,20 @@ from filestore import FileStore, FileNotFound
 from degu import EmbeddedSSLServer
 from gi.repository import GLib
 
-from dmedia.parallel import start_thread, start_process
-from dmedia import util, schema, views
+from dmedia.parallel import start_thread, start_process, create_pipe, Lanes
+from dmedia import util, schema, views, metrics
 from dmedia.client import Downloader, get_client, build_client_sslctx
-from dmedia.metastore import MetaStore, create_stored, get_dict
+from dmedia.client import rank_peers, download_from_peers
+from dmedia.metastore import MetaStore, create_stored, get_dict, get_rank
+from dmedia.metastore import get_layout_key
 from dmedia.metastore import MIN_BYTES_FREE, MAX_BYTES_FREE
-from dmedia.local import LocalStores, FileNotLocal
-from dmedia.units import file_count
+from dmedia.local import LocalStores, FileNotLocal, get_drive_id
+from dmedia.leafcache import LeafHashCache
+from dmedia.shadow import ShadowIndex
+from dmedia.iobudget import mark_foreground, DriveLease, is_leased
+from dmedia.manifest import RelinkManifest
+from dmedia.peerstats import PeerStats
+from dmedia.units import file_count, bytes10
 
 
 log = logging.getLogger()
@@ -236,12 +246,217 @@ def get_downgraded(doc):
     return downgraded
 
 
+MAX_LANES = 8
+PLAN_WINDOW = 2000
+CHECKPOINT_ID = '_local/vigilance'
+CHECKPOINT_MAX_AGE = 6 * 60 * 60
+CHECKPOINT_INTERVAL = 60
+REQUEUED = object()  # Returned by Vigilance.requeue()
+
+
+def iter_plan_windows(docs, size=PLAN_WINDOW):
+    """
+    Yield ``(rank, docs)`` windows of at most *size* docs, all at the same rank.
+
+    *docs* are expected to be in order of rank, as yielded by
+    `MetaStore.iter_fragile_files()`.  For example:
+
+    >>> docs = [{'stored': {}}, {'stored': {}}, {'stored': {}}]
+    >>> [(rank, len(w)) for (rank, w) in iter_plan_windows(docs, 2)]
+    [(0, 2), (0, 1)]
+
+    """
+    window = []
+    current = None
+    for doc in docs:
+        rank = get_rank(doc)
+        if window and (rank != current or len(window) >= size):
+            yield (current, window)
+            window = []
+        current = rank
+        window.append(doc)
+    if window:
+        yield (current, window)
+
+
+class IOPlan:
+    """
+    Rank-increasing actions for a window of fragile files, grouped for IO.
+
+    Each action is keyed by ``(action, src, dst)``, where *action* is
+    ``'verify'``, ``'copy'``, or ``'download'``; *src* is the store ID read
+    from (or a tuple of peer IDs for a download); and *dst* is a tuple of the
+    store IDs written to.  All the files in a group are handled one after
+    another, so each drive gets a long sequential stream of reads or writes
+    rather than reads interleaved across every drive.
+
+    The estimated cost uses the IO cost model documented in
+    `Vigilance.up_rank()`: one unit to read a copy, plus one unit per copy
+    written.
+    """
+
+    __slots__ = ('groups', 'count', 'cost', 'size', 'skipped')
+
+    def __init__(self):
+        self.groups = {}
+        self.count = 0
+        self.cost = 0
+        self.size = 0
+        self.skipped = 0
+
+    def add(self, key, doc):
+        if key is None:
+            self.skipped += 1
+            return
+        self.groups.setdefault(key, []).append(doc)
+        cost = get_cost(key)
+        self.count += 1
+        self.cost += cost
+        self.size += cost * doc.get('bytes', 0)
+
+    def log(self, rank):
+        log.info('IO plan at rank=%d: %d actions in %d groups, %d IO units '
+            '(%s weighted), %d skipped',
+            rank, self.count, len(self.groups), self.cost, bytes10(self.size),
+            self.skipped
+        )
+        for key in sorted(self.groups, key=str):
+            docs = self.groups[key]
+            log.info('  %s: %d files, %d IO units', key, len(docs),
+                get_cost(key) * len(docs)
+            )
+
+
+def get_cost(key):
+    """
+    Return the IO cost units of the action *key* in an `IOPlan`.
+
+    >>> get_cost(('verify', 'AAAAAAAAAAAAAAAAAAAAAAAA', ()))
+    1
+    >>> get_cost(('copy', 'AAAAAAAAAAAAAAAAAAAAAAAA', ('BBBBBBBBBBBBBBBBBBBBBBBB',)))
+    2
+
+    """
+    return 1 + len(key[2])
+
+
+def new_checkpoint(context, now=None):
+    return {
+        '_id': CHECKPOINT_ID,
+        'time': (time.time() if now is None else now),
+        'stores': context['stores'],
+        'peers': context['peers'],
+        'stop': 2,
+        'rank': 0,
+        'last_id': None,
+        'last_seq': None,
+    }
+
+
+def is_resumable(doc, context, now, max_age=CHECKPOINT_MAX_AGE):
+    """
+    Return ``True`` if Vigilance can resume from checkpoint *doc*.
+
+    A checkpoint is only used when it was saved with the same local stores and
+    peers, and when the walk it records started less than *max_age* seconds
+    ago.  For example:
+
+    >>> context = {'stores': ['AAAAAAAAAAAAAAAAAAAAAAAA'], 'peers': []}
+    >>> doc = new_checkpoint(context, 1000)
+    >>> is_resumable(doc, context, 1060)
+    True
+    >>> is_resumable(doc, context, 1000 + CHECKPOINT_MAX_AGE)
+    False
+    >>> is_resumable(doc, {'stores': [], 'peers': []}, 1060)
+    False
+
+    """
+    try:
+        if doc['stores'] != context['stores'] or doc['peers'] != context['peers']:
+            return False
+        return 0 <= now - doc['time'] < max_age
+    except (KeyError, TypeError):
+        return False
+
+
+class Checkpoint:
+    """
+    How far `Vigilance` got, saved in a _local doc so a restart can resume.
+
+    Vigilance is restarted every 13 minutes, and would otherwise walk the
+    whole "file/rank" view from rank 0 each time, re-considering every file
+    that it has already found it can't do anything about.  The checkpoint
+    records the backlog pass (*stop*), the *rank* being walked, and the
+    *last_id* of the last view page whose files were acted on, and then the
+    *last_seq* once in the event loop.
+
+    As a _local doc, the checkpoint isn't replicated to peers.
+    """
+
+    __slots__ = ('db', 'context', 'doc', 'saved')
+
+    def __init__(self, db, context):
+        self.db = db
+        self.context = context
+        self.doc = new_checkpoint(context)
+        self.saved = None
+
+    def load(self, now=None):
+        """
+        Load the saved checkpoint, returning ``True`` if it can be resumed.
+        """
+        try:
+            doc = self.db.get(CHECKPOINT_ID)
+        except NotFound:
+            return False
+        now = (time.time() if now is None else now)
+        if is_resumable(doc, self.context, now):
+            self.doc = doc
+            return True
+        log.info('Vigilance: not resuming from checkpoint %r', doc)
+        self.doc = new_checkpoint(self.context, now)
+        self.doc['_rev'] = doc.get('_rev')
+        return False
+
+    def update(self, force=True, **kw):
+        """
+        Update the checkpoint, saving it if *force* or if it's been a while.
+        """
+        self.doc.update(kw)
+        now = time.monotonic()
+        if force or self.saved is None or now - self.saved >= CHECKPOINT_INTERVAL:
+            try:
+                self.db.save(self.doc)
+                self.saved = now
+            except Exception:
+                log.exception('Error saving Vigilance checkpoint')
+
+
 class Vigilance:
-    def __init__(self, ms, ssl_config):
+    """
+    Take rank-increasing actions on fragile files.
+
+    When more than one physical drive (or peer) is available, the actions are
+    run on `dmedia.parallel.Lanes` keyed by the drives and peers each action
+    will use, so a copy between drives A and B doesn't hold up a verify on
+    drive C, and a slow download from one peer doesn't hold up anything that
+    doesn't need that peer.  With a single drive and no peers, the actions are
+    taken one at a time in the calling thread, just as before.
+
+    Progress is saved in a `Checkpoint`, so when Vigilance is restarted it
+    picks up where it stopped rather than walking the whole backlog again.
+    """
+
+    def __init__(self, ms, ssl_config, peer_stats=None):
         self.ms = ms
+        self.peer_stats = (PeerStats() if peer_stats is None else peer_stats)
         self.stores = ms.get_local_stores()
+        self.drives = {}
         for fs in self.stores:
-            log.info('Vigilance: local store: %r', fs)
+            self.drives[fs.id] = get_drive_id(fs.parentdir)
+            log.info('Vigilance: local store: %r on drive %r',
+                fs, self.drives[fs.id]
+            )
         self.local = frozenset(self.stores.ids)
         self.clients = {}
         self.peers = ms.get_local_peers()
@@ -251,6 +466,17 @@ class Vigilance:
                 url = info['url']
                 log.info('Vigilance: peer %s at %s', peer_id, url)
                 self.clients[peer_id] = get_client(url, ssl_context)
+        self.lock = threading.Lock()
+        self.inflight = set()
+        self.checkpoint = Checkpoint(ms.db, {
+            'stores': sorted(self.local),
+            'peers': sorted(self.peers),
+        })
+        self.lanes = None
+        count = len(set(self.drives.values())) + len(self.peers)
+        if count > 1:
+            log.info('Vigilance: using %d lanes', min(count, MAX_LANES))
+            self.lanes = Lanes(min(count, MAX_LANES))
 
     def update_remote(self):
         """
@@ -284,12 +510,24 @@ class Vigilance:
         log.info('Visible remote stores: %s', dumps(self.store_to_peer, pretty=True))
 
     def run(self):
-        self.log_stats()
-        for stop_rank in (2, 4, 6):
-            last_seq = self.process_backlog(stop_rank)
-        self.log_stats()
-        self.process_preempt()
-        self.log_stats()
+        cp = self.checkpoint
+        if cp.load():
+            log.info('Vigilance: resuming from checkpoint %r', cp.doc)
+        else:
+            self.log_stats()
+        last_seq = cp.doc['last_seq']
+        if last_seq is None:
+            for stop_rank in (2, 4, 6):
+                if stop_rank == cp.doc['stop']:
+                    last_seq = self.process_backlog(stop_rank,
+                        cp.doc['rank'], cp.doc['last_id']
+                    )
+                elif stop_rank > cp.doc['stop']:
+                    last_seq = self.process_backlog(stop_rank)
+            self.log_stats()
+            self.process_preempt()
+            self.log_stats()
+            cp.update(last_seq=last_seq)
         self.run_event_loop(last_seq)
 
     def log_stats(self):
@@ -302,10 +540,33 @@ class Vigilance:
         for row in result['rows']:
             log.info('## rank=%d: %s', row['key'], file_count(row['value']))
 
-    def process_backlog(self, stop):
+    def iter_backlog(self, stop, start_rank=0, start_id=None):
+        """
+        Yield ``(rank, last_id, docs)`` batches of fragile files below *stop*.
+
+        Each batch is made of whole "file/rank" view pages, so once its docs
+        have been acted on, the walk can be resumed after *last_id*.
+        """
+        for rank in range(start_rank, stop):
+            last_id = (start_id if rank == start_rank else None)
+            docs = []
+            for (last_id, page) in self.ms.iter_rank_pages(rank, last_id):
+                docs.extend(page)
+                if len(docs) >= PLAN_WINDOW:
+                    yield (rank, last_id, docs)
+                    docs = []
+            yield (rank, last_id, docs)
+
+    def process_backlog(self, stop, start_rank=0, start_id=None):
         self.update_remote()
-        for doc in self.ms.iter_fragile_files(stop):
-            self.wrap_up_rank(doc, MIN_BYTES_FREE)
+        for (rank, last_id, docs) in self.iter_backlog(stop, start_rank, start_id):
+            for (doc_rank, window) in iter_plan_windows(docs, len(docs)):
+                plan = self.plan(window, MIN_BYTES_FREE)
+                plan.log(doc_rank)
+                metrics.incr('vigilance.plan.io_units', plan.cost)
+                self.execute_plan(plan, MIN_BYTES_FREE)
+                self.ms.copy_stats.log(reset=True)
+            self.checkpoint.update(stop=stop, rank=rank, last_id=last_id)
         last_seq = self.ms.db.get()['update_seq']
         log.info('Vigilance: processed backlog: stop=%d, update_seq=%r',
                 stop, last_seq)
@@ -314,17 +575,248 @@ class Vigilance:
     def process_preempt(self):
         self.update_remote()
         for doc in self.ms.iter_preempt_files():
-            self.wrap_up_rank(doc, MAX_BYTES_FREE)
+            self.dispatch(doc, MAX_BYTES_FREE)
+        self.join_lanes()
+        self.ms.copy_stats.log(reset=True)
 
     def run_event_loop(self, last_seq):
         self.update_remote()
         log.info('Vigilance: starting event loop at %d', last_seq)
         while True:
+            # Log the copies dispatched from the previous batch, if any:
+            self.ms.copy_stats.log(reset=True)
             result = self.ms.wait_for_fragile_files(last_seq)
+            # Checkpoint the start of this batch, so it's looked at again if
+            # we're restarted before the actions it dispatches are finished:
+            self.checkpoint.update(force=False, last_seq=last_seq)
             last_seq = result['last_seq']
             #log.info('vigilance event loop at update_seq %s', last_seq)
             for row in result['results']:
-                self.wrap_up_rank(row['doc'], MIN_BYTES_FREE)
+                self.dispatch(row['doc'], MIN_BYTES_FREE)
+
+    def dispatch(self, doc, threshold):
+        """
+        Call `Vigilance.wrap_up_rank()` now, or queue it on the lanes.
+
+        A doc already queued or running on the lanes is skipped; the action
+        taken for it will change the doc, so it will come back through the
+        _changes feed if it's still fragile.
+        """
+        if self.lanes is None:
+            return self.wrap_up_rank(doc, threshold)
+        _id = doc['_id']
+        with self.lock:
+            if _id in self.inflight:
+                return
+            self.inflight.add(_id)
+        self.queue_action(doc, threshold)
+
+    def queue_action(self, doc, threshold, resubmit=False):
+        """
+        Plan the action for *doc*, then queue it on the lanes the action uses.
+
+        The doc must already be in `Vigilance.inflight`, and it's removed if
+        there's no action to take.  A job re-queuing a doc uses *resubmit*, so
+        it never waits on the other jobs.
+        """
+        try:
+            key = self.plan_action(doc, threshold)
+        except Exception:
+            log.exception('Error calling Vigilance.plan_action() for %r', doc)
+            key = None
+        if key is None:
+            with self.lock:
+                self.inflight.discard(doc['_id'])
+            return
+        submit = (self.lanes.resubmit if resubmit else self.lanes.submit)
+        submit(self.get_action_lanes(key),
+            self.run_lane_job, key, doc, threshold
+        )
+
+    def run_lane_job(self, key, doc, threshold):
+        requeued = False
+        try:
+            requeued = (self.run_action(key, doc, threshold) is REQUEUED)
+        except Exception:
+            log.exception('Error running %r for %r', key, doc)
+        finally:
+            if not requeued:
+                with self.lock:
+                    self.inflight.discard(doc['_id'])
+
+    def requeue(self, doc, threshold):
+        """
+        Re-plan *doc*, as its planned action no longer fits.
+
+        With lanes, the new action is queued on the lanes it needs, rather than
+        taken in a job holding the lanes of another action.  Without lanes,
+        `Vigilance.up_rank()` is simply called now.
+        """
+        if self.lanes is None:
+            return self.up_rank(doc, threshold)
+        log.info('Re-planning %s', doc['_id'])
+        with self.lock:
+            self.inflight.add(doc['_id'])
+        self.queue_action(doc, threshold, resubmit=True)
+        return REQUEUED
+
+    def join_lanes(self):
+        if self.lanes is not None:
+            self.lanes.join()
+
+    def plan(self, docs, threshold):
+        """
+        Build an `IOPlan` for *docs*.
+        """
+        plan = IOPlan()
+        for doc in docs:
+            try:
+                plan.add(self.plan_action(doc, threshold), doc)
+            except Exception:
+                log.exception('Error calling Vigilance.plan_action() for %r', doc)
+        return plan
+
+    def execute_plan(self, plan, threshold):
+        """
+        Run each group in *plan* as a sequential batch, then wait for them all.
+
+        With lanes, groups using different drives and peers run in parallel.
+        """
+        for key in sorted(plan.groups, key=str):
+            docs = plan.groups[key]
+            if self.lanes is None:
+                self.run_group(key, docs, threshold)
+            else:
+                self.lanes.submit(self.get_action_lanes(key),
+                    self.run_group, key, docs, threshold
+                )
+        self.join_lanes()
+
+    def run_group(self, key, docs, threshold):
+        """
+        Run the action *key* for each of *docs*, in source drive order.
+
+        The docs may have changed since the plan was made, so the whole group
+        is fetched again first with `MetaStore.recheck_ranks()`.  A doc that
+        was deleted, or whose rank has gone up in the meantime, is skipped.
+        """
+        docs = self.ms.recheck_ranks(self.order_group(key, docs))
+        for doc in docs:
+            if doc is None:
+                continue
+            try:
+                self.run_action(key, doc, threshold)
+            except Exception:
+                log.exception('Error running %r for %r', key, doc)
+
+    def order_group(self, key, docs):
+        """
+        Order the *docs* in a group by their location on the source drive.
+        """
+        if key[0] == 'download':
+            return docs
+        fs = self.stores.by_id(key[1])
+        return sorted(docs, key=lambda doc: get_layout_key(fs, doc['_id']))
+
+    def run_action(self, key, doc, threshold):
+        """
+        Take the planned action, or re-plan with `Vigilance.requeue()`.
+
+        The action only uses the stores and peers in *key*, as those are the
+        lanes reserved for it.  We re-plan when they no longer fit (say,
+        because the planned destination has filled up with the copies made
+        earlier in the same plan, or because the doc has since changed).
+
+        *doc* should be current (see `Vigilance.run_group()`).
+        """
+        if not self.action_fits(key, doc, threshold):
+            return self.requeue(doc, threshold)
+        (action, src, dst) = key
+        if action == 'verify':
+            return self.up_rank_by_verifying(doc, {src})
+        if action == 'copy':
+            dst_fs = [self.stores.by_id(store_id) for store_id in dst]
+            return self.up_rank_by_copying(doc, None, threshold, dst_fs)
+        remote = self.classify(doc)[3]
+        return self.up_rank_by_downloading(doc, remote, threshold,
+            self.stores.by_id(dst[0])
+        )
+
+    def action_fits(self, key, doc, threshold):
+        """
+        Return ``True`` if *key* can still be taken for *doc* as planned.
+
+        That is, it's still the kind of action `Vigilance.up_rank()` would
+        take, and it can still use exactly the stores and peers in *key*.
+        """
+        (action, src, dst) = key
+        (local, downgraded, free, remote) = self.classify(doc)
+        if action == 'verify':
+            return src in downgraded
+        fits = len(self.stores.filter_by_avail(
+            set(dst), doc['bytes'], len(dst), threshold
+        )) == len(dst)
+        if action == 'copy':
+            return bool(
+                local and not downgraded and fits
+                and free.issuperset(dst)
+                and self.stores.choose_local_store(doc).id == src
+            )
+        if action == 'download':
+            peer_ids = set(self.store_to_peer[store_id] for store_id in remote)
+            return bool(
+                not local and peer_ids and fits
+                and peer_ids.issubset(src)
+            )
+        return False
+
+    def plan_action(self, doc, threshold):
+        """
+        Return the action `Vigilance.up_rank()` would take for *doc*.
+
+        This follows the same decision tree as `Vigilance.up_rank()`, and
+        returns an ``(action, src, dst)`` key as used by `IOPlan`, or ``None``
+        when no rank-increasing action is possible.
+        """
+        (local, downgraded, free, remote) = self.classify(doc)
+        if local:
+            if downgraded:
+                return ('verify', min(downgraded), ())
+            elif free:
+                dst = self.stores.filter_by_avail(free, doc['bytes'], 1, threshold)
+                if dst:
+                    src = self.stores.choose_local_store(doc)
+                    return ('copy', src.id, tuple(fs.id for fs in dst))
+        elif remote:
+            fs = self.stores.find_dst_store(doc['bytes'], threshold)
+            if fs is not None:
+                peer_ids = tuple(sorted(
+                    set(self.store_to_peer[store_id] for store_id in remote)
+                ))
+                return ('download', peer_ids, (fs.id,))
+
+    def get_action_lanes(self, key):
+        """
+        Return the drive IDs and ``('peer', peer_id)`` tuples an action uses.
+        """
+        (action, src, dst) = key
+        lanes = set(self.drives[store_id] for store_id in dst)
+        if action == 'download':
+            lanes.update(('peer', peer_id) for peer_id in src)
+        else:
+            lanes.add(self.drives[src])
+        return lanes
+
+    def classify(self, doc):
+        """
+        Return the sets of store IDs `Vigilance.up_rank()` decides on.
+        """
+        stored = set(doc['stored'])
+        local = stored.intersection(self.local)
+        downgraded = local.intersection(get_downgraded(doc))
+        free = self.local - stored
+        remote = stored.intersection(self.remote)
+        return (local, downgraded, free, remote)
 
     def wrap_up_rank(self, doc, threshold):
         try:
@@ -428,11 +920,7 @@ class Vigilance:
         absolutely needed (ie, when no local copy is available).        
         """
         assert isinstance(threshold, int) and threshold > 0
-        stored = set(doc['stored'])
-        local = stored.intersection(self.local)
-        downgraded = local.intersection(get_downgraded(doc))
-        free = self.local - stored
-        remote = stored.intersection(self.remote)
+        (local, downgraded, free, remote) = self.classify(doc)
         if local:
             if downgraded:
                 return self.up_rank_by_verifying(doc, downgraded)
@@ -441,46 +929,67 @@ class Vigilance:
         elif remote:
             return self.up_rank_by_downloading(doc, remote, threshold)
 
+    def lease(self, *filestores):
+        """
+        Return a `DriveLease` on the drives of *filestores*.
+
+        Each action holds it while it does its IO, so a filestore task (which
+        runs in another process) can't scan or verify the same drives at once.
+        """
+        return DriveLease(self.drives[fs.id] for fs in filestores)
+
     def up_rank_by_verifying(self, doc, downgraded):
         assert isinstance(downgraded, set)
         store_id = downgraded.pop()
         fs = self.stores.by_id(store_id)
-        return self.ms.verify(fs, doc)
+        with self.lease(fs):
+            return self.ms.verify(fs, doc)
 
-    def up_rank_by_copying(self, doc, free, threshold):
-        dst = self.stores.filter_by_avail(free, doc['bytes'], 1, threshold)
+    def up_rank_by_copying(self, doc, free, threshold, dst=None):
+        """
+        Copy to a store in *free*, or to the planned *dst* stores if provided.
+        """
+        if dst is None:
+            dst = self.stores.filter_by_avail(free, doc['bytes'], 1, threshold)
         if dst:
             src = self.stores.choose_local_store(doc)
-            return self.ms.copy(src, doc, *dst)
+            with self.lease(src, *dst):
+                return self.ms.copy(src, doc, *dst)
 
-    def up_rank_by_downloading(self, doc, remote, threshold):
-        fs = self.stores.find_dst_store(doc['bytes'], threshold)
+    def up_rank_by_downloading(self, doc, remote, threshold, fs=None):
+        """
+        Download to the store with the most space, or to the planned *fs*.
+        """
+        if fs is None:
+            fs = self.stores.find_dst_store(doc['bytes'], threshold)
         if fs is None:
             return
-        peer_ids = frozenset(
-            self.store_to_peer[store_id] for store_id in remote
+        clients = dict(
+            (peer_id, self.clients[peer_id])
+            for peer_id in set(self.store_to_peer[s] for s in remote)
         )
-        downloader = None
         _id = doc['_id']
-        for peer_id in peer_ids:
-            client = self.clients[peer_id]
-            if not client.has_file(_id):
-                continue
-            if downloader is None:
-                downloader = Downloader(doc, self.ms, fs)
-            try:
-                downloader.download_from(client)
-            except Exception:
-                log.exception('Error downloading %s from %s', _id, client)
-            if downloader.download_is_complete():
-                return downloader.doc
+        peer_ids = rank_peers(clients, _id, doc['bytes'], self.peer_stats)
+        if not peer_ids:
+            return
+        with self.lease(fs):
+            downloader = Downloader(doc, self.ms, fs)
+            complete = download_from_peers(
+                downloader, clients, peer_ids, self.peer_stats
+            )
+        self.peer_stats.save()
+        if complete:
+            return downloader.doc
 
 
 def vigilance_worker(env, ssl_config):
     try:
         db = util.get_db(env)
-        ms = MetaStore(db)
-        vigilance = Vigilance(ms, ssl_config)
+        ms = MetaStore(db,
+            leaf_cache=LeafHashCache.open_default(),
+            shadow=ShadowIndex.open_if_enabled(),
+        )
+        vigilance = Vigilance(ms, ssl_config, PeerStats.open_default())
         vigilance.run()
     except Exception:
         log.exception('Error in vigilance_worker():')
@@ -488,27 +997,85 @@ def vigilance_worker(env, ssl_config):
 
 TIMEOUT = 240
 
-def _pull_replication(peers, sslconfig, dst_id, dst):
+# Max concurrent pull replications or scan/relinks in downgrade_worker():
+MAX_COUCH_LANES = 3
+
+
+def _pull_one(src_id, info, sslctx, dst_id, dst, start_time):
     from microfiber.replicator import load_session, replicate
+    remaining = int(TIMEOUT + start_time - time.monotonic())
+    if remaining < 2:
+        log.warning('Reached %d second TIMEOUT, skipping %s', TIMEOUT, src_id)
+        return
+    src_env = {
+        'url': info['url'] + 'couch/',
+        'ssl': {'context': sslctx},
+    }
+    src = Database('dmedia-1', src_env)
+    session = load_session(src_id, src, dst_id, dst, mode='pull')
+    replicate(session, timeout=remaining)
+
+
+def _pull_replication(peers, sslconfig, dst_id, dst):
+    """
+    Pull from *peers* in parallel, giving up after `TIMEOUT` seconds.
+
+    Each peer gets its own lane, with at most `MAX_COUCH_LANES` replications
+    running at once.  A replication still running after the timeout is left
+    to finish on its own, as it's already limited to the time that remained
+    when it started, but those not yet started are cancelled.
+    """
     sslctx = build_client_sslctx(sslconfig)
     start_time = time.monotonic()
+    lanes = Lanes(min(len(peers), MAX_COUCH_LANES))
     for (src_id, info) in peers.items():
-        remaining = int(TIMEOUT + start_time - time.monotonic())
-        if remaining < 2:
-            log.warning('Reached %d second TIMEOUT', TIMEOUT)
-            break
-        src_env = {
-            'url': info['url'] + 'couch/',
-            'ssl': {'context': sslctx},
-        }
-        src = Database('dmedia-1', src_env)
-        session = load_session(src_id, src, dst_id, dst, mode='pull')
-        replicate(session, timeout=remaining)
+        lanes.submit([src_id], _pull_one,
+            src_id, info, sslctx, dst_id, dst, start_time
+        )
+    if lanes.join(TIMEOUT):
+        lanes.close()
+    else:
+        log.warning('Reached %d second TIMEOUT, cancelled %d pulls',
+            TIMEOUT, lanes.cancel()
+        )
+
+
+def _scan_relink(ms, fs, drive_id):
+    try:
+        with DriveLease([drive_id]):
+            ms.scan(fs)
+            ms.relink(fs, RelinkManifest.open_default(fs.id))
+    except Exception:
+        log.exception('error doing scan/relink of %r in downgrade_worker():',
+            fs
+        )
+
+
+def scan_relink_stores(ms, stores):
+    """
+    Scan, then relink each of *stores*, one lane per physical drive.
+
+    Stores on different drives are done in parallel, with at most
+    `MAX_COUCH_LANES` at once, whereas stores on the same drive are done one
+    at a time.  A failure on one store (say, its drive was unplugged) doesn't
+    stop the others.
+    """
+    drives = dict((fs.id, get_drive_id(fs.parentdir)) for fs in stores)
+    count = min(len(set(drives.values())), MAX_COUCH_LANES)
+    if count <= 1:
+        for fs in stores:
+            _scan_relink(ms, fs, drives[fs.id])
+        return
+    log.info('scan/relink of %d stores using %d lanes', len(stores), count)
+    lanes = Lanes(count)
+    for fs in stores:
+        lanes.submit([drives[fs.id]], _scan_relink, ms, fs, drives[fs.id])
+    lanes.close()
 
 
 def downgrade_worker(env, sslconfig):
     db = util.get_db(env)
-    ms = MetaStore(db)
+    ms = MetaStore(db, shadow=ShadowIndex.open_if_enabled())
     peers = ms.get_local_peers()
 
     # Optionally do pull replication to make sure peer changes have been synced
@@ -538,11 +1105,7 @@ def downgrade_worker(env, sslconfig):
     # which this will fail (namely, a user unplugs a drive as the scan/relink is
     # happening), so we just catch and log unhandled exceptions here:
     try:
-        stores = ms.get_local_stores()
-        for fs in stores:
-            ms.scan(fs)
-        for fs in stores:
-            ms.relink(fs)
+        scan_relink_stores(ms, ms.get_local_stores())
     except Exception:
         log.exception('error doing scan/relink in downgrade_worker():')
 
@@ -550,11 +1113,13 @@ def downgrade_worker(env, sslconfig):
 def filestore_worker(env, parentdir, store_id):
     try:
         db = util.get_db(env)
-        ms = MetaStore(db)
+        ms = MetaStore(db, shadow=ShadowIndex.open_if_enabled())
         fs = FileStore(parentdir, store_id)
-        ms.scan(fs)
-        ms.relink(fs)
-        ms.verify_all(fs, int(time.time()))
+        layout = (os.environ.get('DMEDIA_VERIFY_ORDER') == 'layout')
+        with DriveLease([get_drive_id(parentdir)]):
+            ms.scan_relink_verify(fs, int(time.time()), layout,
+                RelinkManifest.open_default(fs.id)
+            )
     except Exception:
         log.exception('Error in filestore_worker():')
 
@@ -574,7 +1139,38 @@ def clean_file_id(_id):
 
 
 TaskInfo = namedtuple('TaskInfo', 'target args')
-ActiveTask = namedtuple('ActiveTask', 'key process start_time')
+ActiveTask = namedtuple('ActiveTask', 'key process start_time conn')
+ActiveTask.__new__.__defaults__ = (None,)  # conn is optional
+
+# Max concurrent tasks per resource; each drive resource defaults to 1:
+RESOURCE_LIMITS = {
+    'couchdb': 3,
+    'network': 8,
+}
+PRIORITY_VIGILANCE = 0
+PRIORITY_REPLICATION = 1
+PRIORITY_FILESTORE = 2
+PRIORITY_DOWNGRADE = 3
+ADMIT_RETRY = 2000  # Milliseconds between retries while a drive is leased
+
+
+def drive_resource(drive_id):
+    return 'drive:{}'.format(drive_id)
+
+
+def get_limit(limits, resource):
+    """
+    Return the max concurrent tasks for *resource*.
+
+    For example:
+
+    >>> get_limit(RESOURCE_LIMITS, 'couchdb')
+    3
+    >>> get_limit(RESOURCE_LIMITS, drive_resource('8:16'))
+    1
+
+    """
+    return limits.get(resource, 1)
 
 
 class TaskPool:
@@ -583,44 +1179,104 @@ class TaskPool:
 
     Vaguely similar to ``multiprocessing.Pool``, but with some special logic
     we can't easily layer on top.
+
+    Each task can declare the resources it uses (say, a physical drive, the
+    CouchDB server, or the network) and a priority.  A task is only started
+    when none of its resources are already used by as many tasks as
+    `RESOURCE_LIMITS` allows; otherwise it waits in `TaskPool.pending`, where
+    tasks are admitted in order of priority (lowest first), then in the order
+    they were queued.  A waiting task reserves its exclusive resources (and
+    any that are full), so it can't be starved by lower priority tasks that
+    keep taking them first.
+
+    A drive is also unavailable while another process holds a
+    `dmedia.iobudget.DriveLease` on it (say, Vigilance copying onto it).  As
+    nothing tells the pool when such a lease is released, `TaskPool.admit()`
+    is retried every ``ADMIT_RETRY`` milliseconds while a task waits on one.
     """
 
     def __init__(self, *restart_always):
         self.tasks = {}
+        self.resources = {}
+        self.priorities = {}
+        self.limits = dict(RESOURCE_LIMITS)
+        self.pending = {}
+        self.pending_seq = 0
+        self.held = {}
         self.active_tasks = {}
+        self.admit_retry_id = None
         self.thread = None
         self.queue = queue.Queue()
+        self.open_wakeup()
         self.restart_always = frozenset(restart_always)
         self.restart_once = set()
         self.running = False
 
+    def open_wakeup(self):
+        (self.wakeup_r, self.wakeup_w) = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+
+    def close_wakeup(self):
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+        self.wakeup_r = self.wakeup_w = None
+
     def start_reaper(self):
         if self.thread is not None:
             return False
+        if self.wakeup_r is None:
+            self.open_wakeup()
         self.thread = start_thread(self.reaper)
         return True
 
     def stop_reaper(self):
         if self.thread is None:
             return False
-        self.queue.put(None)
+        self.notify(None)
         self.thread.join()
         self.thread = None
+        self.close_wakeup()
         return True
 
-    def reaper(self, timeout=2):
+    def notify(self, item):
+        """
+        Put *item* in the reaper queue, then wake up the reaper thread.
+        """
+        self.queue.put(item)
+        os.write(self.wakeup_w, b'\x00')
+
+    def drain_wakeup(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def reaper(self, timeout=None):
         """
         Collect finished tasks and forward them to the main thread.
 
-        As Dmedia will have a small number of relatively long-running background
-        tasks, the reaper doesn't need to be especially responsive, so we use a
-        relatively long timeout in order to minimize CPU wakeups.
+        This also merges the metrics forwarded by the worker processes into the
+        `dmedia.metrics.registry` of the main service.  Each task forwards its
+        metrics on its own pipe, which the reaper closes once the task has
+        ended and everything it sent has been merged.
+
+        Between passes, the reaper blocks in
+        ``multiprocessing.connection.wait()`` on the sentinel and metrics pipe
+        of every active process, and on a wake-up pipe written to by
+        `TaskPool.notify()`.  So a finished task is forwarded as soon as its
+        process exits, and the reaper doesn't wake up at all while nothing is
+        happening.  The *timeout* is only for unit testing.
         """
         running = True
         task_map = {}
-        while running or task_map:  # Shutdown feature is for unit testing
-            try:
-                task = self.queue.get(timeout=timeout)
+        while True:
+            self.drain_wakeup()
+            while True:
+                try:
+                    task = self.queue.get_nowait()
+                except queue.Empty:
+                    break
                 if task is None:
                     log.info('reaper thread received shutdown request')
                     running = False
@@ -631,14 +1287,40 @@ class TaskPool:
                             'key {!r} is already in task_map'.format(task.key)
                         )
                     task_map[task.key] = task
-            except queue.Empty:
-                pass
             for key in sorted(task_map):  # Sorted to make unit testing easier
                 task = task_map[key]
-                task.process.join(timeout)
-                if not task.process.is_alive():
+                alive = task.process.is_alive()
+                self.collect_metrics(task)
+                if not alive:
                     del task_map[key]
+                    if task.conn is not None:
+                        task.conn.close()
                     self.forward_completed_task(task)
+            if not (running or task_map):  # Shutdown feature is for unit testing
+                break
+            waitables = [self.wakeup_r]
+            for task in task_map.values():
+                waitables.append(task.process.sentinel)
+                if not (task.conn is None or task.conn.closed):
+                    waitables.append(task.conn)
+            wait(waitables, timeout)
+
+    def collect_metrics(self, task):
+        """
+        Merge the metrics forwarded by *task* so far.
+
+        The pipe is closed at EOF, or if the task was killed in the middle of
+        a send, so it's no longer waited on.
+        """
+        conn = task.conn
+        if conn is None or conn.closed:
+            return
+        try:
+            while conn.poll():
+                (key, snapshot) = conn.recv()
+                metrics.registry.merge(snapshot)
+        except (EOFError, OSError):
+            conn.close()
 
     def forward_completed_task(self, task):
         """
@@ -652,10 +1334,13 @@ class TaskPool:
         assert isinstance(task, ActiveTask)
         expected = self.active_tasks.pop(task.key)
         assert task is expected
+        self.held.pop(task.key, None)
         task.process.join()  # Make sure process actually terminated
         log.info('on_task_completed: %r', task.key)
         if self.running and self.should_restart(task.key):
             self.queue_task_for_restart(task.key)
+        if self.running:
+            self.admit()
 
     def should_restart(self, key):
         if key not in self.tasks:
@@ -675,44 +1360,147 @@ class TaskPool:
     def on_task_restart(self, key):
         self.start_task(key)
 
-    def add_task(self, key, target, *args):
+    def add_task(self, key, target, *args, resources=(), priority=0):
         assert callable(target)
         if key in self.tasks:
             log.warning('add_task: %r already in tasks', key)
             return False
         log.info('add_task: adding %r', key)
         self.tasks[key] = TaskInfo(target, args)
+        self.resources[key] = frozenset(resources)
+        self.priorities[key] = priority
         if self.running is True:
             self.start_task(key)
         return True
 
+    def set_resources(self, key, resources):
+        """
+        Change the resources used by task *key* the next time it's started.
+        """
+        if key in self.tasks:
+            self.resources[key] = frozenset(resources)
+
     def remove_task(self, key):
         try:
             self.tasks.pop(key)
+            self.resources.pop(key, None)
+            self.priorities.pop(key, None)
             log.info('remove_task: removed %r', key)
             self.stop_task(key)
             return True
         except KeyError:
             return False
 
+    def get_usage(self):
+        """
+        Return a ``dict`` mapping each resource to its count of active tasks.
+        """
+        usage = {}
+        for key in self.active_tasks:
+            for resource in self.held.get(key, ()):
+                usage[resource] = usage.get(resource, 0) + 1
+        return usage
+
+    def is_leased(self, resource, usage):
+        """
+        Return ``True`` if *resource* is a drive leased by another process.
+
+        When one of our own tasks is using the drive, the lease is its own.
+        """
+        if usage.get(resource, 0) or not resource.startswith('drive:'):
+            return False
+        return is_leased(resource[len('drive:'):])
+
+    def admit(self):
+        """
+        Start the pending tasks whose resources are available.
+
+        Returns the list of keys that were started.
+        """
+        usage = self.get_usage()
+        reserved = set()
+        leased = set()
+        started = []
+        order = sorted(self.pending,
+            key=lambda k: (self.priorities.get(k, 0), self.pending[k])
+        )
+        for key in order:
+            resources = self.resources.get(key, frozenset())
+            for r in resources:
+                if r not in leased and self.is_leased(r, usage):
+                    leased.add(r)
+                    reserved.add(r)
+            if reserved.isdisjoint(resources) and all(
+                usage.get(r, 0) < get_limit(self.limits, r) for r in resources
+            ):
+                del self.pending[key]
+                for r in resources:
+                    usage[r] = usage.get(r, 0) + 1
+                self.launch_task(key)
+                started.append(key)
+            else:
+                for r in resources:
+                    limit = get_limit(self.limits, r)
+                    if limit == 1 or usage.get(r, 0) >= limit:
+                        reserved.add(r)
+        if leased:
+            log.info('admit: waiting for leased %s', sorted(leased))
+            self.queue_admit_retry()
+        return started
+
+    def queue_admit_retry(self):
+        if self.admit_retry_id is None:
+            self.admit_retry_id = GLib.timeout_add(
+                ADMIT_RETRY, self.on_admit_retry
+            )
+
+    def on_admit_retry(self):
+        self.admit_retry_id = None
+        if self.running:
+            self.admit()
+        return False  # Don't repeat, admit() queues another retry if needed
+
+    def add_pending(self, key):
+        if key not in self.pending:
+            self.pending_seq += 1
+            self.pending[key] = self.pending_seq
+
     def start_task(self, key):
         if self.running is False:
             return
         if key in self.active_tasks:
             log.warning('start_task: %r already in active_tasks', key)
             return False
+        self.add_pending(key)
+        self.admit()
+        if key in self.pending:
+            log.info('start_task: %r waiting for %s', key,
+                sorted(self.resources.get(key, ()))
+            )
+            return False
+        return True
+
+    def launch_task(self, key):
         info = self.tasks[key]
         assert isinstance(info, TaskInfo)
         log.info('start_task: starting %r', key)
         ts = time.time()
-        process = start_process(info.target, *info.args)
-        task = ActiveTask(key, process, ts)
+        (reader, writer) = create_pipe()
+        process = start_process(metrics.run_task,
+            writer, key, info.target, *info.args
+        )
+        writer.close()  # So the reader gets EOF when the process ends
+        task = ActiveTask(key, process, ts, reader)
         assert key not in self.active_tasks
         self.active_tasks[key] = task
-        self.queue.put(task)
+        self.held[key] = self.resources.get(key, frozenset())
+        self.notify(task)
         return True
 
     def stop_task(self, key):
+        if self.pending.pop(key, None) is not None:
+            log.info('stop_task: removed pending %r', key)
+            return False
         try:
             self.active_tasks[key].process.terminate()
             log.info('stop_task: stopping %r', key)
@@ -728,6 +1516,9 @@ class TaskPool:
         if key not in self.tasks:
             log.warning('restart_task: %r not in tasks', key)
             return 0
+        if key in self.pending:
+            log.info('restart_task: %r is still pending', key)
+            return False
         log.info('restart_task: %r', key)
         if self.stop_task(key):
             if key not in self.restart_always:
@@ -741,14 +1532,17 @@ class TaskPool:
             return False
         self.running = True
         self.start_reaper()
+        # Queue them all first, so they're admitted in order of priority:
         for key in sorted(self.tasks):  # Sorted to make unit testing easier
-            self.start_task(key)
+            self.add_pending(key)
+        self.admit()
         return True
 
     def stop(self):
         if self.running is False:
             return False
         self.running = False
+        self.pending.clear()
         for key in sorted(self.active_tasks):  # Sorted to make unit testing easier
             self.stop_task(key)
         return True 
@@ -790,13 +1584,33 @@ class TaskMaster:
         self.env = env
         self.ssl_config = ssl_config
         self.pool = TaskPool(VIGILANCE)  # vigilance is auto-restarted
+        self.drives = {}
+
+    def get_shared_resources(self):
+        """
+        Return the resources used by tasks that touch every local store.
+        """
+        resources = set(drive_resource(d) for d in self.drives.values())
+        resources.update(['couchdb', 'network'])
+        return resources
+
+    def update_shared_resources(self):
+        self.pool.set_resources(DOWNGRADE, self.get_shared_resources())
 
     def add_filestore_task(self, fs):
         key = build_fs_key(fs)
-        self.pool.add_task(key, filestore_worker, self.env, fs.parentdir, fs.id)
+        drive_id = get_drive_id(fs.parentdir)
+        self.drives[fs.id] = drive_id
+        self.pool.add_task(key, filestore_worker, self.env, fs.parentdir, fs.id,
+            resources=[drive_resource(drive_id), 'couchdb'],
+            priority=PRIORITY_FILESTORE,
+        )
+        self.update_shared_resources()
 
     def remove_filestore_task(self, fs):
         self.pool.remove_task(build_fs_key(fs))
+        self.drives.pop(fs.id, None)
+        self.update_shared_resources()
 
     def restart_filestore_task(self, fs):
         self.pool.restart_task(build_fs_key(fs))
@@ -812,7 +1626,10 @@ class TaskMaster:
         }
         # In case a previous replication with same peer_id but different url:
         self.pool.remove_task(key)
-        self.pool.add_task(key, replication_worker, src_env, dst_env)
+        self.pool.add_task(key, replication_worker, src_env, dst_env,
+            resources=['network'],
+            priority=PRIORITY_REPLICATION,
+        )
 
     def remove_replication_task(self, peer_id):
         key = build_replication_key(peer_id)
@@ -823,13 +1640,23 @@ class TaskMaster:
         self.pool.restart_task(key)
 
     def add_vigilance_task(self):
-        self.pool.add_task(VIGILANCE, vigilance_worker, self.env, self.ssl_config)
+        # Vigilance runs for the life of the service, mostly idle in its event
+        # loop, so it doesn't claim any drives (or a CouchDB slot) for its
+        # whole life; instead each action takes a `DriveLease` on the drives it
+        # uses, which `TaskPool.admit()` honours:
+        self.pool.add_task(VIGILANCE, vigilance_worker, self.env, self.ssl_config,
+            resources=['network'],
+            priority=PRIORITY_VIGILANCE,
+        )
 
     def restart_vigilance_task(self):
         self.pool.restart_task(VIGILANCE)
 
     def add_downgrade_task(self):
-        self.pool.add_task(DOWNGRADE, downgrade_worker, self.env, self.ssl_config)
+        self.pool.add_task(DOWNGRADE, downgrade_worker, self.env, self.ssl_config,
+            resources=self.get_shared_resources(),
+            priority=PRIORITY_DOWNGRADE,
+        )
 
     def restart_downgrade_task(self):
         self.pool.restart_task(DOWNGRADE)
@@ -914,6 +1741,17 @@ class Core:
     def start_background_tasks(self):
         self.task_master.start_tasks()
 
+    def save_metrics(self):
+        """
+        Save a snapshot of the metrics registry as a "dmedia/metrics" log doc.
+
+        The counters and histograms are cumulative since the service started,
+        so the rates can be charted from the differences between docs.
+        """
+        self.ms.log(time.time(), 'dmedia/metrics', **metrics.registry.snapshot())
+        self.ms.flush_log()
+        return True  # So GLib timeout call repeats
+
     def restart_replication_tasks(self):
         log.info('**** restart_replication_tasks')
         for peer_id in sorted(self.peers):
@@ -1105,6 +1943,7 @@ class Core:
         try:
             fs = self.stores.choose_local_store(doc)
             st = fs.stat(_id)
+            mark_foreground(fs.id)
             return (_id, 0, st.name)
         except (FileNotLocal, FileNotFound):
             return (_id, 1, '')
@@ -1124,6 +1963,7 @@ class Core:
                 try:
                     fs = self.stores.choose_local_store(doc)
                     st = fs.stat(_id)
+                    mark_foreground(fs.id)
                     yield (_id, 0, st.name)
                 except (FileNotLocal, FileNotFound):
                     yield (_id, 1, '')
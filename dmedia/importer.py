@@ -43,7 +43,8 @@ from dmedia.parallel import start_thread
 from dmedia.util import get_project_db
 from dmedia.units import bytes10
 from dmedia import workers, schema
-from dmedia.metastore import MetaStore, create_stored, update_duplicate_file
+from dmedia.metastore import MetaStore, LogWriter, create_stored
+from dmedia.metastore import update_duplicate_file
 from dmedia.extractor import extract, merge_thumbnail
 
 
@@ -171,6 +172,7 @@ class ImportWorker(workers.CouchWorker):
         self.extract = self.env.get('extract', True)
         self.log_db = self.db.database(schema.LOG_DB_NAME)
         self.log_db.ensure()
+        self.log_writer = LogWriter(self.log_db)
         self.project = get_project_db(self.env['project_id'], self.env)
         self.project.ensure()
         self.extraction_queue = Queue(10)
@@ -236,6 +238,7 @@ class ImportWorker(workers.CouchWorker):
             self.doc['time_end'] = time.time()
             self.doc['rate'] = get_rate(self.doc)
         finally:
+            self.log_writer.flush()
             self.db.save(self.doc)
             self.extraction_queue.put(None)
             extractor.join()
@@ -264,7 +267,7 @@ class ImportWorker(workers.CouchWorker):
                 continue
             timestamp = time.time()
             self.extraction_queue.put((timestamp, file, ch))
-            self.log_db.save(
+            self.log_writer.write(
                 schema.log_file_import(timestamp, ch.id, file, **common)
             )
             stored = create_stored(ch.id, *filestores)
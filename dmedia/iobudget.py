@@ -0,0 +1,312 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Pace background IO on a FileStore so it doesn't starve foreground reads.
+
+The background integrity work done by `dmedia.metastore.MetaStore` (verify,
+scan, relink, copy) would otherwise read a drive as fast as it can, which can
+make ``Resolve()`` and the FilesApp painfully slow for an editor using the same
+drive.
+
+Each FileStore gets an `IOBudget`, a pair of token buckets limiting the bytes
+per second and the IO operations per second.  By default a store is unlimited,
+and the limits are set per store in the "dmedia/store" doc, for example:
+
+    >>> doc = {
+    ...     '_id': 'NYXXMYLDOV3F6YTUO5PWM5DX',
+    ...     'type': 'dmedia/store',
+    ...     'io_budget': {'bytes_per_sec': 50000000, 'iops': 200},
+    ... }
+    >>> budget = IOBudget.from_doc(doc)
+    >>> budget.bytes.rate
+    50000000
+
+A missing limit, or a limit of zero, means unlimited.
+
+Foreground reads are signaled with `mark_foreground()`, which touches a small
+per-store file in the runtime directory, so the signal works across the
+dmedia-service process, the HTTP server, and the worker processes.  While a
+store has had foreground reads within the last ``FOREGROUND_WINDOW`` seconds,
+a configured limit is scaled down by ``FOREGROUND_SCALE``, and an unlimited
+one is held to the conservative ``FOREGROUND_BYTES_PER_SEC`` and
+``FOREGROUND_IOPS``.  So by default background IO runs at full speed, but
+still yields to foreground reads.
+
+Whole drives are reserved across processes with a `DriveLease`, an
+``flock()`` on a per-drive lock file in the runtime directory.  Vigilance
+leases the source and destination drives for the length of each action, and
+a filestore task leases its drive while it runs, so the two never do IO on
+the same drive at once.  The `dmedia.core.TaskPool` uses `is_leased()` to
+hold back a task whose drive is leased.
+"""
+
+import os
+from os import path
+import time
+import fcntl
+import threading
+import logging
+
+from .leafcache import get_cache_dir
+
+
+log = logging.getLogger()
+
+FOREGROUND_WINDOW = 10  # Seconds since the last foreground read
+FOREGROUND_SCALE = 0.25
+FOREGROUND_BYTES_PER_SEC = 25 * 1000 * 1000  # When otherwise unlimited
+FOREGROUND_IOPS = 50  # When otherwise unlimited
+MARK_INTERVAL = 1  # Touch the foreground file at most once per second
+
+_last_marked = {}
+
+
+def get_runtime_dir():
+    """
+    Return the per-user dmedia runtime directory, creating it if needed.
+
+    This is under ``$XDG_RUNTIME_DIR`` (normally a tmpfs) when it's set, so
+    marking foreground reads doesn't itself cause disk IO.
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime:
+        return get_cache_dir()
+    dirname = path.join(runtime, 'dmedia')
+    os.makedirs(dirname, exist_ok=True)
+    return dirname
+
+
+def foreground_filename(store_id):
+    return path.join(get_runtime_dir(), 'foreground-' + store_id)
+
+
+def mark_foreground(store_id):
+    """
+    Signal that there was a foreground read from the store *store_id*.
+    """
+    now = time.monotonic()
+    if now - _last_marked.get(store_id, -MARK_INTERVAL) < MARK_INTERVAL:
+        return
+    _last_marked[store_id] = now
+    filename = foreground_filename(store_id)
+    try:
+        os.utime(filename)
+    except FileNotFoundError:
+        open(filename, 'ab').close()
+
+
+def get_foreground_time(store_id):
+    """
+    Return the time of the last foreground read from *store_id*, or ``0``.
+    """
+    try:
+        return os.stat(foreground_filename(store_id)).st_mtime
+    except FileNotFoundError:
+        return 0
+
+
+def lease_filename(drive_id):
+    return path.join(get_runtime_dir(), 'drive-' + drive_id + '.lock')
+
+
+def is_leased(drive_id):
+    """
+    Return ``True`` if a `DriveLease` is currently held on *drive_id*.
+
+    This doesn't create the lock file, so it's cheap to call for a drive that
+    has never been leased.
+    """
+    try:
+        fd = os.open(lease_filename(drive_id), os.O_RDONLY | os.O_CLOEXEC)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+
+class DriveLease:
+    """
+    Reserve the drives *drive_ids* across processes, for use in a with block.
+
+    Entering the with block waits until no other process holds a lease on any
+    of the drives.  The drives are locked in sorted order, so two leases on
+    overlapping drives can't deadlock.
+    """
+
+    __slots__ = ('drive_ids', 'fds')
+
+    def __init__(self, drive_ids):
+        self.drive_ids = tuple(sorted(set(drive_ids)))
+        self.fds = []
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, list(self.drive_ids))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        try:
+            for drive_id in self.drive_ids:
+                fd = os.open(lease_filename(drive_id),
+                    os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600
+                )
+                self.fds.append(fd)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        while self.fds:
+            os.close(self.fds.pop())
+
+
+class TokenBucket:
+    """
+    A token bucket holding up to one second worth of tokens.
+
+    Tokens are reserved by `TokenBucket.take()`, which can leave the bucket in
+    debt, returning how long the caller should sleep to pay it off.  This means
+    a single request can be larger than the bucket.
+    """
+
+    __slots__ = ('rate', 'tokens', 'stamp')
+
+    def __init__(self, rate, now=None):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = (time.monotonic() if now is None else now)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.rate)
+
+    def take(self, amount, scale=1.0, now=None):
+        """
+        Take *amount* tokens, returning the seconds to wait before using them.
+
+        For example:
+
+        >>> bucket = TokenBucket(100, now=0)
+        >>> bucket.take(50, now=0)
+        0
+        >>> bucket.take(100, now=0)
+        0.5
+        >>> bucket.take(100, scale=0.5, now=1.5)
+        1.5
+
+        """
+        if now is None:
+            now = time.monotonic()
+        rate = self.rate * scale
+        self.tokens = min(rate, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / rate
+
+
+class IOBudget:
+    __slots__ = (
+        'store_id', 'bytes', 'iops', 'fg_bytes', 'fg_iops',
+        'lock', 'active', 'checked',
+    )
+
+    def __init__(self, store_id, bytes_per_sec=None, iops=None):
+        self.store_id = store_id
+        self.bytes = (TokenBucket(bytes_per_sec) if bytes_per_sec else None)
+        self.iops = (TokenBucket(iops) if iops else None)
+        # Only used during foreground reads, in place of an unlimited bucket:
+        self.fg_bytes = TokenBucket(FOREGROUND_BYTES_PER_SEC)
+        self.fg_iops = TokenBucket(FOREGROUND_IOPS)
+        self.lock = threading.Lock()
+        self.active = False
+        self.checked = None
+
+    def __repr__(self):
+        return '{}({!r}, {!r}, {!r})'.format(self.__class__.__name__,
+            self.store_id,
+            (self.bytes.rate if self.bytes else 0),
+            (self.iops.rate if self.iops else 0),
+        )
+
+    @classmethod
+    def from_doc(cls, doc):
+        """
+        Create an `IOBudget` from the "io_budget" in a "dmedia/store" *doc*.
+        """
+        config = doc.get('io_budget', {})
+        return cls(doc['_id'],
+            config.get('bytes_per_sec'),
+            config.get('iops'),
+        )
+
+    def get_scale(self, now):
+        if self.checked is None or now - self.checked >= MARK_INTERVAL:
+            self.checked = now
+            foreground = get_foreground_time(self.store_id)
+            active = (time.time() - foreground < FOREGROUND_WINDOW)
+            if active != self.active:
+                log.info('Foreground reads on %s: %s, background IO scale=%s',
+                    self.store_id, active, (FOREGROUND_SCALE if active else 1)
+                )
+            self.active = active
+        return (FOREGROUND_SCALE if self.active else 1.0)
+
+    def take(self, bucket, fg_bucket, amount, scale, now):
+        if bucket is not None:
+            return bucket.take(amount, scale, now)
+        if self.active:
+            return fg_bucket.take(amount, 1.0, now)
+        return 0
+
+    def consume(self, nbytes=0, ops=1):
+        """
+        Draw *nbytes* and *ops* from the budget, sleeping if needed.
+
+        Returns the number of seconds slept.
+        """
+        with self.lock:
+            now = time.monotonic()
+            scale = self.get_scale(now)
+            delay = 0
+            if nbytes:
+                delay = self.take(self.bytes, self.fg_bytes,
+                    nbytes, scale, now
+                )
+            if ops:
+                delay = max(delay,
+                    self.take(self.iops, self.fg_iops, ops, scale, now)
+                )
+        if delay > 0:
+            time.sleep(delay)
+        return delay
@@ -0,0 +1,201 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+A persistent, memory-mapped local cache of file leaf hashes.
+
+Every verify, download, and resume needs the leaf hashes of the file, which
+are stored in the "leaf_hashes" attachment on the CouchDB doc.  Fetching that
+attachment on every call is slow, so instead the leaf hashes are kept in a
+single append-only file that's memory-mapped, something like this::
+
+    +----------------+-----------------+---------------+-----------------+
+    | _id (48 bytes) | file_size (u64) | length (u64)  | leaf_hashes ... |
+    +----------------+-----------------+---------------+-----------------+
+    | _id (48 bytes) | file_size (u64) | length (u64)  | leaf_hashes ... |
+    +----------------+-----------------+---------------+-----------------+
+
+The leaf hashes are only added to the cache after `filestore.check_root_hash()`
+has confirmed that they match the file ID, and are returned as ``memoryview``
+slices of the mmap, so a lookup doesn't copy anything.
+
+Several processes can share the same cache file.  Appends are done under an
+exclusive ``flock()``, and records added by other processes are picked up the
+next time a lookup misses.  Within a process, a single `LeafHashCache` can be
+shared by several threads.
+"""
+
+import os
+from os import path
+import mmap
+import fcntl
+import struct
+import threading
+import logging
+
+from filestore import ContentHash, DIGEST_BYTES, DIGEST_B32LEN
+
+
+log = logging.getLogger()
+
+HEADER = struct.Struct('>{}sQQ'.format(DIGEST_B32LEN))
+
+
+def get_cache_dir():
+    """
+    Return the per-user dmedia cache directory, creating it if needed.
+    """
+    home = path.abspath(os.environ['HOME'])
+    cache = path.join(home, '.cache', 'dmedia')
+    os.makedirs(cache, exist_ok=True)
+    return cache
+
+
+def unpack_leaf_hashes(leaf_hashes):
+    """
+    Split packed *leaf_hashes* into a ``tuple`` of ``DIGEST_BYTES`` slices.
+
+    When *leaf_hashes* is a ``memoryview``, so are the items in the ``tuple``:
+
+    >>> unpack_leaf_hashes(memoryview(b'A' * 30 + b'B' * 30))[1].tobytes()
+    b'BBBBBBBBBBBBBBBBBBBBBBBBBBBBBB'
+
+    """
+    return tuple(
+        leaf_hashes[i:i+DIGEST_BYTES]
+        for i in range(0, len(leaf_hashes), DIGEST_BYTES)
+    )
+
+
+class LeafHashCache:
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+        self.lock = threading.Lock()
+        self.index = {}
+        self.end = 0
+        self.buf = None
+        self.refresh()
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.filename)
+
+    def __len__(self):
+        return len(self.index)
+
+    @classmethod
+    def open_default(cls):
+        """
+        Open the default cache at ~/.cache/dmedia/leaf-hashes.
+        """
+        return cls(path.join(get_cache_dir(), 'leaf-hashes'))
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            # The mmap is left for the garbage collector, as there could still
+            # be memoryview slices of it being used by callers:
+            self.buf = None
+
+    def refresh(self):
+        """
+        Map and index any records appended since the last refresh.
+
+        A trailing partial record (say, from a crash during `add()`) is left
+        out of the index, and will be truncated by the next `add()`.
+        """
+        with self.lock:
+            self._refresh()
+
+    def _refresh(self):
+        size = os.fstat(self.fd).st_size
+        if size <= self.end:
+            return
+        self.buf = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+        offset = self.end
+        while offset + HEADER.size <= size:
+            (_id, file_size, length) = HEADER.unpack_from(self.buf, offset)
+            start = offset + HEADER.size
+            if start + length > size:
+                break
+            self.index[_id.decode()] = (file_size, start, length)
+            offset = start + length
+        self.end = offset
+
+    def get(self, _id, file_size):
+        """
+        Return the packed leaf hashes as a ``memoryview``, or ``None``.
+
+        ``None`` is also returned when the cached *file_size* doesn't match,
+        in which case the caller should check the root hash as it normally
+        would.
+        """
+        with self.lock:
+            entry = self.index.get(_id)
+            if entry is None:
+                self._refresh()
+                entry = self.index.get(_id)
+                if entry is None:
+                    return None
+            (cached_size, start, length) = entry
+            if cached_size != file_size:
+                return None
+            return memoryview(self.buf)[start:start+length]
+
+    def content_hash(self, _id, file_size, unpack=True):
+        """
+        Return a `filestore.ContentHash` from the cache, or ``None``.
+        """
+        leaf_hashes = self.get(_id, file_size)
+        if leaf_hashes is None:
+            return None
+        if unpack:
+            leaf_hashes = unpack_leaf_hashes(leaf_hashes)
+        return ContentHash(_id, file_size, leaf_hashes)
+
+    def add(self, ch):
+        """
+        Append the `filestore.ContentHash` *ch* to the cache.
+
+        *ch* must have already been checked with `filestore.check_root_hash()`.
+        """
+        if isinstance(ch.leaf_hashes, tuple):
+            leaf_hashes = b''.join(ch.leaf_hashes)
+        else:
+            leaf_hashes = bytes(ch.leaf_hashes)
+        header = HEADER.pack(ch.id.encode(), ch.file_size, len(leaf_hashes))
+        with self.lock:
+            if ch.id in self.index:
+                return
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                if ch.id in self.index:
+                    return
+                if os.fstat(self.fd).st_size > self.end:
+                    log.warning('Truncating partial record in %r', self)
+                    os.ftruncate(self.fd, self.end)
+                os.pwrite(self.fd, header + leaf_hashes, self.end)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self._refresh()
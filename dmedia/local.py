@@ -23,6 +23,8 @@
 A FileStore-like API that abstract the specific FileStore away.
 """
 
+import os
+from os import path
 from random import Random
 import logging
 
@@ -30,6 +32,7 @@ from filestore import check_id, check_root_hash, FileStore
 import microfiber
 
 from dmedia.util import get_db
+from dmedia.iobudget import mark_foreground
 
 
 log = logging.getLogger()
@@ -53,6 +56,25 @@ class NotLocalStore(Exception):
         super().__init__(store_id)
 
 
+def get_drive_id(parentdir, sysdir='/sys/dev/block'):
+    """
+    Return an ID for the physical drive that *parentdir* is on.
+
+    This is the kernel name of the whole disk (say, ``'sda'``), even when
+    *parentdir* is on one of its partitions.  When the device isn't a block
+    device (say, a tmpfs), the ``'major:minor'`` device number is returned
+    instead, which is still unique per filesystem.
+    """
+    st_dev = os.stat(parentdir).st_dev
+    name = '{}:{}'.format(os.major(st_dev), os.minor(st_dev))
+    devdir = path.realpath(path.join(sysdir, name))
+    if not path.isdir(devdir):
+        return name
+    if path.exists(path.join(devdir, 'partition')):
+        devdir = path.dirname(devdir)
+    return path.basename(devdir)
+
+
 def choose_local_store(doc, fast, slow):
     """
     Load balance across multiple local hard disks.
@@ -198,10 +220,11 @@ class LocalStores:
 
 
 class LocalSlave:
-    def __init__(self, env):
+    def __init__(self, env, leaf_cache=None):
         self.db = get_db(env)
         self.machine_id = env['machine_id']
         self.last_rev = None
+        self.leaf_cache = leaf_cache
 
     def update_stores(self):
         machine = self.db.get(self.machine_id)
@@ -221,17 +244,26 @@ class LocalSlave:
 
     def content_hash(self, _id, unpack=True):
         doc = self.get_doc(_id)
+        if self.leaf_cache is not None:
+            ch = self.leaf_cache.content_hash(_id, doc['bytes'], unpack)
+            if ch is not None:
+                return ch
         leaf_hashes = self.db.get_att(_id, 'leaf_hashes')[1]
-        return check_root_hash(_id, doc['bytes'], leaf_hashes, unpack)
+        ch = check_root_hash(_id, doc['bytes'], leaf_hashes, unpack)
+        if self.leaf_cache is not None:
+            self.leaf_cache.add(ch)
+        return ch
 
     def stat(self, _id):
         doc = self.get_doc(_id)
         self.update_stores()
         fs = self.stores.choose_local_store(doc)
+        mark_foreground(fs.id)
         return fs.stat(_id)
 
     def stat2(self, doc):
         self.update_stores()
         fs = self.stores.choose_local_store(doc)
+        mark_foreground(fs.id)
         return fs.stat(doc['_id'])
 
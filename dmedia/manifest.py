@@ -0,0 +1,176 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+A persistent manifest of the files already linked in a FileStore.
+
+`dmedia.metastore.MetaStore.relink()` looks for files in a FileStore whose doc
+doesn't yet say they're stored there.  Doing this by listing every file and
+requesting every doc is slow on a large store, even though usually nothing has
+changed since the last run.
+
+A `RelinkManifest` records, for each of the 1024 sub-directories in a
+FileStore, the directory mtime and the IDs of the files that were confirmed to
+be linked at that time.  The next relink only needs to list the directories
+whose mtime has changed, and only needs to request the docs for IDs that aren't
+already in the manifest.
+
+The manifest is a single binary file, something like this::
+
+    +------------------+----------------+-----------------+
+    | magic (8 bytes)  | created (f64)  | dir count (u32) |
+    +------------------+----------------+-----------------+
+    | prefix (2 bytes) | mtime_ns (i64) | ID count (u32)  | IDs (30 bytes each)
+    +------------------+----------------+-----------------+
+    | ...              |                |                 |
+
+An mtime_ns of -1 means the directory needs to be listed again.  The IDs for
+a directory are kept as packed bytes until they're actually needed.
+"""
+
+import os
+from os import path
+import struct
+import time
+import logging
+
+from dbase32 import db32enc, db32dec
+from filestore import DIGEST_BYTES
+
+from .leafcache import get_cache_dir
+
+
+log = logging.getLogger()
+
+MAGIC = b'DMRELNK1'
+HEADER = struct.Struct('>8sdL')
+DIR = struct.Struct('>2sqL')
+DIRTY = -1
+
+
+def pack_ids(ids):
+    """
+    Pack file IDs into a ``bytes`` instance of ``DIGEST_BYTES`` records.
+    """
+    return b''.join(db32dec(_id) for _id in sorted(ids))
+
+
+def unpack_ids(data):
+    """
+    Unpack the output of `pack_ids()` into a ``set`` of file IDs.
+    """
+    return set(
+        db32enc(data[i:i+DIGEST_BYTES])
+        for i in range(0, len(data), DIGEST_BYTES)
+    )
+
+
+class RelinkManifest:
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.created = time.time()
+        self.dirs = {}
+        if filename is not None and path.exists(filename):
+            try:
+                self.load()
+            except (ValueError, struct.error):
+                log.warning('Ignoring corrupt manifest %r', filename)
+                self.reset()
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.filename)
+
+    def __len__(self):
+        return sum(len(data) // DIGEST_BYTES for (m, data) in self.dirs.values())
+
+    @classmethod
+    def open_default(cls, store_id):
+        """
+        Open the manifest at ~/.cache/dmedia/relink-<store_id>.
+        """
+        return cls(path.join(get_cache_dir(), 'relink-' + store_id))
+
+    def reset(self):
+        self.created = time.time()
+        self.dirs = {}
+
+    def load(self):
+        with open(self.filename, 'rb') as fp:
+            data = fp.read()
+        (magic, created, count) = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('bad magic {!r}'.format(magic))
+        dirs = {}
+        offset = HEADER.size
+        for i in range(count):
+            (prefix, mtime_ns, n) = DIR.unpack_from(data, offset)
+            offset += DIR.size
+            end = offset + n * DIGEST_BYTES
+            if end > len(data):
+                raise ValueError('truncated manifest')
+            dirs[prefix.decode()] = (mtime_ns, data[offset:end])
+            offset = end
+        self.created = created
+        self.dirs = dirs
+
+    def save(self):
+        """
+        Atomically write the manifest to disk.
+        """
+        parts = [HEADER.pack(MAGIC, self.created, len(self.dirs))]
+        for prefix in sorted(self.dirs):
+            (mtime_ns, data) = self.dirs[prefix]
+            parts.append(
+                DIR.pack(prefix.encode(), mtime_ns, len(data) // DIGEST_BYTES)
+            )
+            parts.append(data)
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(b''.join(parts))
+        os.replace(tmp, self.filename)
+
+    def is_clean(self, prefix, mtime_ns):
+        """
+        Return ``True`` if directory *prefix* is unchanged since the last run.
+        """
+        entry = self.dirs.get(prefix)
+        return entry is not None and entry[0] != DIRTY and entry[0] == mtime_ns
+
+    def get_ids(self, prefix):
+        """
+        Return the ``set`` of file IDs linked in directory *prefix*.
+        """
+        entry = self.dirs.get(prefix)
+        if entry is None:
+            return set()
+        return unpack_ids(entry[1])
+
+    def update(self, prefix, mtime_ns, ids):
+        """
+        Record the linked *ids* in directory *prefix*.
+
+        Use an *mtime_ns* of ``None`` when the directory should be listed
+        again next time (say, because some files in it still need to be
+        confirmed).
+        """
+        if mtime_ns is None:
+            mtime_ns = DIRTY
+        self.dirs[prefix] = (mtime_ns, pack_ids(ids))
@@ -60,18 +60,34 @@ Types of background tasks:
         Currently this includes the scan, relink, and verify behaviors.
 """
 
+import os
+from os import path
+import stat
 import time
+import fcntl
+import struct
+import threading
+import multiprocessing
 import logging
+from base64 import b64decode
 from random import SystemRandom
 from copy import deepcopy
+from queue import Empty
 
 from dbase32 import log_id, isdb32
 from filestore import FileStore, CorruptFile, FileNotFound, check_root_hash
+from filestore import DOTNAME, Hasher, Leaf, LEAF_SIZE
 from microfiber import NotFound, BadRequest, BulkConflict, id_slice_iter, dumps
 
+from . import schema
 from .units import count_and_size, bytes10
 from .constants import TYPE_ERROR
 from .local import LocalStores
+from .parallel import start_thread, SmartQueue, drain_queue
+from .shadow import ShadowDatabase, isnumber
+from .iobudget import IOBudget
+from . import metrics
+from .copier import copy_file, CopyStats
 
 
 log = logging.getLogger()
@@ -95,6 +111,29 @@ GB = 1000000000
 MIN_BYTES_FREE =  4 * GB
 MAX_BYTES_FREE = 64 * GB
 
+# See MetaStore.relink(), how often to ignore the manifest and relink everything:
+RELINK_FULL = DAY
+
+# Verification batch size when shuffling, and when ordering by layout:
+VERIFY_BATCH = 17
+LAYOUT_BATCH = 100
+
+# See MetaStore.wait_for_fragile_files(), max changes per request:
+CHANGES_BATCH = 500
+
+# See MetaStore.log(), log docs for rank-decreasing events are saved right away:
+FLUSH_LOG_TYPES = frozenset([
+    'dmedia/file/corrupt',
+    'dmedia/store/purge',
+    'dmedia/store/downgrade',
+])
+
+# See get_physical_offset(), from <linux/fs.h> and <linux/fiemap.h>:
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP = struct.Struct('=QQLLLL')
+FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+FIEMAP_EXTENT_UNKNOWN = 0x00000002
+
 
 class TimeDelta:
     __slots__ = ('start', 'end')
@@ -274,6 +313,52 @@ def get_copies(doc):
     return copies
 
 
+def is_fragile(doc):
+    """
+    Return ``True`` if *doc* is a user file with fewer than 3 copies.
+
+    This is the Python equivalent of the "file/fragile" filter function, used
+    so the _changes feed doesn't need a server-side filter.  For example:
+
+    >>> doc = {
+    ...     'type': 'dmedia/file',
+    ...     'origin': 'user',
+    ...     'stored': {
+    ...         '333333333333333333333333': {'copies': 1},
+    ...         '999999999999999999999999': {'copies': 1},
+    ...     },
+    ... }
+    >>> is_fragile(doc)
+    True
+    >>> doc['stored']['AAAAAAAAAAAAAAAAAAAAAAAA'] = {'copies': 1}
+    >>> is_fragile(doc)
+    False
+    >>> is_fragile({'_id': 'foo', '_deleted': True})
+    False
+
+    """
+    if doc.get('type') != 'dmedia/file' or doc.get('origin') != 'user':
+        return False
+    return get_copies(doc) < 3
+
+
+def filter_fragile_rows(rows):
+    """
+    Return the _changes *rows* whose doc `is_fragile()`.
+
+    Should the same doc ID appear more than once, only its last row is kept,
+    and only if its doc is still fragile.
+    """
+    fragile = {}
+    for row in rows:
+        doc = row.get('doc')
+        if doc is not None and is_fragile(doc):
+            fragile[row['id']] = row
+        else:
+            fragile.pop(row['id'], None)
+    return list(fragile.values())
+
+
 def get_mtime(fs, _id):
     return int(fs.stat(_id).mtime)
 
@@ -367,6 +452,64 @@ def mark_mismatched(doc, fs_id, mtime):
     value.pop('verified', None)
 
 
+def get_bytes(doc):
+    """
+    Return doc['bytes'] if it's an ``int`` >= 0, otherwise return ``0``.
+
+    Unlike `get_int()`, *doc* isn't modified.
+    """
+    value = doc.get('bytes')
+    if isinstance(value, int) and value >= 0:
+        return value
+    return 0
+
+
+def is_reclaimable(doc, fs_id):
+    """
+    Return ``True`` if the copy in *fs_id* can be removed from *doc*.
+
+    This mirrors the "file/store-reclaimable" view function, and is used by
+    `MetaStore.reclaim()` to re-check each doc right before its copy is removed,
+    as the file might have been changed since the reclaim was planned.
+
+    For example:
+
+    >>> doc = {
+    ...     'type': 'dmedia/file',
+    ...     'origin': 'user',
+    ...     'stored': {
+    ...         '333333333333333333333333': {'copies': 1},
+    ...         '999999999999999999999999': {'copies': 1},
+    ...         'AAAAAAAAAAAAAAAAAAAAAAAA': {'copies': 2},
+    ...     },
+    ... }
+    >>> is_reclaimable(doc, '333333333333333333333333')
+    True
+    >>> is_reclaimable(doc, 'AAAAAAAAAAAAAAAAAAAAAAAA')
+    False
+
+    """
+    if doc.get('type') != 'dmedia/file' or doc.get('origin') != 'user':
+        return False
+    stored = doc.get('stored')
+    if not (isinstance(stored, dict) and isinstance(stored.get(fs_id), dict)):
+        return False
+
+    def copies(value):
+        if isinstance(value, dict) and isnumber(value.get('copies')):
+            return value['copies']
+        return 0
+
+    # Like the view, only the total is clamped, not the copies subtracted:
+    total = sum(max(0, copies(value)) for value in stored.values())
+    value = stored[fs_id]
+    return (
+        total >= 3
+        and total - copies(value) >= 3
+        and not value.get('pinned')
+    )
+
+
 def update_store(doc, timestamp, bytes_avail):
     """
     Used by `MetaStore.scan()` to update the dmedia/store doc.
@@ -385,6 +528,37 @@ def update_duplicate_file(doc, timestamp, stored):
     merge_stored(get_dict(doc, 'stored'), stored)
 
 
+def sweep_downgrade_by_view(doc, row):
+    """
+    Used by `MetaStore._downgrade_by_view()`, where row['value'] is a store_id.
+    """
+    value = get_dict(doc, 'stored').get(row['value'])
+    if isinstance(value, dict):
+        value['copies'] = 0
+
+
+def sweep_downgrade_store(doc, row):
+    """
+    Used by `MetaStore.downgrade_store()`, where row['key'] is a store_id.
+    """
+    value = get_dict(doc, 'stored').get(row['key'])
+    if isinstance(value, dict):
+        value['copies'] = 0
+        value.pop('verified', None)
+
+
+def sweep_purge_store(doc, row):
+    """
+    Used by `MetaStore.purge_store()`, where row['key'] is a store_id.
+    """
+    get_dict(doc, 'stored').pop(row['key'], None)
+
+
+def apply_rows(doc, func, rows):
+    for row in rows:
+        func(doc, row)
+
+
 def relink_iter(fs, count=50):
     buf = []
     for st in fs:
@@ -396,6 +570,360 @@ def relink_iter(fs, count=50):
         yield buf
 
 
+def iter_view_pages(db, design, view, limit=17, stale=False, **kw):
+    """
+    Yield pages of rows from a CouchDB view using keyset pagination.
+
+    Each page is requested starting from the key and doc ID of the last row in
+    the previous page (via *startkey* and *startkey_docid*), rather than by
+    re-querying from the start of the view.  This means rows that drop out of
+    the view while a page is being processed don't shift the following pages,
+    and the caller can safely work on a page while the next one is fetched.
+
+    The last row of the previous page is dropped if it is still present at the
+    start of the next page.
+
+    If *stale* is ``True``, only the first request waits for the view index to
+    be updated, and the following pages are requested with ``stale='ok'``.
+    This is a big win when the caller is itself changing the docs in the view
+    as it goes, as otherwise each page would first have to wait for the view
+    to index those changes.  Note that with ``include_docs=True`` you still
+    get the current doc, so callers must cope with a doc that no longer
+    matches its (stale) row.
+    """
+    assert isinstance(limit, int) and limit >= 2
+    kw['limit'] = limit
+    last = None
+    while True:
+        if stale and last is not None:
+            kw['stale'] = 'ok'
+        rows = db.view(design, view, **kw)['rows']
+        if not rows:
+            break
+        done = len(rows) < limit
+        if last is not None and (rows[0]['key'], rows[0]['id']) == last:
+            rows.pop(0)
+        if rows:
+            last = (rows[-1]['key'], rows[-1]['id'])
+            yield rows
+        if done:
+            break
+        if 'key' not in kw:
+            kw['startkey'] = last[0]
+        kw['startkey_docid'] = last[1]
+
+
+def iter_prefetch(iterable):
+    """
+    Yield items from *iterable*, which is consumed one item ahead in a thread.
+
+    For example, this lets the next page of docs be requested from CouchDB
+    while the caller is still working on the current page.
+
+    If the caller stops early, the background thread is released once it has
+    finished producing the item it's currently working on.
+    """
+    queue = SmartQueue(1)
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for item in iterable:
+                queue.put(item)
+                if stop.is_set():
+                    return
+            queue.put(StopIteration)
+        except Exception as e:
+            queue.put(e)
+
+    start_thread(producer)
+    try:
+        while True:
+            item = queue.get()
+            if item is StopIteration:
+                break
+            yield item
+    finally:
+        stop.set()
+        try:
+            queue.get_nowait()
+        except Exception:
+            pass
+
+
+def bulk_update(db, func, items):
+    """
+    Apply *func* to a batch of docs, then save them in a single request.
+
+    *items* is a list of ``(doc, args)`` tuples, where *func* is called like
+    this for each::
+
+        func(doc, *args)
+
+    Any doc that conflicts is then re-tried individually with
+    `microfiber.Database.update()`, which will get the latest revision and
+    re-apply *func*.  So unlike `BufferedSave`, this is safe to use for
+    rank-decreasing metadata updates.
+
+    Returns the number of docs that conflicted.
+    """
+    if not items:
+        return 0
+    docs = []
+    args_map = {}
+    for (doc, args) in items:
+        func(doc, *args)
+        docs.append(doc)
+        args_map[doc['_id']] = args
+    try:
+        db.save_many(docs)
+        return 0
+    except BulkConflict as e:
+        log.warning('%d conflicts in bulk_update() with %s()',
+            len(e.conflicts), func.__name__
+        )
+        dmap = dict((doc['_id'], doc) for doc in docs)
+        for row in e.conflicts:
+            _id = row['id']
+            db.update(func, dmap[_id], *args_map[_id])
+        return len(e.conflicts)
+
+
+def iter_prefixes(fs):
+    """
+    Yield ``(prefix, dirname)`` for the sub-directories of files in *fs*.
+    """
+    filesdir = path.join(fs.parentdir, DOTNAME, 'files')
+    for prefix in sorted(os.listdir(filesdir)):
+        if len(prefix) == 2 and isdb32(prefix):
+            yield (prefix, path.join(filesdir, prefix))
+
+
+def list_dir(dirname, prefix):
+    """
+    Return a ``dict`` mapping file ID to ``(size, mtime)`` for one directory.
+    """
+    result = {}
+    for name in os.listdir(dirname):
+        _id = prefix + name
+        if len(_id) != 48 or not isdb32(_id):
+            continue
+        st = os.lstat(path.join(dirname, name))
+        if stat.S_ISREG(st.st_mode):
+            result[_id] = (st.st_size, int(st.st_mtime))
+    return result
+
+
+def list_filestore(fs, budget=None):
+    """
+    Return a ``dict`` mapping file ID to ``(size, mtime)`` for files in *fs*.
+
+    Rather than calling ``FileStore.stat()`` for each file we expect to be in
+    *fs* (which on a mechanical HDD means a random seek for each file, in
+    whatever order the files come out of the CouchDB view), this lists the
+    files directly, one directory at a time, with directories visited in sorted
+    order.  This keeps the metadata reads roughly in on-disk order.
+
+    Entries that aren't regular files or don't have a valid file ID name are
+    ignored.
+
+    If an `IOBudget` *budget* is provided, each directory listing draws one IO
+    operation from it.
+    """
+    result = {}
+    for (prefix, dirname) in iter_prefixes(fs):
+        if budget is not None:
+            budget.consume()
+        result.update(list_dir(dirname, prefix))
+    return result
+
+
+def walk_filestore(fs, budget=None):
+    """
+    Return a ``(prefix, mtime_ns, listing)`` tuple for each directory in *fs*.
+
+    Each *listing* is the ``dict`` returned by `list_dir()`, and *mtime_ns* is
+    the directory mtime taken just before it was listed, as needed by a
+    `dmedia.manifest.RelinkManifest`.  This way a single walk of *fs* can be
+    used both to scan and to relink (see `MetaStore.scan_relink_verify()`).
+
+    If an `IOBudget` *budget* is provided, each directory listing draws one IO
+    operation from it.
+    """
+    dirs = []
+    for (prefix, dirname) in iter_prefixes(fs):
+        if budget is not None:
+            budget.consume()
+        mtime_ns = os.stat(dirname).st_mtime_ns
+        dirs.append((prefix, mtime_ns, list_dir(dirname, prefix)))
+    return dirs
+
+
+def iter_dirty_dirs(fs, manifest, budget=None):
+    """
+    Like `walk_filestore()`, but only list directories *manifest* isn't clean
+    for.
+    """
+    for (prefix, dirname) in iter_prefixes(fs):
+        mtime_ns = os.stat(dirname).st_mtime_ns
+        if manifest.is_clean(prefix, mtime_ns):
+            continue
+        if budget is not None:
+            budget.consume()
+        yield (prefix, mtime_ns, list_dir(dirname, prefix))
+
+
+def run_phase(q, name, target, *args):
+    """
+    Call *target*, then put ``(name, seconds, result, error)`` on *q*.
+    """
+    t = TimeDelta()
+    try:
+        result = target(*args)
+    except Exception as e:
+        log.exception('Error in %s phase', name)
+        q.put((name, t.delta, None, e))
+        return
+    q.put((name, t.delta, result, None))
+
+
+def verify_with_budget(fs, _id, budget):
+    """
+    Verify file *_id* in *fs*, drawing each leaf read from *budget*.
+
+    This hashes the file one leaf at a time, calling `IOBudget.consume()` after
+    each read, so a large file is paced rather than read in a single burst.  In
+    the rare case that the content hash doesn't match, this falls back to
+    ``FileStore.verify()`` so the corrupt file is handled exactly as it
+    normally would be.
+    """
+    h = Hasher()
+    src_fp = fs.open(_id)
+    try:
+        index = 0
+        while True:
+            data = src_fp.read(LEAF_SIZE)
+            budget.consume(len(data))
+            if not data:
+                break
+            h.hash_leaf(Leaf(index, data))
+            index += 1
+    finally:
+        src_fp.close()
+    ch = h.content_hash()
+    if ch.id != _id:
+        return fs.verify(_id)
+    return ch
+
+
+def get_physical_offset(fd):
+    """
+    Return the physical offset of the first extent of *fd*, or ``None``.
+
+    This uses the ``FS_IOC_FIEMAP`` ioctl, which isn't supported by every
+    filesystem, in which case ``None`` is returned.  ``None`` is likewise
+    returned when the location isn't known yet (for example, when allocation
+    has been delayed because the file hasn't been written back).
+    """
+    buf = bytearray(FIEMAP.size + FIEMAP_EXTENT.size)
+    FIEMAP.pack_into(buf, 0, 0, 2**64 - 1, 0, 0, 1, 0)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+    except OSError:
+        return None
+    if FIEMAP.unpack_from(buf)[3] < 1:
+        return None
+    extent = FIEMAP_EXTENT.unpack_from(buf, FIEMAP.size)
+    if extent[5] & FIEMAP_EXTENT_UNKNOWN:
+        return None
+    return extent[1]
+
+
+def get_layout_key(fs, _id):
+    """
+    Return a key for sorting files in *fs* by their location on disk.
+
+    The key is ``(0, offset)`` when the physical offset of the first extent is
+    available from `get_physical_offset()`, otherwise ``(1, inode)``, as inode
+    numbers roughly follow the on-disk order on ext4.  A file that doesn't
+    exist gets ``(2, 0)``, which sorts last.
+    """
+    try:
+        fd = os.open(fs.path(_id), os.O_RDONLY)
+    except OSError:
+        return (2, 0)
+    try:
+        offset = get_physical_offset(fd)
+        if offset is not None:
+            return (0, offset)
+        return (1, os.fstat(fd).st_ino)
+    finally:
+        os.close(fd)
+
+
+def order_rows(fs, rows, layout=False, budget=None):
+    """
+    Order a batch of view *rows* for verifying the files in *fs*.
+
+    By default the rows are shuffled, which reduces conflicts when several
+    peers are verifying copies of the same files.  But on a mechanical HDD this
+    makes verification seek-bound.
+
+    When *layout* is ``True``, the rows are instead sorted by
+    `get_layout_key()`, in a randomly chosen direction, so the drive makes a
+    single sweep through the batch while peers still tend to start at
+    different ends of it.  If an `IOBudget` *budget* is provided, each file
+    opened to get its layout key draws one IO operation from it.
+    """
+    if not layout:
+        random.shuffle(rows)
+        return
+    if not rows:
+        return
+    if budget is not None:
+        budget.consume(ops=len(rows))
+    keys = dict((row['id'], get_layout_key(fs, row['id'])) for row in rows)
+    rows.sort(key=lambda row: keys[row['id']], reverse=random.random() < 0.5)
+
+
+def migrate_mtime(doc):
+    """
+    If needed, migrate 'mtime' values in doc['stored'] from float to int.
+
+    Returns ``True`` if *doc* was changed.
+    """
+    changed = False
+    for value in get_dict(doc, 'stored').values():
+        if isinstance(value, dict) and isinstance(value.get('mtime'), float):
+            changed = True
+            value['mtime'] = int(value['mtime'])
+    return changed
+
+
+def check_file_worker(item):
+    """
+    Check the schema and root hash of a dmedia/file doc.
+
+    This runs in a `SchemaChecker` worker process.  *item* is a ``(doc,
+    leaf_hashes)`` tuple, and a ``(doc_id, errors)`` tuple is returned, where
+    *errors* is a list of messages (empty if the doc is valid).
+    """
+    (doc, leaf_hashes) = item
+    errors = []
+    try:
+        schema.check_file(doc)
+    except (TypeError, ValueError) as e:
+        errors.append('{}: {}'.format(e.__class__.__name__, e))
+    if leaf_hashes is None:
+        errors.append('missing leaf_hashes')
+    else:
+        try:
+            check_root_hash(doc['_id'], doc.get('bytes'), leaf_hashes)
+        except Exception as e:
+            errors.append('{}: {}'.format(e.__class__.__name__, e))
+    return (doc['_id'], errors)
+
+
 class BufferedSave:
     __slots__ = ('db', 'size', 'docs', 'count', 'conflicts')
 
@@ -425,18 +953,556 @@ class BufferedSave:
             self.docs = []
 
 
-class MetaStore:
-    def __init__(self, db, log_db=None):
+class LogWriter:
+    """
+    Buffer log docs and save them in batches with `save_many()`.
+
+    The buffered docs are saved once there are *size* of them, or at most
+    *timeout* seconds after the first doc was buffered, whichever comes first.
+    Call `LogWriter.flush()` to save them right away (say, when a worker is
+    exiting), or write a doc with *flush* to save it (along with anything
+    already buffered) before `LogWriter.write()` returns.
+
+    Each batch is saved in order of doc['_id'], which for log docs is the
+    `dbase32.log_id()` of their timestamp, and batches are saved one at a time,
+    so the log docs are saved in the same order as their IDs sort.
+    """
+
+    __slots__ = ('db', 'size', 'timeout', 'docs', 'count', 'lock', 'timer')
+
+    def __init__(self, db, size=50, timeout=5):
         self.db = db
+        self.size = size
+        self.timeout = timeout
+        self.docs = []
+        self.count = 0
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def write(self, doc, flush=False):
+        with self.lock:
+            self.docs.append(doc)
+            if flush or len(self.docs) >= self.size:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.timeout, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.docs:
+            return
+        docs = sorted(self.docs, key=lambda doc: doc['_id'])
+        self.docs = []
+        self.count += len(docs)
+        try:
+            self.db.save_many(docs)
+        except BulkConflict:
+            log.exception('Conflicts in LogWriter.flush()')
+
+
+class Sweep:
+    """
+    Apply *func* to every doc in a view, saving the docs in batches.
+
+    This is the engine behind `MetaStore._downgrade_by_view()`,
+    `MetaStore.downgrade_store()`, and `MetaStore.purge_store()`, each of which
+    make a metadata update to every doc in a view, and where that update will
+    typically cause the doc to drop out of the view.
+
+    The view is paged through *batch_size* rows at a time with
+    `iter_view_pages()`.  Only the first page waits for the view index to be
+    updated; because of the keyset pagination, the following pages can be
+    requested with ``stale='ok'``, so we don't pay to re-index our own changes
+    on every page.  The fetching is done in a background thread, so the next
+    page is being fetched while the current one is being saved.
+
+    *func* is called like this for each row::
+
+        func(doc, row)
+
+    All the rows for the same doc in a page are applied to the same doc, which
+    is then saved once.  As these are rank-decreasing updates, conflicts are
+    re-tried with `microfiber.Database.update()` (see `bulk_update()`).
+    """
+
+    def __init__(self, db, design, view, func, batch_size=100, **kw):
+        assert isinstance(batch_size, int) and batch_size >= 2
+        self.db = db
+        self.design = design
+        self.view = view
+        self.func = func
+        self.batch_size = batch_size
+        self.kw = kw
+        self.queue = SmartQueue(2)
+        self.stopped = threading.Event()
+        self.rows = 0
+        self.count = 0
+        self.conflicts = 0
+        self.delta = None
+
+    def fetch(self):
+        try:
+            pages = iter_view_pages(self.db, self.design, self.view,
+                self.batch_size, True, include_docs=True, **self.kw
+            )
+            for rows in pages:
+                if self.stopped.is_set():
+                    break
+                self.queue.put(rows)
+            self.queue.put(None)
+        except Exception as e:
+            self.queue.put(e)
+
+    def save(self, rows):
+        self.rows += len(rows)
+        docs = {}
+        rows_map = {}
+        for row in rows:
+            _id = row['id']
+            if row.get('doc') is None:
+                continue
+            if _id not in docs:
+                docs[_id] = row['doc']
+                rows_map[_id] = []
+            rows_map[_id].append(row)
+        items = [
+            (doc, (self.func, rows_map[_id])) for (_id, doc) in docs.items()
+        ]
+        self.conflicts += bulk_update(self.db, apply_rows, items)
+        self.count += len(items)
+
+    def run(self):
+        t = TimeDelta()
+        thread = start_thread(self.fetch)
+        try:
+            while True:
+                metrics.gauge('sweep.queue', self.queue.qsize(), self.view)
+                rows = self.queue.get()
+                if rows is None:
+                    break
+                self.save(rows)
+        finally:
+            # If save() raised, the fetch thread could be blocked on a put():
+            self.stopped.set()
+            while thread.is_alive():
+                drain_queue(self.queue)
+                thread.join(0.05)
+        self.delta = t.delta
+        metrics.report('sweep', self.delta, self.count, label=self.view)
+        metrics.incr('sweep.conflicts', self.conflicts, self.view)
+        metrics.gauge('sweep.last_conflicts', self.conflicts, self.view)
+        return self.count
+
+    def rate(self):
+        if not self.delta:
+            return 0
+        return int(self.rows / self.delta)
+
+    def log(self, msg, *args):
+        log.info('%.3fs to ' + msg + ' [%d rows/s, %d conflicts]',
+            self.delta, *(args + (self.rate(), self.conflicts))
+        )
+
+
+class StageStats:
+    __slots__ = ('name', 'count', 'size', 'busy')
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.size = 0
+        self.busy = 0.0
+
+    def add(self, start, count=1, size=0):
+        self.busy += time.perf_counter() - start
+        self.count += count
+        self.size += size
+
+    def rate(self):
+        if self.busy <= 0:
+            return '{}/s'.format(bytes10(0))
+        return '{}/s'.format(bytes10(int(self.size / self.busy)))
+
+    def log(self, fs):
+        log.info('%s stage: %d in %.3fs busy in %r [%s]',
+            self.name, self.count, self.busy, fs, self.rate()
+        )
+
+    def report(self, prefix, fs):
+        metrics.report(prefix + '.' + self.name, self.busy, self.count,
+            self.size, fs.id
+        )
+
+
+class VerifyPipeline:
+    """
+    Verify files in a `FileStore` with fetch, read, and commit overlapped.
+
+    The work is split into three stages connected by bounded queues:
+
+        fetch
+            Pages through the "file/store-downgraded", "file/store-mtime", and
+            "file/store-verified" views (in that order) using keyset pagination
+
+        read
+            Calls `verify_with_budget()` on each file, staying at most
+            *readahead* files ahead of the commit stage
+
+        commit
+            Saves the rank-increasing verified updates in batches of
+            *batch_size* docs; a doc that conflicts is re-tried individually
+            with `microfiber.Database.update()`
+
+    The fetch and read stages each run in their own thread, whereas the commit
+    stage runs in the thread that called `VerifyPipeline.run()`.  This way the
+    drive is kept busy while we wait on CouchDB, and vice versa.
+
+    Just as with `MetaStore.verify()`, missing and corrupt files are
+    rank-decreasing updates, so they are always saved immediately, one doc at a
+    time, using `microfiber.Database.update()`.
+
+    If a *feed* queue is provided, the fetch stage also takes lists of docs
+    from it, right after the "file/store-downgraded" view, till it gets
+    ``None``.  This is how `MetaStore.scan_relink_verify()` hands over the
+    files it downgrades or relinks while the pipeline is already running.
+
+    If the commit stage raises an exception, `VerifyPipeline.stop()` tells the
+    fetch and read stages to stop, and drains their queues so they aren't left
+    blocked on a ``put()``.
+    """
+
+    def __init__(self, ms, fs, readahead=8, batch_size=25, layout=False,
+            feed=None):
+        assert isinstance(readahead, int) and readahead >= 1
+        assert isinstance(batch_size, int) and batch_size >= 1
+        self.ms = ms
+        self.fs = fs
+        self.layout = layout
+        self.feed = feed
+        self.budget = ms.get_budget(fs)
+        self.batch_size = batch_size
+        self.q_fetch = SmartQueue(readahead)
+        self.q_read = SmartQueue(readahead)
+        self.stopped = threading.Event()
+        self.pending = []
+        self.fetch_stats = StageStats('fetch')
+        self.read_stats = StageStats('read')
+        self.commit_stats = StageStats('commit')
+
+    def iter_views(self, curtime):
+        fs_id = self.fs.id
+        yield ('store-downgraded', {'key': fs_id})
+        yield ('store-mtime', {
+            'startkey': [fs_id, None],
+            'endkey': [fs_id, curtime - VERIFY_BY_MTIME],
+        })
+        yield ('store-verified', {
+            'startkey': [fs_id, None],
+            'endkey': [fs_id, curtime - VERIFY_BY_VERIFIED],
+        })
+
+    def fetch_view(self, view, kw, seen):
+        db = self.ms.db
+        limit = (LAYOUT_BATCH if self.layout else VERIFY_BATCH)
+        pages = iter_view_pages(db, 'file', view, limit,
+            include_docs=True, **kw
+        )
+        while not self.stopped.is_set():
+            db.wait_for_compact()
+            start = time.perf_counter()
+            rows = next(pages, None)
+            if rows is None:
+                break
+            self.fetch_stats.add(start, len(rows),
+                sum(r['doc'].get('bytes', 0) for r in rows)
+            )
+            self.put_rows(rows, seen)
+
+    def fetch_feed(self, seen):
+        while not self.stopped.is_set():
+            try:
+                docs = self.feed.get(timeout=0.5)
+            except Empty:
+                continue
+            if docs is None:
+                break
+            rows = [{'id': doc['_id'], 'doc': doc} for doc in docs]
+            self.fetch_stats.count += len(rows)
+            self.put_rows(rows, seen)
+
+    def put_rows(self, rows, seen):
+        order_rows(self.fs, rows, self.layout, self.budget)
+        for row in rows:
+            if self.stopped.is_set():
+                break
+            if row['id'] not in seen:
+                seen.add(row['id'])
+                self.q_fetch.put(row['doc'])
+
+    def fetch(self, curtime):
+        try:
+            seen = set()
+            for (view, kw) in self.iter_views(curtime):
+                if self.stopped.is_set():
+                    break
+                self.fetch_view(view, kw, seen)
+                if view == 'store-downgraded' and self.feed is not None:
+                    self.fetch_feed(seen)
+            self.q_fetch.put(None)
+        except Exception as e:
+            self.q_fetch.put(e)
+
+    def read(self):
+        try:
+            fs = self.fs
+            while not self.stopped.is_set():
+                doc = self.q_fetch.get()
+                if doc is None:
+                    break
+                _id = doc['_id']
+                start = time.perf_counter()
+                try:
+                    verify_with_budget(fs, _id, self.budget)
+                    value = create_stored_value(_id, fs, time.time())
+                    result = ('verified', doc, value)
+                except FileNotFound:
+                    result = ('missing', doc, None)
+                except CorruptFile:
+                    result = ('corrupt', doc, None)
+                self.read_stats.add(start, 1, doc['bytes'])
+                metrics.observe('verify.file.seconds',
+                    time.perf_counter() - start, fs.id
+                )
+                self.q_read.put(result)
+            self.q_read.put(None)
+        except Exception as e:
+            self.q_read.put(e)
+
+    def flush(self):
+        if not self.pending:
+            return
+        start = time.perf_counter()
+        items = [(doc, (self.fs.id, value)) for (doc, value) in self.pending]
+        self.pending = []
+        bulk_update(self.ms.db, mark_verified, items)
+        self.commit_stats.add(start, len(items))
+
+    def commit(self, status, doc, value):
+        fs = self.fs
+        _id = doc['_id']
+        if status == 'verified':
+            log.info('Verified %s in %r', _id, fs)
+            self.pending.append((doc, value))
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+            return
+        start = time.perf_counter()
+        if status == 'missing':
+            log.warning('%s is not in %r', _id, fs)
+            self.ms.db.update(mark_removed, doc, fs.id)
+        else:
+            log.error('%s is corrupt in %r', _id, fs)
+            timestamp = time.time()
+            self.ms.log_file_corrupt(timestamp, fs, _id)
+            self.ms.db.update(mark_corrupt, doc, timestamp, fs.id)
+        self.commit_stats.add(start)
+
+    def stop(self, *threads):
+        """
+        Stop the fetch and read stages, then wait for their *threads*.
+
+        After a normal run the stages have already finished, so this just
+        joins their threads.
+        """
+        self.stopped.set()
+        for thread in threads:
+            while thread.is_alive():
+                drain_queue(self.q_fetch)
+                drain_queue(self.q_read)
+                thread.join(0.05)
+
+    def run(self, curtime):
+        assert isinstance(curtime, int) and curtime >= 0
+        count = 0
+        size = 0
+        fetch_thread = start_thread(self.fetch, curtime)
+        read_thread = start_thread(self.read)
+        try:
+            while True:
+                metrics.gauge('verify.queue.fetch', self.q_fetch.qsize(),
+                    self.fs.id
+                )
+                metrics.gauge('verify.queue.read', self.q_read.qsize(),
+                    self.fs.id
+                )
+                result = self.q_read.get()
+                if result is None:
+                    break
+                (status, doc, value) = result
+                self.commit(status, doc, value)
+                count += 1
+                size += doc['bytes']
+            self.flush()
+        finally:
+            self.stop(fetch_thread, read_thread)
+        for stats in (self.fetch_stats, self.read_stats, self.commit_stats):
+            stats.log(self.fs)
+            stats.report('verify', self.fs)
+        return (count, size)
+
+
+class SchemaChecker:
+    """
+    Incrementally check the schema and root hash of dmedia/file docs.
+
+    Rather than walking through every doc in the library on each run, this
+    follows the CouchDB ``_changes`` feed from the ``last_seq`` saved in the
+    ``_local/schema-check`` doc, so only docs that changed since the last run
+    are checked.  The checkpoint is saved after each batch, so an interrupted
+    run will pick up where it left off.  Each run stops at the ``update_seq``
+    as of when it started.
+
+    The `schema.check_file()` and `filestore.check_root_hash()` work is done by
+    `check_file_worker()` in a ``multiprocessing.Pool``.  While the pool is
+    checking one batch, the next batch is requested from the changes feed, so
+    at most one request is made to CouchDB at a time.
+
+    Docs with float 'mtime' values are migrated to int as they're found, and
+    docs that fail the check are logged in the log DB with a type of
+    "dmedia/file/invalid".
+    """
+
+    CHECKPOINT_ID = '_local/schema-check'
+
+    def __init__(self, ms, processes=None, batch_size=50):
+        assert isinstance(batch_size, int) and batch_size > 0
+        self.ms = ms
+        self.db = ms.db
+        self.processes = processes
+        self.batch_size = batch_size
+        self.count = 0
+        self.invalid = 0
+        self.migrated = 0
+
+    def load_checkpoint(self):
+        try:
+            self.checkpoint = self.db.get(self.CHECKPOINT_ID)
+        except NotFound:
+            self.checkpoint = {'_id': self.CHECKPOINT_ID}
+        return self.checkpoint.get('last_seq', 0)
+
+    def save_checkpoint(self, last_seq):
+        self.checkpoint['last_seq'] = last_seq
+        self.db.save(self.checkpoint)
+
+    def fetch(self, since):
+        """
+        Return ``(items, last_seq, done)`` for the next batch of changes.
+        """
+        result = self.db.get('_changes',
+            since=since,
+            limit=self.batch_size,
+            include_docs=True,
+            attachments=True,
+        )
+        rows = result['results']
+        items = []
+        for row in rows:
+            doc = row.get('doc')
+            if row.get('deleted') or doc is None:
+                continue
+            if doc.get('type') != 'dmedia/file':
+                continue
+            if migrate_mtime(doc):
+                self.buf.save(doc)
+            items.append((doc, self.get_leaf_hashes(doc)))
+        # Flush now so the docs aren't modified while being sent to the pool:
+        self.buf.flush()
+        last_seq = result['last_seq']
+        done = len(rows) < self.batch_size or last_seq >= self.end_seq
+        return (items, last_seq, done)
+
+    def get_leaf_hashes(self, doc):
+        att = doc.get('_attachments', {}).get('leaf_hashes')
+        if not isinstance(att, dict):
+            return None
+        if 'data' in att:
+            return b64decode(att['data'])
+        try:
+            return self.db.get_att(doc['_id'], 'leaf_hashes').data
+        except NotFound:
+            return None
+
+    def handle(self, results):
+        for (_id, errors) in results:
+            self.count += 1
+            if errors:
+                self.invalid += 1
+                log.error('Invalid dmedia/file %s: %s', _id, '; '.join(errors))
+                self.ms.log(time.time(), 'dmedia/file/invalid',
+                    file_id=_id,
+                    errors=errors,
+                )
+
+    def run(self):
+        t = TimeDelta()
+        self.buf = BufferedSave(self.db)
+        since = self.load_checkpoint()
+        # Stop at the update_seq as of when we started, otherwise the docs we
+        # migrate would be checked a second time:
+        self.end_seq = self.db.get()['update_seq']
+        with multiprocessing.Pool(self.processes) as pool:
+            (items, last_seq, done) = self.fetch(since)
+            while True:
+                pending = pool.map_async(check_file_worker, items)
+                if not done:
+                    following = self.fetch(last_seq)
+                self.handle(pending.get())
+                if last_seq != self.checkpoint.get('last_seq', 0):
+                    self.save_checkpoint(last_seq)
+                if done:
+                    break
+                (items, last_seq, done) = following
+        self.ms.flush_log()
+        self.migrated = self.buf.count
+        t.log('schema check %d files since %r (%d invalid, %d migrated)',
+            self.count, since, self.invalid, self.migrated
+        )
+        return self.migrated
+
+
+class MetaStore:
+    def __init__(self, db, log_db=None, leaf_cache=None, shadow=None):
+        self.db = (db if shadow is None else ShadowDatabase(db, shadow))
         if log_db is None:
             log_db = db.database('log-1')
         self.log_db = log_db
+        self.log_writer = LogWriter(log_db)
         self.machine_id = db.env.get('machine_id')
+        self.leaf_cache = leaf_cache
+        self.budgets = {}
+        self.copy_stats = CopyStats()
 
     def __repr__(self):
         return '{}({!r})'.format(self.__class__.__name__, self.db)
 
     def log(self, timestamp, _type, **kw):
+        """
+        Buffer a log doc to be saved in the log DB by `MetaStore.log_writer`.
+
+        The doc will be saved within a few seconds, or when
+        `MetaStore.flush_log()` is called.  Docs for rank-decreasing events
+        (those in ``FLUSH_LOG_TYPES``) are saved before this returns, so they
+        aren't lost if the worker is terminated.
+        """
         doc = kw
         doc.update({
             '_id': log_id(timestamp),
@@ -444,9 +1510,32 @@ class MetaStore:
             'type': _type,
             'machine_id': self.machine_id, 
         })
-        self.log_db.save(doc)
+        self.log_writer.write(doc, _type in FLUSH_LOG_TYPES)
         return doc
 
+    def flush_log(self):
+        self.log_writer.flush()
+
+    def get_budget(self, fs):
+        """
+        Return the `IOBudget` for background IO on `FileStore` *fs*.
+
+        The budget is created from the "dmedia/store" doc the first time it's
+        needed, so changes to the "io_budget" config take effect the next time
+        a worker process is started.
+        """
+        try:
+            return self.budgets[fs.id]
+        except KeyError:
+            pass
+        try:
+            doc = self.db.get(fs.id)
+        except NotFound:
+            doc = fs.doc
+        budget = IOBudget.from_doc(doc)
+        self.budgets[fs.id] = budget
+        return budget
+
     def log_file_corrupt(self, timestamp, fs, _id):
         return self.log(timestamp, 'dmedia/file/corrupt',
             file_id=_id,
@@ -472,8 +1561,15 @@ class MetaStore:
         if not isinstance(doc, dict):
             raise TypeError(TYPE_ERROR.format('doc', dict, type(doc), doc))
         _id = doc['_id']
+        if self.leaf_cache is not None:
+            ch = self.leaf_cache.content_hash(_id, doc['bytes'], unpack)
+            if ch is not None:
+                return ch
         leaf_hashes = self.db.get_att(_id, 'leaf_hashes').data
-        return check_root_hash(_id, doc['bytes'], leaf_hashes, unpack)
+        ch = check_root_hash(_id, doc['bytes'], leaf_hashes, unpack)
+        if self.leaf_cache is not None:
+            self.leaf_cache.add(ch)
+        return ch
 
     def get_machine(self):
         try:
@@ -500,24 +1596,15 @@ class MetaStore:
         for row in result['rows']:
             yield row['key']
 
-    def schema_check(self):
+    def schema_check(self, processes=None):
         """
-        If needed, migrate mtime from float to int.
+        Check dmedia/file docs changed since the last schema check.
+
+        If needed, mtime is migrated from float to int.  Returns the number of
+        docs that were migrated.  See `SchemaChecker` for details.
         """
-        buf = BufferedSave(self.db)
-        rows = self.db.view('doc', 'type', key='dmedia/file')['rows']
-        for ids in id_slice_iter(rows):
-            for doc in self.db.get_many(ids):
-                changed = False
-                for value in doc['stored'].values():
-                    if isinstance(value.get('mtime'), float):
-                        changed = True
-                        value['mtime'] = int(value['mtime'])
-                if changed:
-                    buf.save(doc)
-        buf.flush()
-        log.info('converted mtime from `float` to `int` for %d docs', buf.count)
-        return buf.count
+        checker = SchemaChecker(self, processes)
+        return checker.run()
 
     def _downgrade_by_view(self, curtime, threshold, view):
         assert isinstance(curtime, int) and curtime >= 0
@@ -526,31 +1613,12 @@ class MetaStore:
         assert view in ('downgrade-by-mtime', 'downgrade-by-verified')
         endkey = curtime - threshold
         self.db.wait_for_compact()
-        t = TimeDelta()
-        count = 0
-        while True:
-            rows = self.db.view('file', view,
-                endkey=endkey,
-                include_docs=True,
-                limit=100,
-            )['rows']
-            if not rows:
-                break
-            dmap = dict(
-                (row['id'], row['doc']) for row in rows
-            )
-            for row in rows:
-                doc = dmap[row['id']]
-                doc['stored'][row['value']]['copies'] = 0
-            docs = list(dmap.values())
-            count += len(docs)
-            try:
-                self.db.save_many(docs)
-            except BulkConflict as e:
-                log.exception('Conflict in %r', view)
-                count -= len(e.conflicts)
+        sweep = Sweep(self.db, 'file', view, sweep_downgrade_by_view,
+            endkey=endkey,
+        )
+        count = sweep.run()
         if count > 0:
-            t.log('%s %d files', view, count)
+            sweep.log('%s %d files', view, count)
         return count
 
     def downgrade_by_mtime(self, curtime):
@@ -651,32 +1719,17 @@ class MetaStore:
                 log.info('store %s okay at atime %s', store_id, atime)
         return result
 
-    def downgrade_store(self, store_id):
+    def downgrade_store(self, store_id, batch_size=100):
         self.db.wait_for_compact()
-        t = TimeDelta()
-        count = 0
-        while True:
-            rows = self.db.view('file', 'nonzero',
-                key=store_id,
-                include_docs=True,
-                limit=100,
-            )['rows']
-            if not rows:
-                break
-            docs = [r['doc'] for r in rows]
-            for doc in docs:
-                value = get_dict(get_dict(doc, 'stored'), store_id)
-                value['copies'] = 0
-                value.pop('verified', None)
-            count += len(docs)
-            try:
-                self.db.save_many(docs)
-            except BulkConflict as e:
-                log.exception('Conflict downgrading %s', store_id)
-                count -= len(e.conflicts)
+        sweep = Sweep(self.db, 'file', 'nonzero', sweep_downgrade_store,
+            batch_size,
+            key=store_id,
+        )
+        count = sweep.run()
         if count > 0:
-            t.log('downgrade %d copies in %s', count, store_id)
+            sweep.log('downgrade %d copies in %s', count, store_id)
             self.log_store_downgrade(time.time(), store_id, count)
+            self.flush_log()
         return count
 
     def downgrade_all(self):
@@ -708,27 +1761,13 @@ class MetaStore:
         t.log('downgrade all %d files (%d total copies)', file_count, copy_count)
         return (file_count, copy_count)
 
-    def purge_store(self, store_id):
+    def purge_store(self, store_id, batch_size=100):
         self.db.wait_for_compact()
-        t = TimeDelta()
-        count = 0
-        while True:
-            rows = self.db.view('file', 'stored',
-                key=store_id,
-                include_docs=True,
-                limit=100,
-            )['rows']
-            if not rows:
-                break
-            docs = [r['doc'] for r in rows]
-            for doc in docs:
-                get_dict(doc, 'stored').pop(store_id, None)
-            count += len(docs)
-            try:
-                self.db.save_many(docs)
-            except BulkConflict as e:
-                log.exception('Conflict purging %s', store_id)
-                count -= len(e.conflicts)
+        sweep = Sweep(self.db, 'file', 'stored', sweep_purge_store,
+            batch_size,
+            key=store_id,
+        )
+        count = sweep.run()
         try:
             doc = self.db.get(store_id)
             log.info('Deleting: %s', dumps(doc, True))
@@ -736,8 +1775,9 @@ class MetaStore:
         except NotFound:
             pass
         if count > 0:
-            t.log('purge %d copies in %s', count, store_id)
+            sweep.log('purge %d copies in %s', count, store_id)
             self.log_store_purge(time.time(), store_id, count)
+            self.flush_log()
         return count
 
     def purge_all(self):
@@ -759,6 +1799,7 @@ class MetaStore:
                 file_count += 1
         buf.flush()
         t.log('purge all %d files', file_count)
+        metrics.report('purge', t.delta, file_count)
         return file_count
 
     def scan(self, fs):
@@ -807,10 +1848,12 @@ class MetaStore:
         self.db.wait_for_compact()
         t = TimeDelta()
         # Do the scan for all files in fs.id:        
+        budget = self.get_budget(fs)
         count = 0
         for doc in self.db.iter_view('file', 'stored', fs.id):
             _id = doc['_id']
             count += 1
+            budget.consume()
             try:
                 st = fs.stat(_id)
                 stored = get_dict(doc, 'stored')
@@ -829,16 +1872,103 @@ class MetaStore:
             except FileNotFound:
                 log.warning('%s is not in %r', _id, fs)
                 self.db.update(mark_removed, doc, fs.id)
-        # Update the atime for the dmedia/store doc
+        self.update_store_atime(fs)
+        t.log('scan %r files in %r', count, fs)
+        metrics.report('scan', t.delta, count, label=fs.id)
+        return count
+
+    def update_store_atime(self, fs):
+        """
+        Update the atime and bytes_avail in the dmedia/store doc for *fs*.
+        """
         try:
             doc = self.db.get(fs.id)
         except NotFound:
             doc = deepcopy(fs.doc)
-        self.db.update(update_store, doc, time.time(), fs.statvfs().avail)
-        t.log('scan %r files in %r', count, fs)
+        return self.db.update(update_store, doc, time.time(), fs.statvfs().avail)
+
+    def scan_by_listing(self, fs, size=100):
+        """
+        Like `MetaStore.scan()`, but driven by a single listing of *fs*.
+
+        Instead of calling ``FileStore.stat()`` once for each file in the
+        "file/stored" view, the files in *fs* are listed in a single pass with
+        `list_filestore()`, and the view rows are diffed against this in-memory
+        map.  On a mechanical HDD this avoids a random metadata seek for each
+        file.
+
+        The view is walked *size* rows at a time, and each page is handled in
+        bulk: the missing, wrong size, and wrong mtime sets are each saved with
+        one `bulk_update()` call, which still safely re-tries conflicts with
+        `microfiber.Database.update()`, as these are rank-decreasing updates.
+
+        The checks and the resulting metadata updates are exactly the same as
+        `MetaStore.scan()`, and likewise this returns the number of files that
+        were expected to be in *fs*.
+        """
+        self.db.wait_for_compact()
+        t = TimeDelta()
+        listing = list_filestore(fs, self.get_budget(fs))
+        t.log('list %d files in %r', len(listing), fs)
+        return self._scan_listing(fs, listing, size)
+
+    def _scan_listing(self, fs, listing, size=100, feed=None):
+        """
+        Diff the "file/stored" view against a *listing* of *fs*.
+
+        If a *feed* queue is provided, the docs downgraded because of a wrong
+        mtime are put on it (a list per page) so they can be verified right
+        away.
+        """
+        t = TimeDelta()
+        count = 0
+        pages = iter_view_pages(self.db, 'file', 'stored', size,
+            key=fs.id,
+            include_docs=True,
+        )
+        for rows in pages:
+            missing = []
+            bad_size = []
+            bad_mtime = []
+            for row in rows:
+                doc = row['doc']
+                _id = doc['_id']
+                count += 1
+                try:
+                    (file_size, mtime) = listing[_id]
+                except KeyError:
+                    # The file might have been added since the listing (say,
+                    # by a download or an import), so check before removing:
+                    try:
+                        st = fs.stat(_id)
+                    except FileNotFound:
+                        log.warning('%s is not in %r', _id, fs)
+                        missing.append((doc, (fs.id,)))
+                        continue
+                    (file_size, mtime) = (st.size, int(st.mtime))
+                value = get_dict(get_dict(doc, 'stored'), fs.id)
+                if doc.get('bytes') != file_size:
+                    log.error('%s has wrong size in %r', _id, fs)
+                    src_fp = open(fs.path(_id), 'rb')
+                    fs.move_to_corrupt(src_fp, _id,
+                        file_size=doc['bytes'],
+                        bad_file_size=file_size,
+                    )
+                    bad_size.append((doc, (time.time(), fs.id)))
+                elif value.get('mtime') != mtime:
+                    log.warning('%s has wrong mtime %r', _id, fs)
+                    bad_mtime.append((doc, (fs.id, mtime)))
+            bulk_update(self.db, mark_removed, missing)
+            bulk_update(self.db, mark_corrupt, bad_size)
+            bulk_update(self.db, mark_mismatched, bad_mtime)
+            if feed is not None and bad_mtime:
+                feed.put([deepcopy(doc) for (doc, args) in bad_mtime])
+        self.update_store_atime(fs)
+        t.log('scan (by listing) %r files in %r', count, fs)
+        metrics.report('scan', t.delta, count, label=fs.id)
         return count
 
-    def relink(self, fs):
+    def relink(self, fs, manifest=None):
         """
         Find known files that we didn't expect in `FileStore` *fs*.
 
@@ -946,11 +2076,20 @@ class MetaStore:
                 it's only okay to do this here because this method makes
                 rank-increasing updates... this approach is *never* okay for
                 methods that make rank-decreasing updates.
+
+        When a `dmedia.manifest.RelinkManifest` *manifest* is provided, only
+        the directories whose mtime has changed since the last run are listed,
+        and only the docs for IDs not already in the manifest are requested.
+        See `MetaStore._relink_by_manifest()`.
         """
+        if manifest is not None:
+            return self._relink_by_manifest(fs, manifest)
         t = TimeDelta()
+        budget = self.get_budget(fs)
         buf = BufferedSave(self.db, 10)
         count = 0
         for group in relink_iter(fs):
+            budget.consume(ops=len(group))
             docs = self.db.get_many([st.id for st in group])
             for (st, doc) in zip(group, docs):
                 if doc is None:
@@ -969,6 +2108,92 @@ class MetaStore:
             self.db.wait_for_compact()
         buf.flush()
         t.log('relink %d files in %r', count, fs)
+        metrics.report('relink', t.delta, count, label=fs.id)
+        return count
+
+    def _relink_by_manifest(self, fs, manifest):
+        """
+        Incrementally relink *fs* using a `dmedia.manifest.RelinkManifest`.
+
+        A directory is only recorded with its mtime (and so skipped next time)
+        when every file in it was confirmed to already be linked.  Newly
+        relinked files aren't confirmed till the next run, as `BufferedSave`
+        ignores conflicts, and orphans are re-checked every run, as their docs
+        may yet arrive through replication.  A directory whose mtime is within
+        the last 2 seconds is likewise re-listed, in case a file was added
+        within the filesystem timestamp granularity.
+
+        Once the manifest is older than `RELINK_FULL`, it's reset so that every
+        file gets checked again, in case any docs were unlinked from *fs*
+        while their files remained.
+        """
+        dirs = iter_dirty_dirs(fs, manifest, self.get_budget(fs))
+        return self._relink_dirs(fs, dirs, manifest)
+
+    def _relink_dirs(self, fs, dirs, manifest=None, feed=None):
+        """
+        Relink the files in *dirs*, as from `walk_filestore()`.
+
+        When a *manifest* is provided, directories it's clean for are skipped,
+        and it's updated and saved as in `MetaStore._relink_by_manifest()`.
+
+        If a *feed* queue is provided, the newly relinked docs are put on it
+        (a list per batch) so they can be verified right away.
+        """
+        t = TimeDelta()
+        if manifest is not None:
+            if time.time() - manifest.created > RELINK_FULL:
+                log.info('Resetting %r for full relink of %r', manifest, fs)
+                manifest.reset()
+        buf = BufferedSave(self.db, 10)
+        count = 0
+        listed = 0
+        for (prefix, mtime_ns, listing) in dirs:
+            if manifest is None:
+                linked = set()
+            elif manifest.is_clean(prefix, mtime_ns):
+                continue
+            else:
+                linked = manifest.get_ids(prefix).intersection(listing)
+            listed += 1
+            new = sorted(set(listing) - linked)
+            clean = (time.time() - mtime_ns / 10**9 >= 2)
+            for i in range(0, len(new), 50):
+                ids = new[i:i+50]
+                docs = self.db.get_many(ids)
+                relinked = []
+                for (_id, doc) in zip(ids, docs):
+                    if doc is None:
+                        log.warning('Orphan %r in %r', _id, fs)
+                        clean = False
+                        continue
+                    stored = get_dict(doc, 'stored')
+                    if fs.id in stored:
+                        linked.add(_id)
+                        continue
+                    log.info('Relinking %s in %r', _id, fs)
+                    new_value = {
+                        fs.id: {'copies': 0, 'mtime': listing[_id][1]}
+                    }
+                    mark_added(doc, new_value)
+                    buf.save(doc)
+                    relinked.append(doc)
+                    count += 1
+                    clean = False
+                if feed is not None and relinked:
+                    # Save first so the verify doesn't conflict with us:
+                    buf.flush()
+                    feed.put([deepcopy(doc) for doc in relinked])
+                self.db.wait_for_compact()
+            if manifest is not None:
+                manifest.update(prefix, (mtime_ns if clean else None), linked)
+        buf.flush()
+        if manifest is not None:
+            manifest.save()
+        t.log('relink %d files in %r (listed %d directories)',
+                count, fs, listed)
+        metrics.report('relink', t.delta, count, label=fs.id)
+        metrics.incr('relink.listed', listed, label=fs.id)
         return count
 
     def remove(self, fs, doc):
@@ -990,7 +2215,7 @@ class MetaStore:
             raise TypeError(TYPE_ERROR.format('doc', dict, type(doc), doc))
         _id = doc['_id']
         try:
-            fs.copy(_id, *dst_fs)
+            copy_file(fs, _id, dst_fs, self.get_budget, self.copy_stats)
             log.info('Copied %s from %r to %r', _id, fs, list(dst_fs))
             new = create_stored(_id, fs, *dst_fs)
             return self.db.update(mark_copied, doc, time.time(), fs.id, new)
@@ -1011,7 +2236,11 @@ class MetaStore:
             raise TypeError(TYPE_ERROR.format('doc', dict, type(doc), doc))
         _id = doc['_id']
         try:
-            fs.verify(_id)
+            start = time.perf_counter()
+            verify_with_budget(fs, _id, self.get_budget(fs))
+            metrics.observe('verify.file.seconds',
+                time.perf_counter() - start, fs.id
+            )
             log.info('Verified %s in %r', _id, fs)
             value = create_stored_value(_id, fs, time.time())
             return self.db.update(mark_verified, doc, fs.id, value)
@@ -1024,16 +2253,18 @@ class MetaStore:
             self.log_file_corrupt(timestamp, fs, _id)
             return self.db.update(mark_corrupt, doc, timestamp, fs.id)
 
-    def verify_by_downgraded(self, fs):
+    def verify_by_downgraded(self, fs, layout=False):
         """
         Verify all downgraded files in FileStore *fs*.
+
+        See `order_rows()` for the *layout* option.
         """
         count = 0
         size = 0
         t = TimeDelta()
         kw = {
             'key': fs.id,
-            'limit': 17,
+            'limit': (LAYOUT_BATCH if layout else VERIFY_BATCH),
             'include_docs': True,
         }
         while True:
@@ -1041,7 +2272,7 @@ class MetaStore:
             rows = self.db.view('file', 'store-downgraded', **kw)['rows']
             if not rows:
                 break
-            random.shuffle(rows)
+            order_rows(fs, rows, layout, self.get_budget(fs))
             for row in rows:
                 doc = row['doc']
                 self.verify(fs, doc)
@@ -1050,9 +2281,11 @@ class MetaStore:
         if count:
             t.log('verify (by downgraded) %s in %r [%s]',
                     count_and_size(count, size), fs, t.rate(size))
+            metrics.report('verify', t.delta, count, size, label=fs.id)
+        self.flush_log()
         return (count, size)
 
-    def _verify_by_view(self, fs, curtime, threshold, view):
+    def _verify_by_view(self, fs, curtime, threshold, view, layout=False):
         assert isinstance(curtime, int) and curtime >= 0
         count = 0
         size = 0
@@ -1060,7 +2293,7 @@ class MetaStore:
         kw = {
             'startkey': [fs.id, None],
             'endkey': [fs.id, curtime - threshold],
-            'limit': 17,
+            'limit': (LAYOUT_BATCH if layout else VERIFY_BATCH),
             'include_docs': True,
         }
         while True:
@@ -1068,7 +2301,7 @@ class MetaStore:
             rows = self.db.view('file', view, **kw)['rows']
             if not rows:
                 break
-            random.shuffle(rows)
+            order_rows(fs, rows, layout, self.get_budget(fs))
             for row in rows:
                 doc = row['doc']
                 self.verify(fs, doc)
@@ -1077,82 +2310,212 @@ class MetaStore:
         if count:
             t.log('verify (by %s) %s in %r [%s]', view,
                     count_and_size(count, size), fs, t.rate(size))
+            metrics.report('verify', t.delta, count, size, label=fs.id)
+        self.flush_log()
         return (count, size)
 
-    def verify_by_mtime(self, fs, curtime):
+    def verify_by_mtime(self, fs, curtime, layout=False):
         """
         Verify files never verified whose "mtime" is older than 6 hours.
         """
         return self._verify_by_view(
-            fs, curtime, VERIFY_BY_MTIME, 'store-mtime'
+            fs, curtime, VERIFY_BY_MTIME, 'store-mtime', layout
         ) 
 
-    def verify_by_verified(self, fs, curtime):
+    def verify_by_verified(self, fs, curtime, layout=False):
         """
         Verify files whose "verified" timestamp is older than 2 weeks.
         """
         return self._verify_by_view(
-            fs, curtime, VERIFY_BY_VERIFIED, 'store-verified'
+            fs, curtime, VERIFY_BY_VERIFIED, 'store-verified', layout
         )
 
-    def verify_all(self, fs, curtime):
+    def verify_all(self, fs, curtime, layout=False, feed=None):
+        """
+        Verify downgraded, then by mtime, then by verified files in *fs*.
+
+        This does the same work as calling `MetaStore.verify_by_downgraded()`,
+        `MetaStore.verify_by_mtime()`, and `MetaStore.verify_by_verified()` one
+        after another, but does so with a `VerifyPipeline` so the drive reads
+        and the CouchDB requests overlap.
+
+        When *layout* is ``True``, each batch is ordered by on-disk location
+        rather than shuffled (see `order_rows()`), which is much faster for
+        many small files on a mechanical HDD.
+
+        See `VerifyPipeline` for the *feed* option.
+        """
         if curtime is None:
             curtime = int(time.time())
         assert isinstance(curtime, int) and curtime >= 0
         log.info('Verifying files in %r as of %d...', fs, curtime)
         t = TimeDelta()
-        (c1, s1) = self.verify_by_downgraded(fs)
-        (c2, s2) = self.verify_by_mtime(fs, curtime)
-        (c3, s3) = self.verify_by_verified(fs, curtime)
-        count = c1 + c2 + c3
-        size = s1 + s2 + s3
+        pipeline = VerifyPipeline(self, fs, layout=layout, feed=feed)
+        try:
+            (count, size) = pipeline.run(curtime)
+        finally:
+            self.flush_log()
         t.log('verify %s in %r [%s]',
                 count_and_size(count, size), fs, t.rate(size))
+        metrics.report('verify', t.delta, count, size, label=fs.id)
         return (count, size)
 
+    def scan_relink_verify(self, fs, curtime=None, layout=False,
+            manifest=None):
+        """
+        Scan, relink, and verify *fs*, with the three phases overlapped.
+
+        This does the same work as calling `MetaStore.scan_by_listing()`,
+        `MetaStore.relink()`, and `MetaStore.verify_all()` one after another,
+        but the scan is metadata and CouchDB bound, the relink is CouchDB
+        bound, and the verify is read bound, so running them in sequence
+        leaves most of these idle most of the time.  Instead:
+
+            1.  *fs* is walked once with `walk_filestore()`, and this listing
+                is used both to diff against the "file/stored" view and to find
+                files to relink
+
+            2.  The scan and the relink then run in parallel, each in its own
+                thread, while a `VerifyPipeline` immediately starts reading
+                the files already in the "file/store-downgraded" view
+
+            3.  As the scan downgrades files (wrong mtime) and the relink adds
+                files, their docs are fed straight into the verify pipeline,
+                which verifies them before moving on to the "file/store-mtime"
+                and "file/store-verified" views
+
+        Returns a ``dict`` with the wall time in seconds of each phase ("walk",
+        "scan", "relink", and "verify"), and of the whole task ("total").
+        These are also logged and reported in the "filestore.<phase>.seconds"
+        histograms.
+        """
+        if curtime is None:
+            curtime = int(time.time())
+        assert isinstance(curtime, int) and curtime >= 0
+        total = TimeDelta()
+        self.db.wait_for_compact()
+        t = TimeDelta()
+        dirs = walk_filestore(fs, self.get_budget(fs))
+        listing = {}
+        for (prefix, mtime_ns, files) in dirs:
+            listing.update(files)
+        times = {'walk': t.delta}
+        log.info('walk phase: %d files in %.3fs in %r',
+            len(listing), t.delta, fs
+        )
+        q = SmartQueue()
+        feed = SmartQueue()
+        start_thread(run_phase, q, 'verify',
+            self.verify_all, fs, curtime, layout, feed
+        )
+        start_thread(run_phase, q, 'scan',
+            self._scan_listing, fs, listing, 100, feed
+        )
+        start_thread(run_phase, q, 'relink',
+            self._relink_dirs, fs, dirs, manifest, feed
+        )
+        error = None
+        for i in range(3):
+            (name, delta, result, e) = q.get()
+            times[name] = delta
+            log.info('%s phase: %.3fs in %r', name, delta, fs)
+            if error is None:
+                error = e
+            if name != 'verify' and 'scan' in times and 'relink' in times:
+                feed.put(None)
+        if error is not None:
+            raise error
+        times['total'] = total.delta
+        log.info('filestore task: %.3fs in %r', times['total'], fs)
+        for (name, delta) in times.items():
+            if name == 'total':
+                metrics.observe('filestore.seconds', delta, fs.id)
+            else:
+                metrics.observe('filestore.' + name + '.seconds', delta, fs.id)
+        return times
+
     def finish_download(self, fs, doc, tmp_fp):
         log.info('Finishing download of %s in %r', doc['_id'], fs)
         fs.move_to_canonical(tmp_fp, doc['_id'])
         new = create_stored(doc['_id'], fs)
         return self.db.update(mark_added, doc, new)
 
+    def recheck_ranks(self, docs, rank=None):
+        """
+        Return the current version of each of *docs*, using one `get_many()`.
+
+        The docs from `MetaStore.iter_rank_pages()` are prefetched, and can
+        sit in a plan for a while, so call this right before acting on them.
+        The result lines up with *docs*, with ``None`` in place of each doc
+        that has since been deleted, or whose rank is now above *rank* (or
+        above the rank the doc had, when *rank* is ``None``).
+        """
+        if not docs:
+            return []
+        current = self.db.get_many([doc['_id'] for doc in docs])
+        result = []
+        for (doc, new) in zip(docs, current):
+            if new is None:
+                log.info('%s was deleted, skipping', doc['_id'])
+                result.append(None)
+                continue
+            max_rank = (get_rank(doc) if rank is None else rank)
+            new_rank = get_rank(new)
+            if new_rank > max_rank:
+                log.info('Now at rank %d > %d, skipping %s',
+                    new_rank, max_rank, doc['_id']
+                )
+                result.append(None)
+            else:
+                result.append(new)
+        return result
+
     def iter_files_at_rank(self, rank):
+        for (last_id, docs) in self.iter_rank_pages(rank):
+            for doc in self.recheck_ranks(docs, rank):
+                if doc is not None:
+                    yield doc
+
+    def iter_rank_pages(self, rank, start_id=None):
+        """
+        Yield ``(last_id, docs)`` for each page of files at *rank*.
+
+        *last_id* is the ID of the last row in the page (in view order), so
+        the walk can later be resumed after that page by passing it as
+        *start_id*.  The *docs* in each page are shuffled, and those whose
+        rank has since increased are skipped.  As the pages are prefetched,
+        use `MetaStore.recheck_ranks()` right before acting on a page.
+        """
         if not isinstance(rank, int):
             raise TypeError(TYPE_ERROR.format('rank', int, type(rank), rank))
         if not (0 <= rank <= 5):
             raise ValueError('Need 0 <= rank <= 5; got {}'.format(rank))
-        LIMIT = 50
-        kw = {
-            'limit': LIMIT,
-            'key': rank,
-        }
-        log.info('Considering files at rank=%d', rank)
-        while True:
-            rows = self.db.view('file', 'rank', **kw)['rows']
-            if not rows:
-                break
-            ids = [r['id'] for r in rows]
-            if ids[0] == kw.get('startkey_docid'):
-                ids.pop(0)
+        log.info('Considering files at rank=%d, start_id=%r', rank, start_id)
+        kw = {'key': rank}
+        if start_id is not None:
+            kw['startkey_docid'] = start_id
+        pages = iter_prefetch(self._iter_doc_pages('rank', 50, **kw))
+        for (ids, docs) in pages:
+            if start_id is not None and ids[0] == start_id:
+                ids = ids[1:]
+                docs = docs[1:]
             if not ids:
-                break
-            random.shuffle(ids)
-            for _id in ids:
-                try:
-                    doc = self.db.get(_id)
-                    doc_rank = get_rank(doc)
-                    if doc_rank <= rank:
-                        yield doc
-                    else:
-                        log.info('Now at rank %d > %d, skipping %s',
-                            doc_rank, rank, doc.get('_id')
-                        )
-                except NotFound:
+                continue
+            pairs = list(zip(ids, docs))
+            random.shuffle(pairs)
+            keep = []
+            for (_id, doc) in pairs:
+                if doc is None:
                     log.warning('doc NotFound for %s at rank=%d', _id, rank)
-            if len(rows) < LIMIT:
-                break
-            kw['startkey_docid'] = rows[-1]['id']
-            self.db.wait_for_compact()
+                    continue
+                doc_rank = get_rank(doc)
+                if doc_rank <= rank:
+                    keep.append(doc)
+                else:
+                    log.info('Now at rank %d > %d, skipping %s',
+                        doc_rank, rank, doc.get('_id')
+                    )
+            yield (ids[-1], keep)
 
     def iter_fragile_files(self, stop=6):
         if not isinstance(stop, int):
@@ -1163,17 +2526,28 @@ class MetaStore:
             for doc in self.iter_files_at_rank(rank):
                 yield doc
 
-    def wait_for_fragile_files(self, last_seq):
+    def wait_for_fragile_files(self, last_seq, limit=CHANGES_BATCH):
+        """
+        Wait for changes since *last_seq*, returning those for fragile files.
+
+        Up to *limit* changes are requested at a time.  Rather than having
+        CouchDB evaluate the "file/fragile" JavaScript filter for every change,
+        the docs are checked with `is_fragile()`, so a burst of changes (say,
+        after a big import on a peer) is consumed in a few large batches.
+        Note that the "results" can be empty when none of the changes in a
+        batch were for fragile files.
+        """
         kw = {
-            'limit': 3,
+            'limit': limit,
             'feed': 'longpoll',
             'include_docs': True,
-            'filter': 'file/fragile',
             'since': last_seq,
         }
         while True:
             try:
-                return self.db.get('_changes', **kw)
+                result = self.db.get('_changes', **kw)
+                result['results'] = filter_fragile_rows(result['results'])
+                return result
             # FIXME: Sometimes we get a 400 Bad Request from CouchDB, perhaps
             # when `since` gets ahead of the `update_seq` as viewed by the
             # changes feed?  By excepting `BadRequest` here, we prevent the
@@ -1187,6 +2561,19 @@ class MetaStore:
             except (OSError, BadRequest):
                 pass
 
+    def _iter_doc_pages(self, view, limit, **kw):
+        """
+        Yield ``(ids, docs)`` for each page of the "file/*view*" view.
+
+        The docs for each page are requested with a single `get_many()`, rather
+        than with a request per doc.  A doc that has since been deleted will be
+        ``None``.
+        """
+        for rows in iter_view_pages(self.db, 'file', view, limit, **kw):
+            ids = [r['id'] for r in rows]
+            yield (ids, self.db.get_many(ids))
+            self.db.wait_for_compact()
+
     def iter_preempt_files(self):
         kw = {
             'limit': 300,
@@ -1195,45 +2582,135 @@ class MetaStore:
         rows = self.db.view('file', 'preempt', **kw)['rows']
         if not rows:
             return
-        ids = [r['id'] for r in rows]
-        log.info('Considering %d files for preemptive copy increasing', len(ids))
-        random.shuffle(ids)
-        for _id in ids:
-            try:
-                doc = self.db.get(_id)
+        log.info('Considering %d files for preemptive copy increasing', len(rows))
+        random.shuffle(rows)
+        # Fetch the docs in batches, the next batch being fetched while the
+        # caller works on the current one:
+        batches = iter_prefetch(
+            (ids, self.db.get_many(ids)) for ids in id_slice_iter(rows, 50)
+        )
+        for (ids, docs) in batches:
+            for (_id, doc) in zip(ids, docs):
+                if doc is None:
+                    log.warning('preempt doc NotFound for %s', _id)
+                    continue
                 copies = get_copies(doc)
                 if copies == 3:
                     yield doc
                 else:
                     log.info('Now at copies=%d, skipping %s', copies, _id)
-            except NotFound:
-                log.warning('preempt doc NotFound for %s', _id)
 
-    def reclaim(self, fs, threshold=MAX_BYTES_FREE):
+    def plan_reclaim(self, fs, need, batch_size=100):
+        """
+        Return a list of reclaimable docs in *fs* totaling at least *need* bytes.
+
+        The "file/store-reclaimable" view is paged through in order of atime
+        (least recently accessed first), and rows are taken until the sum of
+        their doc['bytes'] reaches *need*.  Fewer bytes are returned when there
+        aren't enough reclaimable files in *fs*.
+        """
+        docs = []
+        size = 0
+        if need <= 0:
+            return docs
+        pages = iter_view_pages(self.db, 'file', 'store-reclaimable', batch_size,
+            startkey=[fs.id, None],
+            endkey=[fs.id, int(time.time())],
+            include_docs=True,
+        )
+        for rows in pages:
+            for row in rows:
+                doc = row['doc']
+                if doc is None:
+                    continue
+                docs.append(doc)
+                size += get_bytes(doc)
+                if size >= need:
+                    return docs
+        return docs
+
+    def _reclaim_batch(self, fs, ids):
+        """
+        Remove copies in *fs* for *ids* with a single bulk metadata update.
+
+        Each doc is re-fetched and re-checked with `is_reclaimable()`.  As this
+        is a rank-decreasing update, docs that conflict are skipped rather than
+        re-tried, and won't have their file removed.
+        """
+        docs = [
+            doc for doc in self.db.get_many(ids)
+            if doc is not None and is_reclaimable(doc, fs.id)
+        ]
+        if not docs:
+            return []
+        for doc in docs:
+            mark_removed(doc, fs.id)
+        try:
+            self.db.save_many(docs)
+        except BulkConflict as e:
+            conflicts = set(row['id'] for row in e.conflicts)
+            log.warning('reclaim: skipping %d conflicts in %r',
+                len(conflicts), fs
+            )
+            docs = [doc for doc in docs if doc['_id'] not in conflicts]
+        for doc in docs:
+            try:
+                fs.remove(doc['_id'])
+            except FileNotFound:
+                log.warning('%s is not in %r', doc['_id'], fs)
+        return docs
+
+    def reclaim(self, fs, threshold=MAX_BYTES_FREE, dry_run=False, batch_size=50):
+        """
+        Remove reclaimable files from *fs* till it has *threshold* bytes free.
+
+        Rather than checking `FileStore.statvfs()` after each file is removed,
+        a plan is made with `MetaStore.plan_reclaim()` from the doc['bytes'] of
+        the reclaimable files, which are then removed in batches of
+        *batch_size*.  `FileStore.statvfs()` is only called again to reconcile
+        at the end of each plan, in case another plan is needed (say because
+        some docs changed and were no longer reclaimable).
+
+        If *dry_run* is ``True``, the files that would be removed are logged
+        but nothing is changed.
+
+        Returns a ``(count, size)`` tuple.
+        """
         count = 0
         size = 0
         t = TimeDelta()
         while True:
-            kw = {
-                'startkey': [fs.id, None],
-                'endkey': [fs.id, int(time.time())],
-                'limit': 1,
-                'include_docs': True,
-            }
-            rows = self.db.view('file', 'store-reclaimable', **kw)['rows']
-            if not rows:
+            avail = fs.statvfs().avail
+            if avail > threshold:
                 break
-            doc = rows[0]['doc']
-            doc = self.remove(fs, doc)
-            count += 1
-            size += doc['bytes']
-            if fs.statvfs().avail > threshold:
+            docs = self.plan_reclaim(fs, threshold - avail + 1)
+            if not docs:
+                break
+            if dry_run:
+                for doc in docs:
+                    log.info('dry run: would reclaim %s (%s) in %r',
+                        doc['_id'], bytes10(get_bytes(doc)), fs
+                    )
+                count = len(docs)
+                size = sum(get_bytes(doc) for doc in docs)
+                t.log('plan reclaim of %s in %r', count_and_size(count, size), fs)
+                metrics.report('reclaim.plan', t.delta, count, size, fs.id)
+                return (count, size)
+            removed = 0
+            ids = [doc['_id'] for doc in docs]
+            for i in range(0, len(ids), batch_size):
+                for doc in self._reclaim_batch(fs, ids[i:i+batch_size]):
+                    removed += 1
+                    size += get_bytes(doc)
+            if removed == 0:
                 break
+            count += removed
         if count > 0:
             t.log('reclaim %s in %r', count_and_size(count, size), fs)
+            metrics.report('reclaim', t.delta, count, size, label=fs.id)
         return (count, size)
 
-    def reclaim_all(self, threshold=MAX_BYTES_FREE):
+    def reclaim_all(self, threshold=MAX_BYTES_FREE, dry_run=False):
         try:
             count = 0
             size = 0
@@ -1242,12 +2719,13 @@ class MetaStore:
             for fs in filestores:
                 if fs.statvfs().avail > threshold:
                     break
-                (c, s) = self.reclaim(fs, threshold)
+                (c, s) = self.reclaim(fs, threshold, dry_run)
                 count += c
                 size += s
             n = len(filestores)
             if count > 0:
-                t.log('reclaim %s in %d filestores', count_and_size(count, size), n)
+                msg = ('plan reclaim of' if dry_run else 'reclaim')
+                t.log('%s %s in %d filestores', msg, count_and_size(count, size), n)
             return (count, size, n)
         except Exception:
             log.exception('error in MetaStore.reclaim_all():')
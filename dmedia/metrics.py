@@ -0,0 +1,256 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Counters, gauges, and latency histograms for the background tasks.
+
+Each process has a single `Registry` (`registry`), which the scan, relink,
+verify, purge, reclaim, and sweep code report into through the module-level
+`incr()`, `gauge()`, `observe()`, and `report()` functions.
+
+The `dmedia.core.TaskPool` starts each worker process with `run_task()`, which
+periodically drains the worker's registry and sends the snapshot on a pipe of
+its own.  The reaper thread in the main service merges these snapshots into
+the main registry with `Registry.merge()`, from where they're periodically
+saved in the log DB as "dmedia/metrics" docs.
+
+For example:
+
+>>> r = Registry()
+>>> r.incr('verify.count', 3)
+>>> r.gauge('verify.queue', 2)
+>>> r.observe('verify.seconds', 0.75)
+>>> snapshot = r.drain()
+>>> snapshot['counters']
+{'verify.count': 3}
+>>> r.incr('verify.count')
+>>> r.merge(snapshot)
+>>> r.snapshot()['counters']
+{'verify.count': 4}
+
+"""
+
+import os
+import time
+import signal
+import threading
+import logging
+from bisect import bisect_left
+from copy import deepcopy
+
+from .parallel import start_thread
+
+
+log = logging.getLogger()
+
+# Histogram bucket upper bounds, in seconds; the last bucket is unbounded:
+BUCKETS = (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 60, 300, 1800)
+FORWARD_INTERVAL = 15
+
+
+def metric_name(name, label=None):
+    """
+    Return the registry key for *name*, optionally for a specific *label*.
+
+    For example:
+
+    >>> metric_name('verify.bytes')
+    'verify.bytes'
+    >>> metric_name('verify.bytes', 'MZJBVFZG5XFVNLOQAAMD4YCR')
+    'verify.bytes:MZJBVFZG5XFVNLOQAAMD4YCR'
+
+    """
+    if label is None:
+        return name
+    return '{}:{}'.format(name, label)
+
+
+def new_histogram():
+    return {'count': 0, 'sum': 0.0, 'buckets': [0] * (len(BUCKETS) + 1)}
+
+
+class Registry:
+    __slots__ = ('lock', 'counters', 'gauges', 'histograms')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = new_histogram()
+            h['count'] += 1
+            h['sum'] += value
+            h['buckets'][bisect_left(BUCKETS, value)] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': deepcopy(self.histograms),
+            }
+
+    def drain(self):
+        """
+        Return a snapshot, then reset the registry.
+
+        Used in worker processes so each forwarded snapshot only contains what
+        changed since the last one.
+        """
+        with self.lock:
+            snapshot = {
+                'counters': self.counters,
+                'gauges': self.gauges,
+                'histograms': self.histograms,
+            }
+            self.reset()
+            return snapshot
+
+    def merge(self, snapshot):
+        """
+        Merge a snapshot from `Registry.drain()` into this registry.
+        """
+        with self.lock:
+            for (name, value) in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            self.gauges.update(snapshot['gauges'])
+            for (name, other) in snapshot['histograms'].items():
+                h = self.histograms.get(name)
+                if h is None:
+                    h = self.histograms[name] = new_histogram()
+                h['count'] += other['count']
+                h['sum'] += other['sum']
+                for (i, n) in enumerate(other['buckets']):
+                    h['buckets'][i] += n
+
+
+def is_empty(snapshot):
+    return not any(snapshot.values())
+
+
+registry = Registry()
+_send_lock = threading.Lock()
+
+
+def incr(name, value=1, label=None):
+    registry.incr(metric_name(name, label), value)
+
+
+def gauge(name, value, label=None):
+    registry.gauge(metric_name(name, label), value)
+
+
+def observe(name, value, label=None):
+    registry.observe(metric_name(name, label), value)
+
+
+def report(name, delta, count, size=None, label=None):
+    """
+    Report a completed operation, typically timed with a `TimeDelta`.
+
+    This records the duration in the "<name>.seconds" histogram, adds to the
+    "<name>.count" and optional "<name>.bytes" counters, and sets the
+    "<name>.bytes_per_sec" gauge.
+    """
+    observe(name + '.seconds', delta, label)
+    incr(name + '.count', count, label)
+    if size is not None:
+        incr(name + '.bytes', size, label)
+        if delta > 0:
+            gauge(name + '.bytes_per_sec', size / delta, label)
+
+
+def forward(conn, key, timeout=-1):
+    """
+    Send a snapshot of this process's metrics on *conn* if there's anything new.
+
+    Returns ``False`` if the previous send didn't finish within *timeout*
+    seconds, in which case nothing is sent.
+    """
+    if not _send_lock.acquire(timeout=timeout):
+        return False
+    try:
+        snapshot = registry.drain()
+        if not is_empty(snapshot):
+            conn.send((key, snapshot))
+        return True
+    finally:
+        _send_lock.release()
+
+
+def forwarder(conn, key, interval):
+    while True:
+        time.sleep(interval)
+        forward(conn, key)
+
+
+def on_sigterm(conn, key):
+    """
+    Return a SIGTERM handler that forwards the metrics before dying.
+
+    The main thread might be interrupted while holding the registry lock, which
+    is why `run_task()` makes it re-entrant.  It might also be interrupted in
+    the middle of a send, in which case the final snapshot is dropped rather
+    than corrupting the message.
+    """
+    def handler(signum, frame):
+        forward(conn, key, timeout=1)
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+    return handler
+
+
+def run_task(conn, key, target, *args):
+    """
+    Run *target* in a worker process, forwarding its metrics on *conn*.
+
+    Each task gets its own *conn*, so a task that's terminated in the middle of
+    a send can't corrupt the metrics of any other task.
+
+    The registry inherited from the parent process is reset first so the
+    parent's metrics aren't forwarded back to it.
+    """
+    global _send_lock
+    registry.lock = threading.RLock()  # Re-entrant for on_sigterm()
+    registry.reset()
+    _send_lock = threading.Lock()
+    signal.signal(signal.SIGTERM, on_sigterm(conn, key))
+    start_thread(forwarder, conn, key, FORWARD_INTERVAL)
+    try:
+        target(*args)
+    finally:
+        forward(conn, key)
@@ -21,11 +21,41 @@
 
 """
 Small helpers for starting threads and processes.
+
+By default, processes are started with the platform's default multiprocessing
+start method.  Long running services like dmedia-service should instead call
+`start_launcher()` early on, after which `start_process()` hands each process
+off to a forkserver that already has the dmedia modules imported, so that
+starting a background task doesn't pay to import microfiber, filestore, etc
+all over again.  Use `create_queue()` for any queue shared with a process
+started this way.
+
+Only modules are preloaded, not the CouchDB connection configuration.  The
+env (with its random port and credentials) and the SSL config aren't known
+until CouchDB has been bootstrapped, which is well after the forkserver has to
+be started, and the forkserver is a fresh process, so it can't inherit them
+anyway.  Each task still gets them as arguments and builds its own
+``microfiber.Database`` and SSL context, which is cheap next to the imports.
 """
 
 import threading
 import multiprocessing
-from queue import Queue
+import logging
+from queue import Queue, Empty
+
+
+log = logging.getLogger()
+
+PRELOAD = (
+    'dmedia.core',
+    'dmedia.metastore',
+    'dmedia.client',
+    'dmedia.importer',
+    'dmedia.workers',
+)
+
+_context = multiprocessing  # Same API as a context, with the default method
+_log_config = None
 
 
 def create_thread(target, *args, **kw):
@@ -40,8 +70,102 @@ def start_thread(target, *args, **kw):
     return thread
 
 
+def get_log_config():
+    """
+    Return a picklable description of how the root logger is configured.
+
+    This is what `launch()` needs to configure logging the same way in a
+    process started by the forkserver, which doesn't inherit the logging
+    configuration from our process.
+    """
+    root = logging.getLogger()
+    handlers = []
+    format = None
+    for handler in root.handlers:
+        if isinstance(handler, logging.FileHandler):
+            handlers.append(handler.baseFilename)
+        elif isinstance(handler, logging.StreamHandler):
+            handlers.append(None)
+        else:
+            continue
+        if format is None and handler.formatter is not None:
+            format = handler.formatter._fmt
+    return {'level': root.level, 'format': format, 'handlers': handlers}
+
+
+def configure_logging(config):
+    root = logging.getLogger()
+    root.setLevel(config['level'])
+    formatter = logging.Formatter(config['format'])
+    for filename in config['handlers']:
+        if filename is None:
+            handler = logging.StreamHandler()
+        else:
+            handler = logging.FileHandler(filename, mode='a')
+        handler.setFormatter(formatter)
+        root.addHandler(handler)
+
+
+def launch(log_config, target, args, kw):
+    """
+    Run *target* in a process started by the forkserver.
+    """
+    configure_logging(log_config)
+    target(*args, **kw)
+
+
+def start_launcher(preload=PRELOAD):
+    """
+    Start the forkserver, pre-loaded with *preload*, for `start_process()`.
+
+    Returns ``True`` if the forkserver was started, or ``False`` if it isn't
+    available on this platform, in which case processes are still started with
+    the default start method.
+
+    Note that the forkserver is started with whatever environment this process
+    has at the time, so call this early, before any threads are started.  As
+    that's before CouchDB is bootstrapped, only modules are preloaded; the
+    CouchDB env and SSL config are still passed to each task.  Also
+    note that like with the "spawn" start method, the main script is imported
+    again in each process, so it must only do its work under a
+    ``if __name__ == '__main__':`` guard.
+    """
+    global _context, _log_config
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        log.warning('forkserver not available, using default start method')
+        return False
+    from multiprocessing import forkserver
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(list(preload))
+    forkserver.ensure_running()
+    _log_config = get_log_config()
+    _context = context
+    log.info('Started forkserver with preload %r', list(preload))
+    return True
+
+
+def get_context():
+    return _context
+
+
+def create_queue():
+    return _context.Queue()
+
+
+def create_pipe():
+    """
+    Return a ``(reader, writer)`` pair of one-way connections.
+    """
+    return _context.Pipe(duplex=False)
+
+
 def start_process(target, *args, **kw):
-    process = multiprocessing.Process(target=target, args=args, kwargs=kw)
+    if _log_config is None:
+        process = _context.Process(target=target, args=args, kwargs=kw)
+    else:
+        process = _context.Process(target=launch,
+            args=(_log_config, target, args, kw)
+        )
     process.daemon = True
     process.start()
     return process
@@ -58,3 +182,139 @@ class SmartQueue(Queue):
             raise item
         return item
 
+
+def drain_queue(q):
+    """
+    Discard everything in *q*, returning the number of items discarded.
+
+    Exception instances are discarded too, rather than raised as they would be
+    by `SmartQueue.get()`.
+    """
+    count = 0
+    while True:
+        try:
+            Queue.get(q, False)
+        except Empty:
+            return count
+        count += 1
+
+
+class Lanes:
+    """
+    Run jobs in a pool of threads, with at most one job per lane at a time.
+
+    Each job is submitted with the set of lanes it needs (say, the physical
+    drives it will read from and write to).  A job is only started once none of
+    its lanes are busy, so jobs with disjoint lanes run in parallel, whereas
+    jobs sharing a lane run one at a time, in the order they were submitted.
+
+    `Lanes.submit()` blocks once *maxpending* jobs are waiting, so the
+    producer can't get too far ahead of the workers.
+    """
+
+    def __init__(self, workers, maxpending=64):
+        assert isinstance(workers, int) and workers >= 1
+        assert isinstance(maxpending, int) and maxpending >= 1
+        self.maxpending = maxpending
+        self.cond = threading.Condition()
+        self.pending = []
+        self.busy = set()
+        self.running = 0
+        self.closed = False
+        self.threads = tuple(start_thread(self.worker) for i in range(workers))
+
+    def submit(self, lanes, func, *args):
+        with self.cond:
+            if self.closed:
+                raise ValueError('Lanes are closed')
+            while len(self.pending) >= self.maxpending:
+                self.cond.wait()
+            self.pending.append((frozenset(lanes), func, args))
+            self.cond.notify_all()
+
+    def resubmit(self, lanes, func, *args):
+        """
+        Like `Lanes.submit()`, but never blocks on *maxpending*.
+
+        This is for a running job that hands work back to the lanes.  If it
+        waited, every worker could end up waiting on a full queue that only
+        the workers themselves can drain.
+        """
+        with self.cond:
+            if self.closed:
+                raise ValueError('Lanes are closed')
+            self.pending.append((frozenset(lanes), func, args))
+            self.cond.notify_all()
+
+    def next_job(self):
+        """
+        Pop the first pending job whose lanes are all free.
+
+        A lane needed by an earlier pending job is treated as busy so jobs in
+        the same lane never jump ahead of each other.  Must be called with
+        `Lanes.cond` held.
+        """
+        blocked = set(self.busy)
+        for (i, job) in enumerate(self.pending):
+            if job[0].isdisjoint(blocked):
+                return self.pending.pop(i)
+            blocked.update(job[0])
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while True:
+                    job = self.next_job()
+                    if job is not None:
+                        break
+                    if self.closed and not self.pending:
+                        return
+                    self.cond.wait()
+                (lanes, func, args) = job
+                self.busy.update(lanes)
+                self.running += 1
+                self.cond.notify_all()  # submit() might be waiting on us
+            try:
+                func(*args)
+            except Exception:
+                log.exception('Error in lane job %r', func)
+            finally:
+                with self.cond:
+                    self.busy.difference_update(lanes)
+                    self.running -= 1
+                    self.cond.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait till every submitted job has finished.
+
+        Returns ``False`` if *timeout* seconds pass first, otherwise ``True``.
+        """
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: not (self.pending or self.running), timeout
+            )
+
+    def close(self):
+        """
+        Finish the pending jobs, then stop the worker threads.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def cancel(self):
+        """
+        Drop the pending jobs and close, without waiting for the running jobs.
+
+        The worker threads exit as soon as their running jobs finish.  Returns
+        the number of pending jobs that were dropped.
+        """
+        with self.cond:
+            count = len(self.pending)
+            self.pending.clear()
+            self.closed = True
+            self.cond.notify_all()
+        return count
@@ -0,0 +1,250 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Per-peer throughput and latency estimates, used to rank download sources.
+
+Each time a file is downloaded from a peer, `PeerStats.record_download()`
+folds the measured rate into an exponentially weighted moving average (EWMA)
+for that peer.  Likewise, the time taken by the HEAD request that checks
+whether a peer has a file is folded into a latency EWMA.
+
+`PeerStats.rank()` then orders the candidate peers by the estimated time to
+download a file of a given size, so a peer on gigabit ethernet is tried before
+a peer on slow WiFi.  Peers we know nothing about yet get a middling default
+estimate, so they're still tried ahead of peers that have proven slow.
+
+The estimates are kept in ~/.cache/dmedia/peer-stats.json so they survive
+restarts.  Several processes (say, Vigilance and the download worker) save
+to the same file, so `PeerStats.save()` merges in the entries saved by the
+others, keeping whichever entry for a peer was updated most recently.  For
+example:
+
+>>> stats = PeerStats()
+>>> stats.record_download('fast', 100 * 1000 * 1000, 1.0)
+>>> stats.record_download('slow', 100 * 1000 * 1000, 25.0)
+>>> stats.rank(['slow', 'new', 'fast'], 100 * 1000 * 1000)
+['fast', 'new', 'slow']
+
+"""
+
+import os
+from os import path
+import json
+import time
+import fcntl
+import tempfile
+import threading
+import logging
+
+from .leafcache import get_cache_dir
+
+
+log = logging.getLogger()
+
+ALPHA = 0.3
+DEFAULT_RATE = 10 * 1000 * 1000  # 10 MB/s
+DEFAULT_LATENCY = 0.05
+MAX_PENALTY = 6
+
+
+def ewma(old, sample, alpha=ALPHA):
+    """
+    Fold *sample* into the moving average *old*.
+
+    For example:
+
+    >>> ewma(None, 10.0)
+    10.0
+    >>> ewma(10.0, 20.0)
+    13.0
+
+    """
+    if old is None:
+        return float(sample)
+    return old + alpha * (sample - old)
+
+
+def new_entry():
+    return {
+        'rate': None,
+        'latency': None,
+        'downloads': 0,
+        'failures': 0,
+        'time': None,
+    }
+
+
+def read_peers(filename):
+    with open(filename, 'r') as fp:
+        peers = json.load(fp)
+    if not isinstance(peers, dict):
+        raise ValueError('bad peer stats: {!r}'.format(peers))
+    return dict(
+        (peer_id, dict(new_entry(), **entry))
+        for (peer_id, entry) in peers.items()
+        if isinstance(entry, dict)
+    )
+
+
+def is_newer(entry, other):
+    """
+    Return ``True`` if *entry* was updated more recently than *other*.
+    """
+    return (entry['time'] or 0) > (other['time'] or 0)
+
+
+class PeerStats:
+    __slots__ = ('filename', 'lock', 'peers')
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.peers = {}
+        if filename is not None and path.exists(filename):
+            try:
+                self.load()
+            except ValueError:
+                log.warning('Ignoring corrupt peer stats %r', filename)
+                self.peers = {}
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.filename)
+
+    @classmethod
+    def open_default(cls):
+        """
+        Open the peer stats at ~/.cache/dmedia/peer-stats.json.
+        """
+        return cls(path.join(get_cache_dir(), 'peer-stats.json'))
+
+    def load(self):
+        self.peers = read_peers(self.filename)
+
+    def merge(self):
+        """
+        Merge in the entries saved by other processes since we last saved.
+
+        Must be called with `PeerStats.lock` held, and with the file locked.
+        """
+        try:
+            saved = read_peers(self.filename)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            log.warning('Ignoring corrupt peer stats %r', self.filename)
+            return
+        for (peer_id, entry) in saved.items():
+            ours = self.peers.get(peer_id)
+            if ours is None or is_newer(entry, ours):
+                self.peers[peer_id] = entry
+
+    def save(self):
+        """
+        Atomically write the peer stats to disk, merged with those saved.
+
+        The merge and write are done under an exclusive ``flock()`` on a
+        separate lock file (as the stats file itself is replaced), and each
+        process writes its own temporary file.
+        """
+        if self.filename is None:
+            return
+        (dirname, basename) = path.split(self.filename)
+        with self.lock:
+            with open(self.filename + '.lock', 'a') as lock_fp:
+                fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+                self.merge()
+                (fd, tmp) = tempfile.mkstemp(
+                    prefix='.' + basename + '.', suffix='.tmp', dir=dirname
+                )
+                try:
+                    with open(fd, 'w') as fp:
+                        json.dump(self.peers, fp, sort_keys=True, indent=4)
+                    os.replace(tmp, self.filename)
+                except BaseException:
+                    os.unlink(tmp)
+                    raise
+
+    def get(self, peer_id):
+        with self.lock:
+            return dict(self.peers.get(peer_id) or new_entry())
+
+    def _entry(self, peer_id):
+        entry = self.peers.get(peer_id)
+        if entry is None:
+            entry = self.peers[peer_id] = new_entry()
+        entry['time'] = time.time()
+        return entry
+
+    def record_download(self, peer_id, size, delta):
+        """
+        Record that *size* bytes were downloaded from *peer_id* in *delta*
+        seconds.
+        """
+        if size <= 0 or delta <= 0:
+            return
+        with self.lock:
+            entry = self._entry(peer_id)
+            entry['rate'] = ewma(entry['rate'], size / delta)
+            entry['downloads'] += 1
+            entry['failures'] = 0
+
+    def record_latency(self, peer_id, delta):
+        with self.lock:
+            entry = self._entry(peer_id)
+            entry['latency'] = ewma(entry['latency'], delta)
+
+    def record_failure(self, peer_id):
+        with self.lock:
+            entry = self._entry(peer_id)
+            entry['failures'] += 1
+
+    def estimate(self, peer_id, size):
+        """
+        Return the estimated seconds to download *size* bytes from *peer_id*.
+
+        Each consecutive failure doubles the estimate (up to a point), so a
+        flaky peer falls to the back of the line until it succeeds again.
+
+        >>> stats = PeerStats()
+        >>> stats.estimate('new', 10 * 1000 * 1000)
+        1.05
+        >>> stats.record_failure('new')
+        >>> stats.estimate('new', 10 * 1000 * 1000)
+        2.1
+
+        """
+        with self.lock:
+            entry = self.peers.get(peer_id) or new_entry()
+            rate = entry['rate'] or DEFAULT_RATE
+            latency = entry['latency']
+            if latency is None:
+                latency = DEFAULT_LATENCY
+            penalty = 2 ** min(entry['failures'], MAX_PENALTY)
+        return (latency + size / rate) * penalty
+
+    def rank(self, peer_ids, size):
+        """
+        Return *peer_ids* sorted from fastest to slowest estimated download.
+        """
+        return sorted(peer_ids,
+            key=lambda peer_id: (self.estimate(peer_id, size), peer_id)
+        )
@@ -804,6 +804,14 @@ def check_store(doc):
     _check(doc, ['copies'], int,
         (_at_least, 0),
     )
+    if _exists(doc, ['io_budget']):
+        _check(doc, ['io_budget'], dict)
+        _check_if_exists(doc, ['io_budget', 'bytes_per_sec'], int,
+            (_at_least, 0),
+        )
+        _check_if_exists(doc, ['io_budget', 'iops'], int,
+            (_at_least, 0),
+        )
 
 
 #######################################################
@@ -23,14 +23,13 @@
 Helpers to perform background task but using the GLib mainloop for communication.
 """
 
-import multiprocessing
 import logging
 import time
 
 from gi.repository import GLib
 from microfiber import BulkConflict
 
-from dmedia.parallel import start_thread, start_process
+from dmedia.parallel import start_thread, start_process, create_queue
 from dmedia.core import snapshot_worker
 from dmedia.client import download_worker
 
@@ -43,8 +42,8 @@ class Snapshots:
         self.env = env
         self.dumpdir = dumpdir
         self.callback = callback
-        self.in_q = multiprocessing.Queue()
-        self.out_q = multiprocessing.Queue()
+        self.in_q = create_queue()
+        self.out_q = create_queue()
         self.in_flight = set()
         self.process = None
         self.thread = None
@@ -156,7 +155,7 @@ class Downloads:
     def __init__(self, env, ssl_config):
         self.env = env
         self.ssl_config = ssl_config
-        self.queue = multiprocessing.Queue()
+        self.queue = create_queue()
         self.process = None
 
     def download(self, file_id):
@@ -0,0 +1,441 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+A local SQLite shadow of the "file" design views, fed by the changes feed.
+
+The Vigilance, downgrade, and verify behaviors all make their decisions through
+CouchDB views in the "file" design (see `dmedia.views`).  Those views can be
+slow to rebuild after a burst of replication, and each page costs an HTTP
+round trip.
+
+A `ShadowIndex` tails the ``_changes`` feed and keeps the per-file state these
+views are built from (the file ID, bytes, atime, origin, and the per-store
+copies, mtime, verified, and pinned values).  It also materializes the rows
+that each view would emit, using Python versions of the view functions, so it
+can answer the same queries the views do.
+
+A `ShadowDatabase` wraps a `microfiber.Database` and answers queries for the
+views it knows about from a `ShadowIndex`, passing everything else through to
+CouchDB.  `dmedia.metastore.MetaStore` uses one when given a *shadow*, and the
+workers in `dmedia.core` do so when the ``DMEDIA_SHADOW_INDEX`` environment
+variable is set.
+"""
+
+import os
+from os import path
+import sqlite3
+import threading
+import logging
+
+from .leafcache import get_cache_dir
+
+
+log = logging.getLogger()
+
+NULL = float('-inf')  # A null key sorts before all numbers, as in CouchDB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    bytes INTEGER,
+    atime INTEGER,
+    origin TEXT
+);
+CREATE TABLE IF NOT EXISTS stored (
+    file_id TEXT,
+    store_id TEXT,
+    copies INTEGER,
+    mtime INTEGER,
+    verified INTEGER,
+    pinned INTEGER,
+    PRIMARY KEY (file_id, store_id)
+);
+CREATE TABLE IF NOT EXISTS rows (
+    view TEXT,
+    k1 TEXT,
+    k2 REAL,
+    id TEXT,
+    value
+);
+CREATE INDEX IF NOT EXISTS rows_key ON rows (view, k1, k2, id);
+CREATE INDEX IF NOT EXISTS rows_id ON rows (id);
+"""
+
+
+def isnumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def iszero(value):
+    """
+    Return ``True`` if *value* would be ``=== 0`` in JavaScript.
+
+    Python's ``==`` would also treat ``False`` as zero.
+    """
+    return isnumber(value) and value == 0
+
+
+def iter_stored(doc):
+    stored = doc.get('stored')
+    if isinstance(stored, dict):
+        for (key, value) in stored.items():
+            if isinstance(value, dict):
+                yield (key, value)
+            else:
+                yield (key, {})
+
+
+def get_durability(doc):
+    total = 0
+    for (key, value) in iter_stored(doc):
+        copies = value.get('copies')
+        if isnumber(copies) and copies > 0:
+            total += copies
+    return total
+
+
+# Python versions of the "file" design view functions; each yields the
+# ``(key, value)`` pairs the JavaScript function would emit:
+
+def map_stored(doc):
+    _bytes = doc.get('bytes')
+    _bytes = (_bytes if isnumber(_bytes) else 0)
+    for (key, value) in iter_stored(doc):
+        yield (key, _bytes)
+
+
+def map_nonzero(doc):
+    for (key, value) in iter_stored(doc):
+        if not iszero(value.get('copies')):
+            yield (key, None)
+
+
+def map_rank(doc):
+    if doc.get('origin') != 'user':
+        return
+    stored = doc.get('stored')
+    if not isinstance(stored, dict):
+        yield (0, None)
+        return
+    rank = min(3, len(stored)) + min(3, get_durability(doc))
+    yield (rank, None)
+
+
+def map_preempt(doc):
+    if doc.get('origin') != 'user':
+        return
+    if not isinstance(doc.get('stored'), dict):
+        return
+    if get_durability(doc) == 3:
+        yield (doc.get('atime'), None)
+
+
+def map_downgrade_by_mtime(doc):
+    for (key, value) in iter_stored(doc):
+        verified = value.get('verified')
+        if not isnumber(verified) and not iszero(value.get('copies')):
+            mtime = value.get('mtime')
+            yield ((mtime if isnumber(mtime) else None), key)
+
+
+def map_downgrade_by_verified(doc):
+    for (key, value) in iter_stored(doc):
+        if isnumber(value.get('verified')) and not iszero(value.get('copies')):
+            yield (value['verified'], key)
+
+
+def map_store_downgraded(doc):
+    for (key, value) in iter_stored(doc):
+        if not isnumber(value.get('verified')) and iszero(value.get('copies')):
+            yield (key, None)
+
+
+def map_store_mtime(doc):
+    for (key, value) in iter_stored(doc):
+        verified = value.get('verified')
+        if not isnumber(verified) and not iszero(value.get('copies')):
+            mtime = value.get('mtime')
+            yield ([key, (mtime if isnumber(mtime) else None)], None)
+
+
+def map_store_verified(doc):
+    for (key, value) in iter_stored(doc):
+        if isnumber(value.get('verified')):
+            yield ([key, value['verified']], None)
+
+
+def map_store_reclaimable(doc):
+    if doc.get('origin') != 'user':
+        return
+    atime = doc.get('atime')
+    atime = (atime if isnumber(atime) else None)
+    total = 0
+    for (key, value) in iter_stored(doc):
+        copies = value.get('copies')
+        total += max(0, copies) if isnumber(copies) else 0
+    if total >= 3:
+        for (key, value) in iter_stored(doc):
+            copies = value.get('copies')
+            copies = (copies if isnumber(copies) else 0)
+            if total - copies >= 3 and not value.get('pinned'):
+                yield ([key, atime], None)
+
+
+# Maps view name to (map function, key shape), where the key shape says which
+# of the k1 (store_id) and k2 (number) columns the view key is stored in:
+VIEWS = {
+    'stored': (map_stored, 'k1'),
+    'nonzero': (map_nonzero, 'k1'),
+    'rank': (map_rank, 'k2'),
+    'preempt': (map_preempt, 'k2'),
+    'downgrade-by-mtime': (map_downgrade_by_mtime, 'k2'),
+    'downgrade-by-verified': (map_downgrade_by_verified, 'k2'),
+    'store-downgraded': (map_store_downgraded, 'k1'),
+    'store-mtime': (map_store_mtime, 'k1k2'),
+    'store-verified': (map_store_verified, 'k1k2'),
+    'store-reclaimable': (map_store_reclaimable, 'k1k2'),
+}
+
+# Query options a ShadowIndex can answer; anything else goes to CouchDB:
+OPTIONS = frozenset([
+    'key', 'startkey', 'endkey', 'startkey_docid', 'limit', 'descending',
+    'include_docs', 'stale',
+])
+
+
+def encode_key(shape, key):
+    """
+    Encode a view *key* as a ``(k1, k2)`` tuple.
+
+    For example:
+
+    >>> encode_key('k1k2', ['MZZG2ZDSOQVSW2TEMVZG643F', None])
+    ('MZZG2ZDSOQVSW2TEMVZG643F', -inf)
+
+    """
+    if shape == 'k1':
+        return (key, NULL)
+    if shape == 'k2':
+        return ('', (NULL if key is None else key))
+    (k1, k2) = key
+    return (k1, (NULL if k2 is None else k2))
+
+
+def decode_key(shape, k1, k2):
+    if k2 == NULL:
+        k2 = None
+    elif isinstance(k2, float) and k2.is_integer():
+        k2 = int(k2)
+    if shape == 'k1':
+        return k1
+    if shape == 'k2':
+        return k2
+    return [k1, k2]
+
+
+class ShadowIndex:
+    """
+    The connection is shared by the threads of a worker (for example, the
+    lanes of `dmedia.parallel.Lanes`), so everything that uses it is done
+    under `ShadowIndex.lock`.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(filename, timeout=30,
+            check_same_thread=False
+        )
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.filename)
+
+    @classmethod
+    def open_default(cls, name='dmedia-1'):
+        """
+        Open the default index at ~/.cache/dmedia/shadow-<name>.sqlite3.
+        """
+        filename = 'shadow-{}.sqlite3'.format(name)
+        return cls(path.join(get_cache_dir(), filename))
+
+    @classmethod
+    def open_if_enabled(cls):
+        """
+        Open the default index if ``DMEDIA_SHADOW_INDEX`` is set.
+        """
+        if os.environ.get('DMEDIA_SHADOW_INDEX'):
+            return cls.open_default()
+
+    def get_last_seq(self):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE name = 'last_seq'"
+            ).fetchone()
+        return (0 if row is None else row[0])
+
+    def _remove(self, _id):
+        self.conn.execute('DELETE FROM files WHERE id = ?', (_id,))
+        self.conn.execute('DELETE FROM stored WHERE file_id = ?', (_id,))
+        self.conn.execute('DELETE FROM rows WHERE id = ?', (_id,))
+
+    def _add(self, doc):
+        _id = doc['_id']
+        self.conn.execute('INSERT INTO files VALUES (?, ?, ?, ?)',
+            (_id, doc.get('bytes'), doc.get('atime'), doc.get('origin'))
+        )
+        self.conn.executemany('INSERT INTO stored VALUES (?, ?, ?, ?, ?, ?)',
+            [
+                (_id, key, value.get('copies'), value.get('mtime'),
+                    value.get('verified'), int(bool(value.get('pinned'))))
+                for (key, value) in iter_stored(doc)
+            ]
+        )
+        rows = []
+        for (view, (func, shape)) in VIEWS.items():
+            for (key, value) in func(doc):
+                (k1, k2) = encode_key(shape, key)
+                rows.append((view, k1, k2, _id, value))
+        self.conn.executemany('INSERT INTO rows VALUES (?, ?, ?, ?, ?)', rows)
+
+    def update(self, doc):
+        """
+        Update the index for a single *doc* (without committing).
+        """
+        self._remove(doc['_id'])
+        if doc.get('type') == 'dmedia/file' and not doc.get('_deleted'):
+            self._add(doc)
+
+    def apply_changes(self, result):
+        """
+        Apply a ``_changes`` *result* in a single transaction.
+        """
+        with self.lock, self.conn:
+            for row in result['results']:
+                doc = row.get('doc')
+                if row.get('deleted') or doc is None:
+                    self._remove(row['id'])
+                else:
+                    self.update(doc)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('last_seq', ?)",
+                (result['last_seq'],)
+            )
+
+    def sync(self, db, limit=500):
+        """
+        Apply all the changes in *db* since the last sync.
+
+        Returns the number of changes applied.  Only one thread syncs at a
+        time, so the same changes aren't fetched and applied twice.
+        """
+        count = 0
+        with self.lock:
+            while True:
+                result = db.get('_changes',
+                    since=self.get_last_seq(),
+                    limit=limit,
+                    include_docs=True,
+                )
+                self.apply_changes(result)
+                count += len(result['results'])
+                if len(result['results']) < limit:
+                    return count
+
+    def query(self, view, key=None, startkey=None, endkey=None,
+            startkey_docid=None, limit=None, descending=False, **kw):
+        """
+        Return rows like those CouchDB returns for "file/*view*".
+
+        Unlike a CouchDB view, doc IDs are always collated in order of their
+        (ASCII) bytes, which is the same thing for dmedia file IDs.
+        """
+        (func, shape) = VIEWS[view]
+        if key is not None:
+            startkey = endkey = key
+        (lo, hi) = ('>=', '<=') if not descending else ('<=', '>=')
+        where = ['view = ?']
+        params = [view]
+        if startkey is not None:
+            (k1, k2) = encode_key(shape, startkey)
+            if startkey_docid is not None:
+                where.append('(k1, k2, id) {} (?, ?, ?)'.format(lo))
+                params.extend([k1, k2, startkey_docid])
+            else:
+                where.append('(k1, k2) {} (?, ?)'.format(lo))
+                params.extend([k1, k2])
+        if endkey is not None:
+            (k1, k2) = encode_key(shape, endkey)
+            where.append('(k1, k2) {} (?, ?)'.format(hi))
+            params.extend([k1, k2])
+        order = ('DESC' if descending else 'ASC')
+        sql = 'SELECT k1, k2, id, value FROM rows WHERE {} ORDER BY {}'.format(
+            ' AND '.join(where),
+            ', '.join('{} {}'.format(c, order) for c in ('k1', 'k2', 'id'))
+        )
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self.lock:
+            return [
+                {'key': decode_key(shape, k1, k2), 'id': _id, 'value': value}
+                for (k1, k2, _id, value) in self.conn.execute(sql, params)
+            ]
+
+
+class ShadowDatabase:
+    """
+    Answer "file" design view queries from a `ShadowIndex`.
+
+    Everything else is passed through to the wrapped `microfiber.Database`.
+    The index is synced with the changes feed before each query, unless the
+    query is done with ``stale='ok'``.  When *include_docs* is ``True``, the
+    docs are requested from CouchDB with a single `get_many()`.
+    """
+
+    def __init__(self, db, index):
+        self._db = db
+        self._index = index
+
+    def __repr__(self):
+        return repr(self._db)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def view(self, design, view, **kw):
+        if design != 'file' or view not in VIEWS or not OPTIONS.issuperset(kw):
+            return self._db.view(design, view, **kw)
+        if kw.pop('stale', None) != 'ok':
+            self._index.sync(self._db)
+        include_docs = kw.pop('include_docs', False)
+        rows = self._index.query(view, **kw)
+        if include_docs and rows:
+            docs = self._db.get_many([r['id'] for r in rows])
+            for (row, doc) in zip(rows, docs):
+                row['doc'] = doc
+        return {'rows': rows}
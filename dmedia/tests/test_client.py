@@ -25,13 +25,30 @@ Unit tests for `dmedia.client`.
 
 from unittest import TestCase
 import os
+import threading
 from collections import OrderedDict
 
-from filestore import ContentHash, TYPE_ERROR, DIGEST_BYTES
+from filestore import ContentHash, TYPE_ERROR, DIGEST_BYTES, LEAF_SIZE
+from filestore import Leaf, hash_leaf
 
+from .base import TempDir
+
+from dmedia.peerstats import PeerStats
 from dmedia import client
 
 
+class DummyClient:
+    def __init__(self, result):
+        self._result = result
+        self._calls = []
+
+    def has_file(self, _id):
+        self._calls.append(('has_file', _id))
+        if isinstance(self._result, Exception):
+            raise self._result
+        return self._result
+
+
 class TestFunctions(TestCase):
     def test_check_slice(self):
         ch = ContentHash('foo', None, (1, 2, 3))
@@ -111,6 +128,319 @@ class TestFunctions(TestCase):
             client.check_slice(ch, 2, 1)
         self.assertEqual(str(cm.exception), '[2:1] invalid slice for 3 leaves')
 
+    def test_probe_peers(self):
+        clients = {
+            'a': DummyClient(True),
+            'b': DummyClient(False),
+            'c': DummyClient(ValueError('nope')),
+            'd': DummyClient(True),
+        }
+        self.assertEqual(client.probe_peers(clients, 'foo'), {'a', 'd'})
+        for c in clients.values():
+            self.assertEqual(c._calls, [('has_file', 'foo')])
+        self.assertEqual(client.probe_peers({}, 'foo'), set())
+
+        # Latency and failures are recorded:
+        stats = PeerStats()
+        self.assertEqual(client.probe_peers(clients, 'bar', stats), {'a', 'd'})
+        for peer_id in ('a', 'b', 'd'):
+            entry = stats.get(peer_id)
+            self.assertGreaterEqual(entry['latency'], 0)
+            self.assertEqual(entry['failures'], 0)
+        entry = stats.get('c')
+        self.assertIsNone(entry['latency'])
+        self.assertEqual(entry['failures'], 1)
+
+    def test_rank_peers(self):
+        clients = {
+            'a': DummyClient(True),
+            'b': DummyClient(False),
+            'c': DummyClient(True),
+            'd': DummyClient(True),
+        }
+        self.assertEqual(client.rank_peers(clients, 'foo', 1000),
+            ['a', 'c', 'd']
+        )
+        stats = PeerStats()
+        stats.record_download('a', 10 ** 6, 10.0)
+        stats.record_download('d', 10 ** 9, 1.0)
+        self.assertEqual(client.rank_peers(clients, 'foo', 10 ** 9, stats),
+            ['d', 'c', 'a']
+        )
+
+    def test_download_from_peers(self):
+        class Dummy:
+            id = 'foo'
+
+            def __init__(self, good, banned=()):
+                self.good = good
+                self.banned = set(banned)
+                self.complete = False
+                self._calls = []
+
+            def download_from(self, client, stats, peer_id):
+                self._calls.append((client, stats, peer_id))
+                if client is not self.good:
+                    raise ValueError('nope')
+                self.complete = True
+
+            def download_from_swarm(self, peers, stats):
+                self._calls.append(('swarm', peers, stats))
+                return self.banned
+
+            def download_is_complete(self):
+                return self.complete
+
+        clients = {'a': 'client-a', 'b': 'client-b', 'c': 'client-c'}
+
+        # A single peer is tried directly:
+        stats = PeerStats()
+        dl = Dummy('client-b')
+        self.assertIs(
+            client.download_from_peers(dl, clients, ['b'], stats), True
+        )
+        self.assertEqual(dl._calls, [('client-b', stats, 'b')])
+        dl = Dummy(None)
+        self.assertIs(client.download_from_peers(dl, clients, ['c'], stats),
+            False
+        )
+        self.assertEqual(dl._calls, [('client-c', stats, 'c')])
+        self.assertEqual(stats.get('c')['failures'], 1)
+        self.assertEqual(stats.get('b')['failures'], 0)
+
+        # Several peers are swarmed, then whatever is left is retried in
+        # order, skipping banned peers:
+        dl = Dummy('client-b', banned=['c'])
+        self.assertIs(
+            client.download_from_peers(dl, clients, ['c', 'a', 'b'], stats),
+            True
+        )
+        self.assertEqual(dl._calls, [
+            ('swarm', [('c', 'client-c'), ('a', 'client-a'), ('b', 'client-b')], stats),
+            ('client-a', stats, 'a'),
+            ('client-b', stats, 'b'),
+        ])
+
+        dl = Dummy(None)
+        self.assertIs(
+            client.download_from_peers(dl, clients, ['a', 'b']), False
+        )
+        self.assertEqual(dl._calls, [
+            ('swarm', [('a', 'client-a'), ('b', 'client-b')], None),
+            ('client-a', None, 'a'),
+            ('client-b', None, 'b'),
+        ])
+        dl = Dummy(None)
+        self.assertIs(client.download_from_peers(dl, clients, []), False)
+        self.assertEqual(dl._calls, [])
+
+
+class DummyDownloader(client.Downloader):
+    def __init__(self, ch, tmp_fp):
+        self.id = ch.id
+        self.ch = ch
+        self.tmp_fp = tmp_fp
+        self.missing = OrderedDict(enumerate(ch.leaf_hashes))
+        self.finished = False
+
+    def finish_download(self):
+        self.finished = True
+
+
+class SwarmClient:
+    def __init__(self, leaves, corrupt=None, fail=False, short=False,
+            wait_for=(), flaky=0):
+        self.leaves = leaves
+        self.corrupt = corrupt
+        self.fail = fail
+        self.flaky = flaky
+        self.short = short
+        self.wait_for = wait_for
+        self.called = threading.Event()
+        self.closed = False
+        self._calls = []
+
+    def iter_leaves(self, ch, start, stop):
+        self._calls.append((start, stop))
+        self.called.set()
+        for other in self.wait_for:
+            other.called.wait(5)
+        if self.fail or len(self._calls) <= self.flaky:
+            raise ValueError('nope')
+        if self.short:
+            stop -= 1
+        for i in range(start, stop):
+            data = self.leaves[i]
+            if i == self.corrupt:
+                data = b'corrupt'
+            yield Leaf(i, data)
+
+    def close(self):
+        self.closed = True
+
+
+def build_swarm_file(count):
+    leaves = [os.urandom(16) for i in range(count)]
+    ch = ContentHash('foo', 16 * count,
+        tuple(hash_leaf(i, data) for (i, data) in enumerate(leaves))
+    )
+    return (leaves, ch)
+
+
+class TestSwarm(TestCase):
+    def test_claim(self):
+        (leaves, ch) = build_swarm_file(10)
+        dl = DummyDownloader(ch, None)
+        swarm = client.Swarm(dl, 4)
+        self.assertIsInstance(swarm.stats, PeerStats)
+        self.assertEqual(swarm.try_claim('a', 0), (0, 4))
+        self.assertEqual(swarm.try_claim('b', 0), (4, 8))
+        self.assertEqual(swarm.try_claim('a', 0), (8, 10))
+
+        # Everything is claimed, but nothing is overdue yet:
+        self.assertIsNone(swarm.try_claim('c', 0))
+        expected = swarm.stats.estimate('a', 4 * LEAF_SIZE)
+        self.assertEqual(swarm.claimed[0], {'a': expected})
+        self.assertEqual(swarm._next_deadline('c', 0),
+            swarm.stats.estimate('a', 2 * LEAF_SIZE)
+        )
+        self.assertEqual(swarm._next_deadline('a', 0), expected)
+
+        # Once overdue, ranges held by one other peer are duplicated:
+        self.assertEqual(swarm.try_claim('a', expected), (4, 8))
+        self.assertEqual(swarm.try_claim('c', expected), (0, 4))
+        self.assertEqual(swarm.try_claim('c', expected), (8, 10))
+        self.assertIsNone(swarm.try_claim('c', expected))
+        self.assertIsNone(swarm.try_claim('a', expected))
+        self.assertEqual(set(swarm.claimed[0]), {'a', 'c'})
+        self.assertIsNone(swarm._next_deadline('d', expected))
+
+        # Released ranges go back to the pool, and aren't split across gaps:
+        swarm.release('a', client.Slice(0, 4))
+        swarm.release('c', client.Slice(0, 4))
+        self.assertNotIn(0, swarm.claimed)
+        del dl.missing[2]
+        self.assertEqual(swarm.try_claim('b', 0), (0, 2))
+        self.assertEqual(swarm.try_claim('b', 0), (3, 4))
+
+        # Banned peers don't get anything:
+        swarm.ban('d')
+        self.assertIsNone(swarm.try_claim('d', 0))
+        self.assertIsNone(swarm.claim('d'))
+
+    def test_failed(self):
+        (leaves, ch) = build_swarm_file(8)
+        dl = DummyDownloader(ch, None)
+        swarm = client.Swarm(dl, 4)
+        swarm.enter('a')
+        swarm.enter('b')
+        self.assertEqual(swarm.try_claim('a', 0), (0, 4))
+        swarm.release('a', client.Slice(0, 4), failed=True)
+        self.assertEqual(swarm.failed[0], {'a'})
+        self.assertNotIn(0, swarm.claimed)
+
+        # The failed range is left for the other peer:
+        self.assertEqual(swarm.try_claim('a', 0), (4, 8))
+        self.assertIsNone(swarm.try_claim('a', 0))
+        self.assertEqual(swarm.try_claim('b', 0), (0, 4))
+        swarm.release('b', client.Slice(0, 4), failed=True)
+
+        # Every active peer has failed on it, so anyone can retry it:
+        self.assertEqual(swarm.try_claim('a', 0), (0, 4))
+        swarm.release('a', client.Slice(0, 4), failed=True)
+        swarm.release('b', client.Slice(0, 4), failed=True)
+        swarm.leave('b')
+        self.assertEqual(swarm.active, {'a'})
+        self.assertEqual(swarm.try_claim('a', 0), (0, 4))
+
+    def test_claim_waits(self):
+        (leaves, ch) = build_swarm_file(4)
+        tmp = TempDir()
+        tmp_fp = open(tmp.join('foo'), 'wb+')
+        dl = DummyDownloader(ch, tmp_fp)
+        swarm = client.Swarm(dl, 4)
+        self.assertEqual(swarm.claim('a'), (0, 4))
+        result = []
+        thread = threading.Thread(target=lambda: result.append(swarm.claim('b')))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        for (i, data) in enumerate(leaves):
+            self.assertIs(swarm.write(Leaf(i, data)), True)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(result, [None])
+
+    def test_write(self):
+        (leaves, ch) = build_swarm_file(3)
+        tmp = TempDir()
+        tmp_fp = open(tmp.join('foo'), 'wb+')
+        dl = DummyDownloader(ch, tmp_fp)
+        swarm = client.Swarm(dl)
+        self.assertEqual(swarm.claim('a'), (0, 3))
+        self.assertIs(swarm.write(Leaf(1, leaves[1])), True)
+        self.assertEqual(list(dl.missing), [0, 2])
+        self.assertNotIn(1, swarm.claimed)
+        self.assertIs(swarm.write(Leaf(1, leaves[1])), False)
+        tmp_fp.seek(LEAF_SIZE)
+        self.assertEqual(tmp_fp.read(), leaves[1])
+
+    def test_download_from_swarm(self):
+        (leaves, ch) = build_swarm_file(25)
+        tmp = TempDir()
+        tmp_fp = open(tmp.join('foo'), 'wb+')
+        dl = DummyDownloader(ch, tmp_fp)
+        stats = PeerStats()
+        corrupt = SwarmClient(leaves, corrupt=0)
+        broken = SwarmClient(leaves, fail=True)
+        short = SwarmClient(leaves, short=True)
+        bad = (corrupt, broken, short)
+        good1 = SwarmClient(leaves, wait_for=bad)
+        good2 = SwarmClient(leaves, wait_for=bad)
+        peers = [
+            ('corrupt', corrupt),
+            ('broken', broken),
+            ('short', short),
+            ('good1', good1),
+            ('good2', good2),
+        ]
+        self.assertEqual(dl.download_from_swarm(peers, stats, 2), {'corrupt'})
+        self.assertEqual(len(dl.missing), 0)
+        self.assertIs(dl.finished, True)
+        for (i, data) in enumerate(leaves):
+            tmp_fp.seek(i * LEAF_SIZE)
+            self.assertEqual(tmp_fp.read(16), data)
+
+        self.assertIs(corrupt.closed, True)
+        self.assertEqual(len(corrupt._calls), 1)
+        for bad in (broken, short):
+            self.assertGreaterEqual(len(bad._calls), 1)
+            self.assertLessEqual(len(bad._calls), client.SWARM_MAX_FAILURES)
+        self.assertGreater(len(good1._calls) + len(good2._calls), 0)
+        self.assertEqual(stats.get('corrupt')['failures'], 1)
+        self.assertEqual(stats.get('broken')['failures'], len(broken._calls))
+        self.assertEqual(stats.get('short')['failures'], len(short._calls))
+        self.assertEqual(stats.get('good1')['failures'], 0)
+
+        # A transient failure doesn't end the worker:
+        dl = DummyDownloader(ch, tmp_fp)
+        flaky = SwarmClient(leaves, flaky=2)
+        self.assertEqual(dl.download_from_swarm([('flaky', flaky)], stats, 5),
+            set()
+        )
+        self.assertEqual(len(dl.missing), 0)
+        self.assertIs(dl.finished, True)
+        self.assertEqual(flaky._calls[:3], [(0, 5), (0, 5), (0, 5)])
+        self.assertEqual(len(flaky._calls), 7)
+        self.assertEqual(stats.get('flaky')['failures'], 0)
+
+        # Nothing left to do, or no peers:
+        self.assertEqual(dl.download_from_swarm(peers), set())
+        dl = DummyDownloader(ch, tmp_fp)
+        self.assertEqual(dl.download_from_swarm([]), set())
+        self.assertEqual(len(dl.missing), 25)
+        self.assertIs(dl.finished, False)
+
 
 class TestDownloader(TestCase):
     def test_next_slice(self):
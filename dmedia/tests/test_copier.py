@@ -0,0 +1,225 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Unit tests for `dmedia.copier`.
+"""
+
+from unittest import TestCase
+import os
+from os import path
+import threading
+
+from filestore import CorruptFile, FileNotFound, LEAF_SIZE, DOTNAME
+from filestore.misc import TempFileStore
+
+from .base import TempDir, random_file_id
+
+from dmedia import copier, metrics
+
+
+class CountingBudget:
+    def __init__(self):
+        self.calls = []
+
+    def consume(self, nbytes=0, ops=1):
+        self.calls.append((nbytes, ops))
+        return 0
+
+
+class BrokenBudget:
+    def consume(self, nbytes=0, ops=1):
+        raise ValueError('nope')
+
+
+def list_tmp(fs):
+    return os.listdir(path.join(fs.parentdir, DOTNAME, 'tmp'))
+
+
+class TestFunctions(TestCase):
+    def test_fadvise(self):
+        tmp = TempDir()
+        fp = open(tmp.join('foo'), 'wb')
+        self.assertIsNone(
+            copier.fadvise(fp.fileno(), 0, 0, copier.POSIX_FADV_SEQUENTIAL)
+        )
+        fp.close()
+        # Errors are ignored:
+        self.assertIsNone(
+            copier.fadvise(fp.fileno(), 0, 0, copier.POSIX_FADV_DONTNEED)
+        )
+
+    def test_fallocate(self):
+        tmp = TempDir()
+        fp = open(tmp.join('foo'), 'wb')
+        if copier.fallocate(fp.fileno(), 12345) is True:
+            self.assertEqual(os.fstat(fp.fileno()).st_size, 12345)
+        fp.close()
+        self.assertIs(copier.fallocate(fp.fileno(), 12345), False)
+
+    def test_copy_file(self):
+        tmp = TempDir()
+        fs1 = TempFileStore()
+        fs2 = TempFileStore()
+        fs3 = TempFileStore()
+
+        # Source file doesn't exist:
+        _id = random_file_id()
+        with self.assertRaises(FileNotFound) as cm:
+            copier.copy_file(fs1, _id, [fs2, fs3])
+        self.assertEqual(cm.exception.id, _id)
+        self.assertEqual(list_tmp(fs2), [])
+        self.assertEqual(list_tmp(fs3), [])
+
+        # Two destinations:
+        (file, ch) = tmp.random_file(LEAF_SIZE * 2 + 1)
+        self.assertEqual(fs1.import_file(open(file.name, 'rb')), ch)
+        budgets = {
+            fs1.id: CountingBudget(),
+            fs2.id: CountingBudget(),
+            fs3.id: CountingBudget(),
+        }
+        stats = copier.CopyStats()
+        self.assertEqual(
+            copier.copy_file(fs1, ch.id, [fs2, fs3],
+                lambda fs: budgets[fs.id], stats
+            ),
+            ch
+        )
+        self.assertEqual(fs1.verify(ch.id), ch)
+        self.assertEqual(fs2.verify(ch.id), ch)
+        self.assertEqual(fs3.verify(ch.id), ch)
+        self.assertEqual(list_tmp(fs2), [])
+        self.assertEqual(list_tmp(fs3), [])
+        leaves = len(ch.leaf_hashes) // 30
+        for fs in (fs1, fs2, fs3):
+            calls = budgets[fs.id].calls
+            self.assertEqual(sum(c[0] for c in calls), ch.file_size)
+            self.assertGreaterEqual(len(calls), leaves)
+        self.assertEqual(stats.count, 1)
+        self.assertEqual(stats.size, ch.file_size)
+        self.assertGreater(stats.elapsed, 0)
+
+        # No destinations is just a verify:
+        self.assertEqual(copier.copy_file(fs1, ch.id, []), ch)
+
+        # Source file is corrupt:
+        fs2.remove(ch.id)
+        filename = fs1.path(ch.id)
+        os.chmod(filename, 0o600)
+        open(filename, 'ab').write(os.urandom(16))
+        os.chmod(filename, 0o444)
+        with self.assertRaises(CorruptFile) as cm:
+            copier.copy_file(fs1, ch.id, [fs2], stats=stats)
+        self.assertEqual(cm.exception.id, ch.id)
+        self.assertFalse(path.exists(filename))
+        self.assertFalse(path.exists(fs2.path(ch.id)))
+        self.assertEqual(list_tmp(fs2), [])
+        self.assertEqual(stats.count, 1)
+
+
+class TestCopyStats(TestCase):
+    def test_add(self):
+        stats = copier.CopyStats()
+        self.assertEqual(stats.count, 0)
+        self.assertEqual(stats.rate(), '0 bytes/s')
+        stats.add(2000000, 0.5, 1.0, 0.25, 2.0)
+        stats.add(2000000, 0.5, 1.0, 0.25, 2.0)
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.size, 4000000)
+        self.assertEqual(stats.fsync, 0.5)
+        self.assertEqual(stats.rate(), '1 MB/s')
+        self.assertEqual(stats.rate(stats.read), '4 MB/s')
+        self.assertEqual(stats.rate(stats.write), '2 MB/s')
+
+    def test_log(self):
+        stats = copier.CopyStats()
+        stats.add(2000000, 0.5, 1.0, 0.25, 2.0)
+        stats.log()
+        self.assertEqual(stats.count, 1)
+        stats.log(reset=True)
+        self.assertEqual(stats.count, 0)
+        self.assertEqual(stats.size, 0)
+        self.assertEqual(stats.elapsed, 0.0)
+
+    def test_metrics(self):
+        metrics.registry.reset()
+        stats = copier.CopyStats()
+        stats.add(2000000, 0.5, 1.0, 0.25, 2.0)
+        stats.add(1000000, 0.5, 1.0, 0.25, 1.0)
+        snapshot = metrics.registry.snapshot()
+        self.assertEqual(snapshot['counters'], {
+            'copy.count': 2,
+            'copy.bytes': 3000000,
+        })
+        self.assertEqual(snapshot['gauges'], {'copy.bytes_per_sec': 1000000})
+        self.assertEqual(sorted(snapshot['histograms']),
+            ['copy.fsync.seconds', 'copy.seconds']
+        )
+        self.assertEqual(snapshot['histograms']['copy.seconds']['count'], 2)
+        metrics.registry.reset()
+
+    def test_threads(self):
+        stats = copier.CopyStats()
+
+        def worker():
+            for i in range(1000):
+                stats.add(1, 0, 0, 0, 0)
+
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(stats.count, 4000)
+        self.assertEqual(stats.size, 4000)
+
+
+class TestWriter(TestCase):
+    def test_write(self):
+        tmp = TempDir()
+        filename = tmp.join('foo')
+        budget = CountingBudget()
+        writer = copier.Writer(open(filename, 'xb'), 3000, budget)
+        writer.put(b'a' * 1000)
+        writer.put(b'b' * 2000)
+        writer.finish()
+        self.assertIsNone(writer.error)
+        self.assertEqual(open(filename, 'rb').read(), b'a' * 1000 + b'b' * 2000)
+        self.assertEqual(budget.calls, [(1000, 1), (2000, 1)])
+        self.assertGreaterEqual(writer.busy, 0)
+
+        # An error is raised in finish(), after draining the queue:
+        writer = copier.Writer(open(tmp.join('bar'), 'xb'), 50, BrokenBudget())
+        for i in range(5):
+            writer.put(b'c' * 10)
+        with self.assertRaises(ValueError) as cm:
+            writer.finish()
+        self.assertEqual(str(cm.exception), 'nope')
+        self.assertEqual(open(tmp.join('bar'), 'rb').read(10), b'c' * 10)
+
+    def test_abort(self):
+        tmp = TempDir()
+        filename = tmp.join('foo')
+        writer = copier.Writer(open(filename, 'xb'), 10)
+        writer.put(b'd' * 10)
+        writer.abort()
+        self.assertFalse(path.exists(filename))
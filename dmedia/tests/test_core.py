@@ -32,6 +32,8 @@ from base64 import b64encode
 import queue
 import multiprocessing
 import threading
+from copy import deepcopy
+from contextlib import nullcontext
 
 import microfiber
 from dbase32 import random_id
@@ -40,17 +42,37 @@ from filestore import FileStore
 from filestore.misc import TempFileStore
 from usercouch.misc import CouchTestCase
 
-from dmedia.local import LocalStores
+from dmedia.local import LocalStores, get_drive_id
 from dmedia import metastore
 from dmedia.metastore import MetaStore, get_mtime
 from dmedia.schema import project_db_name
-from dmedia.parallel import start_process
-from dmedia import util, core
+from dmedia.parallel import start_process, create_pipe
+from dmedia.peerstats import PeerStats
+from dmedia.copier import CopyStats
+from dmedia import util, core, metrics, parallel, iobudget
 
 from .couch import CouchCase
 from .base import TempDir, write_random
 
 
+def use_runtime_dir(case, dirname):
+    """
+    Point ``$XDG_RUNTIME_DIR`` at *dirname* until *case* is cleaned up.
+
+    So the drive leases taken by a test don't touch the real runtime dir.
+    """
+    saved = os.environ.get('XDG_RUNTIME_DIR')
+    os.environ['XDG_RUNTIME_DIR'] = dirname
+
+    def restore():
+        if saved is None:
+            del os.environ['XDG_RUNTIME_DIR']
+        else:
+            os.environ['XDG_RUNTIME_DIR'] = saved
+
+    case.addCleanup(restore)
+
+
 class TestFunctions(TestCase):
     def test_has_thumbnail(self):
         self.assertIs(core.has_thumbnail({}), False)
@@ -61,6 +83,98 @@ class TestFunctions(TestCase):
         doc = {'_attachments': {'thumbnail': 'yup'}}
         self.assertIs(core.has_thumbnail(doc), True)
 
+    def test_iter_plan_windows(self):
+        store_id = random_id()
+        docs = [{'stored': {}} for i in range(5)]
+        docs.extend(
+            {'stored': {store_id: {'copies': 0}}} for i in range(3)
+        )
+        windows = list(core.iter_plan_windows(docs, 2))
+        self.assertEqual([(r, len(w)) for (r, w) in windows],
+            [(0, 2), (0, 2), (0, 1), (1, 2), (1, 1)]
+        )
+        self.assertEqual(sum((w for (r, w) in windows), []), docs)
+        self.assertEqual(list(core.iter_plan_windows([])), [])
+
+    def test_get_cost(self):
+        store_ids = tuple(random_id() for i in range(3))
+        self.assertEqual(core.get_cost(('verify', store_ids[0], ())), 1)
+        self.assertEqual(core.get_cost(('copy', store_ids[0], store_ids[1:])), 3)
+        self.assertEqual(
+            core.get_cost(('download', ('peer',), store_ids[:1])), 2
+        )
+
+    def test_scan_relink_stores(self):
+        class Store:
+            def __init__(self, _id, parentdir):
+                self.id = _id
+                self.parentdir = parentdir
+
+        class Mocked:
+            def __init__(self, fail):
+                self.fail = fail
+                self.lock = threading.Lock()
+                self.calls = []
+                self.active = set()
+                self.overlaps = 0
+
+            def scan(self, fs):
+                with self.lock:
+                    self.calls.append(('scan', fs.id))
+                    if self.active:
+                        self.overlaps += 1
+                    self.active.add(fs.id)
+                    self.leased = iobudget.is_leased(
+                        core.get_drive_id(fs.parentdir)
+                    )
+                time.sleep(0.05)
+                with self.lock:
+                    self.active.remove(fs.id)
+                if fs.id == self.fail:
+                    raise ValueError(fs.id)
+
+            def relink(self, fs, manifest):
+                self.calls.append(('relink', fs.id))
+
+        tmp = TempDir()
+        use_runtime_dir(self, tmp.dir)
+        stores = [Store(_id, tmp.dir) for _id in ('A', 'B', 'C', 'D')]
+
+        # All on the same drive, so one at a time, in order:
+        ms = Mocked('B')
+        self.assertIsNone(core.scan_relink_stores(ms, stores))
+        # The drive is leased during the scan, then released:
+        self.assertIs(ms.leased, True)
+        self.assertIs(iobudget.is_leased(get_drive_id(tmp.dir)), False)
+        self.assertEqual(ms.calls, [
+            ('scan', 'A'), ('relink', 'A'),
+            ('scan', 'B'),
+            ('scan', 'C'), ('relink', 'C'),
+            ('scan', 'D'), ('relink', 'D'),
+        ])
+        self.assertEqual(ms.overlaps, 0)
+
+        # Each on its own drive, so in parallel:
+        drives = {'A': 'sda', 'B': 'sdb', 'C': 'sdc', 'D': 'sda'}
+        for fs in stores:
+            fs.parentdir = tmp.join(fs.id)
+        saved = core.get_drive_id
+        core.get_drive_id = lambda parentdir: drives[path.basename(parentdir)]
+        try:
+            ms = Mocked('B')
+            self.assertIsNone(core.scan_relink_stores(ms, stores))
+        finally:
+            core.get_drive_id = saved
+        self.assertEqual(sorted(ms.calls), [
+            ('relink', 'A'), ('relink', 'C'), ('relink', 'D'),
+            ('scan', 'A'), ('scan', 'B'), ('scan', 'C'), ('scan', 'D'),
+        ])
+        self.assertGreater(ms.overlaps, 0)
+        # A and D share a drive, so A is done before D starts:
+        self.assertLess(ms.calls.index(('relink', 'A')),
+            ms.calls.index(('scan', 'D'))
+        )
+
     def test_encode_attachment(self):
         data = os.urandom(1776)
         self.assertEqual(
@@ -181,53 +295,557 @@ class MockDB:
 
 
 class MockMetaStore:
-    def __init__(self, db, docs):
+    def __init__(self, db, pages):
         self.db = db
-        self._docs = docs
+        self._pages = pages
         self._calls = []
+        self.copy_stats = CopyStats()
+
+    def iter_rank_pages(self, rank, start_id=None):
+        self._calls.append((rank, start_id))
+        for (last_id, docs) in self._pages.get(rank, []):
+            if start_id is None or last_id > start_id:
+                yield (last_id, docs)
+
+    def recheck_ranks(self, docs, rank=None):
+        return list(docs)
+
+
+class CheckpointNotFound(microfiber.NotFound):
+    def __init__(self):
+        pass
 
-    def iter_fragile_files(self, stop):
-        self._calls.append(stop)
-        for doc in self._docs:
-            yield doc
+
+class MockCheckpointDB:
+    def __init__(self, doc=None):
+        self._doc = doc
+        self._saved = []
+
+    def get(self, _id):
+        assert _id == core.CHECKPOINT_ID
+        if self._doc is None:
+            raise CheckpointNotFound()
+        return deepcopy(self._doc)
+
+    def save(self, doc):
+        self._saved.append(deepcopy(doc))
+        doc['_rev'] = '0-{}'.format(len(self._saved))
+        self._doc = deepcopy(doc)
+
+
+class DummyFileStore:
+    def __init__(self, _id):
+        self.id = _id
+
+
+class MockStores:
+    def __init__(self, ids):
+        self.ids = ids
+        self.avail = set(ids)
+
+    def by_id(self, _id):
+        return self.ids[_id]
+
+    def choose_local_store(self, doc):
+        return self.ids[sorted(doc['stored'])[0]]
+
+    def filter_by_avail(self, free, size, copies, threshold):
+        ids = sorted(set(free).intersection(self.avail))
+        return [self.ids[_id] for _id in ids[:copies]]
+
+    def find_dst_store(self, size, threshold):
+        if self.avail:
+            return self.ids[sorted(self.avail)[0]]
+
+
+class MockedPlanner(core.Vigilance):
+    def __init__(self, drives, remote):
+        self.stores = MockStores(
+            dict((_id, DummyFileStore(_id)) for _id in drives)
+        )
+        self.drives = drives
+        self.local = frozenset(drives)
+        self.remote = frozenset(remote)
+        self.store_to_peer = remote
+        self._leases = []
+
+    def lease(self, *filestores):
+        self._leases.append(sorted(self.drives[fs.id] for fs in filestores))
+        return nullcontext()
+
+
+class TestCheckpoint(TestCase):
+    def test_load_and_update(self):
+        context = {'stores': [random_id()], 'peers': []}
+        db = MockCheckpointDB()
+        cp = core.Checkpoint(db, context)
+        self.assertIs(cp.db, db)
+        self.assertIs(cp.context, context)
+        self.assertIsNone(cp.saved)
+        self.assertEqual(cp.doc['_id'], core.CHECKPOINT_ID)
+        self.assertEqual(cp.doc['stop'], 2)
+        self.assertIsNone(cp.doc['last_seq'])
+
+        # No saved checkpoint:
+        self.assertIs(cp.load(), False)
+        cp.update(stop=4, rank=1, last_id='foo')
+        self.assertEqual(len(db._saved), 1)
+        self.assertIsNotNone(cp.saved)
+
+        # Unforced updates are only saved every CHECKPOINT_INTERVAL:
+        cp.update(force=False, last_seq=17)
+        self.assertEqual(len(db._saved), 1)
+        self.assertEqual(cp.doc['last_seq'], 17)
+        cp.saved -= core.CHECKPOINT_INTERVAL
+        cp.update(force=False, last_seq=18)
+        self.assertEqual(len(db._saved), 2)
+
+        # Resume:
+        cp2 = core.Checkpoint(db, context)
+        self.assertIs(cp2.load(), True)
+        self.assertEqual(cp2.doc, db._doc)
+        self.assertEqual(cp2.doc['last_id'], 'foo')
+        self.assertEqual(cp2.doc['last_seq'], 18)
+
+        # Too old, or the stores changed:
+        now = db._doc['time'] + core.CHECKPOINT_MAX_AGE
+        cp3 = core.Checkpoint(db, context)
+        self.assertIs(cp3.load(now), False)
+        self.assertEqual(cp3.doc['_rev'], db._doc['_rev'])
+        self.assertEqual(cp3.doc['time'], now)
+        self.assertEqual(cp3.doc['stop'], 2)
+        self.assertIsNone(cp3.doc['last_seq'])
+        cp4 = core.Checkpoint(db, {'stores': [], 'peers': []})
+        self.assertIs(cp4.load(), False)
 
 
 class TestVigilanceMocked(TestCase):
+    def test_run(self):
+        class Mocked(core.Vigilance):
+            def __init__(self, db):
+                self.checkpoint = core.Checkpoint(db,
+                    {'stores': [], 'peers': []}
+                )
+                self._calls = []
+
+            def log_stats(self):
+                self._calls.append('log_stats')
+
+            def process_backlog(self, stop, start_rank=0, start_id=None):
+                self._calls.append((stop, start_rank, start_id))
+                return stop * 10
+
+            def process_preempt(self):
+                self._calls.append('process_preempt')
+
+            def run_event_loop(self, last_seq):
+                self._calls.append(('run_event_loop', last_seq))
+
+        # Fresh start:
+        db = MockCheckpointDB()
+        mocked = Mocked(db)
+        self.assertIsNone(mocked.run())
+        self.assertEqual(mocked._calls, [
+            'log_stats',
+            (2, 0, None),
+            (4, 0, None),
+            (6, 0, None),
+            'log_stats',
+            'process_preempt',
+            'log_stats',
+            ('run_event_loop', 60),
+        ])
+        self.assertEqual(db._doc['last_seq'], 60)
+
+        # Resume in the event loop:
+        mocked = Mocked(db)
+        self.assertIsNone(mocked.run())
+        self.assertEqual(mocked._calls, [('run_event_loop', 60)])
+
+        # Resume part way through the backlog:
+        db._doc.update(stop=4, rank=3, last_id='foo', last_seq=None)
+        mocked = Mocked(db)
+        self.assertIsNone(mocked.run())
+        self.assertEqual(mocked._calls, [
+            (4, 3, 'foo'),
+            (6, 0, None),
+            'log_stats',
+            'process_preempt',
+            'log_stats',
+            ('run_event_loop', 60),
+        ])
+
     def test_process_backlog(self):
         class Mocked(core.Vigilance):
             def __init__(self, ms):
                 self.ms = ms
+                self.lanes = None
+                self.checkpoint = core.Checkpoint(MockCheckpointDB(),
+                    {'stores': [], 'peers': []}
+                )
                 self._calls = []
 
             def update_remote(self):
                 self._calls.append('update_remote')
 
-            def wrap_up_rank(self, doc, threshold):
+            def plan_action(self, doc, threshold):
+                return ('download', (), ())
+
+            def run_action(self, key, doc, threshold):
+                assert key == ('download', (), ())
                 self._calls.append((doc, threshold))
 
-        docs = tuple(random_id() for i in range(10))
-        ms = MockMetaStore(MockDB(17), docs)
+        docs = tuple({'_id': random_id(), 'stored': {}} for i in range(10))
+        pages = {0: [('a', docs[:6]), ('b', docs[6:])]}
+        ms = MockMetaStore(MockDB(17), pages)
         mocked = Mocked(ms)
         self.assertEqual(mocked.process_backlog(4), 17)
         self.assertEqual(ms.db._calls, 1)
-        self.assertEqual(ms._calls, [4])
+        self.assertEqual(ms._calls, [(0, None), (1, None), (2, None), (3, None)])
         self.assertEqual(mocked._calls,
             ['update_remote'] + [
                 (doc, metastore.MIN_BYTES_FREE) for doc in docs
             ]
         )
+        saved = mocked.checkpoint.db._saved
+        self.assertEqual(
+            [(d['stop'], d['rank'], d['last_id']) for d in saved],
+            [(4, 0, 'b'), (4, 1, None), (4, 2, None), (4, 3, None)]
+        )
 
-        docs = tuple(random_id() for i in range(36))
-        ms = MockMetaStore(MockDB(18), docs)
+        # Resume part way through rank 1:
+        docs = tuple({'_id': random_id(), 'stored': {}} for i in range(36))
+        pages = {
+            0: [('a', docs[:10])],
+            1: [('b', docs[10:20]), ('c', docs[20:30])],
+            4: [('d', docs[30:])],
+        }
+        ms = MockMetaStore(MockDB(18), pages)
         mocked = Mocked(ms)
-        self.assertEqual(mocked.process_backlog(6), 18)
+        self.assertEqual(mocked.process_backlog(6, 1, 'b'), 18)
         self.assertEqual(ms.db._calls, 1)
-        self.assertEqual(ms._calls, [6])
+        self.assertEqual(ms._calls,
+            [(1, 'b'), (2, None), (3, None), (4, None), (5, None)]
+        )
         self.assertEqual(mocked._calls,
             ['update_remote'] + [
-                (doc, metastore.MIN_BYTES_FREE) for doc in docs
+                (doc, metastore.MIN_BYTES_FREE) for doc in docs[20:]
             ]
         )
+        saved = mocked.checkpoint.db._saved
+        self.assertEqual(
+            [(d['rank'], d['last_id']) for d in saved],
+            [(1, 'c'), (2, None), (3, None), (4, 'd'), (5, None)]
+        )
+
+    def test_iter_backlog(self):
+        class Mocked(core.Vigilance):
+            def __init__(self, ms):
+                self.ms = ms
+
+        docs = tuple({'_id': random_id(), 'stored': {}} for i in range(5))
+        pages = {
+            0: [('a', docs[:2]), ('b', docs[2:3]), ('c', docs[3:])],
+        }
+        mocked = Mocked(MockMetaStore(None, pages))
+        self.assertEqual(list(mocked.iter_backlog(2)), [
+            (0, 'c', list(docs)),
+            (1, None, []),
+        ])
+        self.assertEqual(list(mocked.iter_backlog(1, 0, 'a')), [
+            (0, 'c', list(docs[2:])),
+        ])
+        self.assertEqual(list(mocked.iter_backlog(1, 0, 'c')), [
+            (0, 'c', []),
+        ])
+
+    def test_dispatch(self):
+        class Mocked(core.Vigilance):
+            def __init__(self, lanes):
+                self.lock = threading.Lock()
+                self.inflight = set()
+                self.lanes = lanes
+                self._calls = []
+
+            def plan_action(self, doc, threshold):
+                return doc['key']
+
+            def get_action_lanes(self, key):
+                return key[1]
+
+            def wrap_up_rank(self, doc, threshold):
+                assert doc['_id'] in self.inflight
+                self._calls.append((doc['_id'], threshold))
+
+            def run_action(self, key, doc, threshold):
+                assert key == doc['key']
+                assert doc['_id'] in self.inflight
+                if doc.pop('requeue', False):
+                    return self.requeue(doc, threshold)
+                self._calls.append((doc['_id'], threshold))
+
+        # Without lanes, wrap_up_rank() is called right away:
+        mocked = Mocked(None)
+        mocked.inflight.add('foo')
+        self.assertIsNone(mocked.dispatch({'_id': 'foo'}, 17))
+        self.assertEqual(mocked._calls, [('foo', 17)])
+        self.assertIsNone(mocked.join_lanes())
+
+        # With lanes:
+        lanes = parallel.Lanes(2)
+        mocked = Mocked(lanes)
+        docs = [
+            {'_id': random_id(), 'key': ('copy', {'sda', ('peer', 'foo')})},
+            {'_id': random_id(), 'key': ('copy', {'sdb'})},
+            {'_id': random_id(), 'key': ('copy', set())},
+        ]
+        for doc in docs:
+            self.assertIsNone(mocked.dispatch(doc, 19))
+        mocked.join_lanes()
+        lanes.close()
+        self.assertEqual(
+            sorted(mocked._calls), sorted((d['_id'], 19) for d in docs)
+        )
+        self.assertEqual(mocked.inflight, set())
+
+        # Docs already inflight are skipped, as are those with no action:
+        lanes = parallel.Lanes(1)
+        mocked = Mocked(lanes)
+        mocked.inflight.add(docs[0]['_id'])
+        nothing = {'_id': random_id(), 'key': None}
+        for doc in docs + [nothing]:
+            mocked.dispatch(doc, 23)
+        mocked.join_lanes()
+        lanes.close()
+        self.assertEqual(mocked._calls, [(d['_id'], 23) for d in docs[1:]])
+        self.assertEqual(mocked.inflight, {docs[0]['_id']})
+
+        # An action that no longer fits is re-queued, and stays inflight till
+        # the new action has run, even when the lanes are backed up:
+        lanes = parallel.Lanes(1, maxpending=1)
+        mocked = Mocked(lanes)
+        for doc in docs:
+            doc['requeue'] = True
+            mocked.dispatch(doc, 29)
+        mocked.join_lanes()
+        lanes.close()
+        self.assertEqual(mocked._calls, [(d['_id'], 29) for d in docs])
+        self.assertEqual(mocked.inflight, set())
+
+    def test_get_action_lanes(self):
+        class Mocked(MockedPlanner):
+            def get_lanes(self, doc, threshold):
+                key = self.plan_action(doc, threshold)
+                if key is None:
+                    return set()
+                return self.get_action_lanes(key)
+
+        (s1, s2, s3) = sorted(random_id() for i in range(3))
+        (r1, r2) = (random_id(), random_id())
+        mocked = Mocked({s1: 'sda', s2: 'sdb', s3: 'sdb'},
+            {r1: 'peer1', r2: 'peer2'}
+        )
+
+        # Verify the downgraded copy:
+        doc = {'stored': {s1: {'copies': 0}, s2: {'copies': 1}}, 'bytes': 1}
+        self.assertEqual(mocked.get_lanes(doc, 17), {'sda'})
+
+        # Copy from s1 to s2 (which is on the same drive as s3):
+        doc = {'stored': {s1: {'copies': 1}}, 'bytes': 1}
+        self.assertEqual(mocked.get_lanes(doc, 17), {'sda', 'sdb'})
+
+        # No local store with enough space:
+        mocked.stores.avail = set()
+        self.assertEqual(mocked.get_lanes(doc, 17), set())
+
+        # Download:
+        doc = {'stored': {r1: {'copies': 1}, r2: {'copies': 1}}, 'bytes': 1}
+        self.assertEqual(mocked.get_lanes(doc, 17), set())
+        mocked.stores.avail = {s3}
+        self.assertEqual(mocked.get_lanes(doc, 17),
+            {'sdb', ('peer', 'peer1'), ('peer', 'peer2')}
+        )
+
+        # Nothing to do:
+        doc = {'stored': {s1: {'copies': 1}, s2: {'copies': 1}, s3: {'copies': 1}}}
+        self.assertEqual(mocked.get_lanes(doc, 17), set())
+
+    def test_plan_action(self):
+        (s1, s2, s3) = sorted(random_id() for i in range(3))
+        (r1, r2) = (random_id(), random_id())
+        mocked = MockedPlanner({s1: 'sda', s2: 'sdb', s3: 'sdb'},
+            {r1: 'peer1', r2: 'peer2'}
+        )
+        doc = {'stored': {s2: {'copies': 0}, s1: {'copies': 0}}, 'bytes': 1}
+        self.assertEqual(mocked.plan_action(doc, 17), ('verify', s1, ()))
+        doc = {'stored': {s1: {'copies': 1}}, 'bytes': 1}
+        self.assertEqual(mocked.plan_action(doc, 17), ('copy', s1, (s2,)))
+        doc = {'stored': {r2: {'copies': 1}, r1: {'copies': 1}}, 'bytes': 1}
+        self.assertEqual(mocked.plan_action(doc, 17),
+            ('download', ('peer1', 'peer2'), (s1,))
+        )
+        mocked.stores.avail = set()
+        self.assertIsNone(mocked.plan_action(doc, 17))
+        doc = {'stored': {s1: {'copies': 1}}, 'bytes': 1}
+        self.assertIsNone(mocked.plan_action(doc, 17))
+
+    def test_action_fits(self):
+        (s1, s2, s3) = sorted(random_id() for i in range(3))
+        (r1, r2) = (random_id(), random_id())
+        mocked = MockedPlanner({s1: 'sda', s2: 'sdb', s3: 'sdc'},
+            {r1: 'peer1', r2: 'peer2'}
+        )
+
+        # Verify:
+        doc = {'stored': {s1: {'copies': 0}, s2: {'copies': 1}}, 'bytes': 1}
+        self.assertIs(mocked.action_fits(('verify', s1, ()), doc, 17), True)
+        self.assertIs(mocked.action_fits(('verify', s2, ()), doc, 17), False)
+
+        # Copy, only to the planned destination:
+        doc = {'stored': {s1: {'copies': 1}}, 'bytes': 1}
+        key = ('copy', s1, (s2,))
+        self.assertEqual(mocked.plan_action(doc, 17), key)
+        self.assertIs(mocked.action_fits(key, doc, 17), True)
+        mocked.stores.avail = {s1, s3}
+        self.assertIs(mocked.action_fits(key, doc, 17), False)
+        self.assertEqual(mocked.plan_action(doc, 17), ('copy', s1, (s3,)))
+        mocked.stores.avail = {s1, s2, s3}
+        doc['stored'][s2] = {'copies': 1}
+        self.assertIs(mocked.action_fits(key, doc, 17), False)
+        doc = {'stored': {s1: {'copies': 0}}, 'bytes': 1}
+        self.assertIs(mocked.action_fits(key, doc, 17), False)
+
+        # Download, only to the planned destination and from planned peers:
+        doc = {'stored': {r1: {'copies': 1}}, 'bytes': 1}
+        key = ('download', ('peer1', 'peer2'), (s1,))
+        self.assertIs(mocked.action_fits(key, doc, 17), True)
+        mocked.stores.avail = {s2}
+        self.assertIs(mocked.action_fits(key, doc, 17), False)
+        mocked.stores.avail = {s1, s2, s3}
+        self.assertIs(
+            mocked.action_fits(('download', ('peer2',), (s1,)), doc, 17),
+            False
+        )
+        doc['stored'][s2] = {'copies': 1}
+        self.assertIs(mocked.action_fits(key, doc, 17), False)
+        self.assertIs(mocked.action_fits(('nope', s1, ()), doc, 17), False)
+
+    def test_plan_and_execute(self):
+        class MockMS:
+            def __init__(self):
+                self._calls = []
+                self._current = {}
+                self._batches = []
+
+            def recheck_ranks(self, docs, rank=None):
+                self._batches.append([doc['_id'] for doc in docs])
+                result = []
+                for doc in docs:
+                    current = self._current.get(doc['_id'], doc)
+                    max_rank = (metastore.get_rank(doc) if rank is None else rank)
+                    if current is not None and metastore.get_rank(current) > max_rank:
+                        current = None
+                    result.append(current)
+                return result
+
+            def verify(self, fs, doc):
+                self._calls.append(('verify', fs.id, doc['_id']))
+
+            def copy(self, fs, doc, *dst):
+                self._calls.append(
+                    ('copy', fs.id, doc['_id'], tuple(d.id for d in dst))
+                )
+
+        class Mocked(MockedPlanner):
+            def __init__(self, drives, remote):
+                super().__init__(drives, remote)
+                self.ms = MockMS()
+                self.lanes = None
+                self._up_rank = []
+
+            def order_group(self, key, docs):
+                return sorted(docs, key=lambda d: d['_id'])
+
+            def up_rank(self, doc, threshold):
+                self._up_rank.append(doc['_id'])
+
+        (s1, s2, s3) = sorted(random_id() for i in range(3))
+        mocked = Mocked({s1: 'sda', s2: 'sdb', s3: 'sdc'}, {})
+        mocked.update_remote = None
+        ids = sorted(random_id() for i in range(5))
+        docs = [
+            {'_id': ids[4], 'stored': {s1: {'copies': 0}}, 'bytes': 10},
+            {'_id': ids[3], 'stored': {s1: {'copies': 1}}, 'bytes': 10},
+            {'_id': ids[2], 'stored': {s1: {'copies': 0}}, 'bytes': 10},
+            {'_id': ids[1], 'stored': {s1: {'copies': 1}}, 'bytes': 10},
+            {'_id': ids[0], 'stored': {s1: {'copies': 1}, s2: {'copies': 1},
+                s3: {'copies': 1}}, 'bytes': 10},
+        ]
+        plan = mocked.plan(docs, 17)
+        self.assertIsInstance(plan, core.IOPlan)
+        self.assertEqual(plan.groups, {
+            ('verify', s1, ()): [docs[0], docs[2]],
+            ('copy', s1, (s2,)): [docs[1], docs[3]],
+        })
+        self.assertEqual(plan.count, 4)
+        self.assertEqual(plan.skipped, 1)
+        self.assertEqual(plan.cost, 6)
+        self.assertEqual(plan.size, 60)
+
+        # s2 fills up part way through:
+        mocked.stores.avail = {s3}
+        self.assertIsNone(mocked.execute_plan(plan, 17))
+        self.assertEqual(sorted(mocked.ms._calls), [
+            ('verify', s1, ids[2]),
+            ('verify', s1, ids[4]),
+        ])
+        self.assertEqual(mocked._up_rank, [ids[1], ids[3]])
+
+        mocked.stores.avail = {s2, s3}
+        mocked.ms._calls = []
+        mocked._leases = []
+        mocked.execute_plan(plan, 17)
+        self.assertEqual(mocked.ms._calls, [
+            ('copy', s1, ids[1], (s2,)),
+            ('copy', s1, ids[3], (s2,)),
+            ('verify', s1, ids[2]),
+            ('verify', s1, ids[4]),
+        ])
+        # Each action leases the drives it uses:
+        self.assertEqual(sorted(mocked._leases), [
+            ['sda'], ['sda'], ['sda', 'sdb'], ['sda', 'sdb'],
+        ])
+
+        # Docs that changed since the plan was made:
+        mocked.ms._calls = []
+        mocked._up_rank = []
+        mocked.ms._batches = []
+        mocked.ms._current = {
+            # Deleted:
+            ids[1]: None,
+            # Rank went up, so it's skipped:
+            ids[2]: {'_id': ids[2], 'stored': {s1: {'copies': 1}}, 'bytes': 10},
+            # Same rank, but the planned action no longer applies:
+            ids[3]: {'_id': ids[3], 'stored': {s2: {'copies': 1}}, 'bytes': 10},
+        }
+        mocked.execute_plan(plan, 17)
+        self.assertEqual(mocked.ms._calls, [
+            ('verify', s1, ids[4]),
+        ])
+        self.assertEqual(mocked._up_rank, [ids[3]])
+        # Each group is re-checked with one batch, in source drive order:
+        self.assertEqual(sorted(mocked.ms._batches), [
+            [ids[1], ids[3]],
+            [ids[2], ids[4]],
+        ])
+
+        self.assertEqual(mocked.get_action_lanes(('copy', s1, (s2, s3))),
+            {'sda', 'sdb', 'sdc'}
+        )
+        self.assertEqual(
+            mocked.get_action_lanes(('download', ('peer1',), (s3,))),
+            {'sdc', ('peer', 'peer1')}
+        )
 
     def test_up_rank(self):
         class Mocked(core.Vigilance):
@@ -368,6 +986,17 @@ class TestVigilance(CouchCase):
         self.assertEqual(inst.local, frozenset())
         self.assertEqual(inst.clients, {})
         self.assertEqual(inst.peers, {})
+        self.assertEqual(inst.drives, {})
+        self.assertEqual(inst.inflight, set())
+        self.assertIsNone(inst.lanes)
+        self.assertIsInstance(inst.checkpoint, core.Checkpoint)
+        self.assertIs(inst.checkpoint.db, db)
+        self.assertEqual(inst.checkpoint.context, {'stores': [], 'peers': []})
+        self.assertIsInstance(inst.peer_stats, PeerStats)
+        self.assertIsNone(inst.peer_stats.filename)
+        stats = PeerStats()
+        inst = core.Vigilance(ms, None, stats)
+        self.assertIs(inst.peer_stats, stats)
 
     def test_update_remote(self):
         db = util.get_db(self.env, True)
@@ -463,11 +1092,20 @@ class TestTaskPool(TestCase):
         self.assertEqual(pool.active_tasks, {})
         self.assertIsNone(pool.thread)
         self.assertIsInstance(pool.queue, queue.Queue)
+        self.assertIsInstance(pool.wakeup_r, int)
+        self.assertIsInstance(pool.wakeup_w, int)
+        self.assertIs(os.get_blocking(pool.wakeup_r), False)
         self.assertIsInstance(pool.restart_always, frozenset)
         self.assertEqual(pool.restart_always, frozenset())
         self.assertIsInstance(pool.restart_once, set)
         self.assertEqual(pool.restart_always, set())
         self.assertIs(pool.running, False)
+        self.assertEqual(pool.resources, {})
+        self.assertEqual(pool.priorities, {})
+        self.assertEqual(pool.limits, core.RESOURCE_LIMITS)
+        self.assertIsNot(pool.limits, core.RESOURCE_LIMITS)
+        self.assertEqual(pool.pending, {})
+        self.assertEqual(pool.held, {})
 
         key1 = random_id()
         pool = core.TaskPool(key1)
@@ -484,11 +1122,24 @@ class TestTaskPool(TestCase):
         self.assertIs(pool.start_reaper(), False)
         self.assertIsInstance(pool.thread, threading.Thread)
 
+        (wakeup_r, wakeup_w) = (pool.wakeup_r, pool.wakeup_w)
         self.assertIs(pool.stop_reaper(), True)
         self.assertIsNone(pool.thread)
+        self.assertIsNone(pool.wakeup_r)
+        self.assertIsNone(pool.wakeup_w)
+        for fd in (wakeup_r, wakeup_w):
+            with self.assertRaises(OSError):
+                os.fstat(fd)
         self.assertIs(pool.stop_reaper(), False)
         self.assertIsNone(pool.thread)
 
+        # The wake-up pipe is re-opened when the reaper is restarted:
+        self.assertIs(pool.start_reaper(), True)
+        self.assertIsInstance(pool.wakeup_r, int)
+        self.assertIsInstance(pool.wakeup_w, int)
+        self.assertIs(os.get_blocking(pool.wakeup_r), False)
+        self.assertIs(pool.stop_reaper(), True)
+
     def test_reaper(self):
         class MockedTaskPool(core.TaskPool):
             def __init__(self):
@@ -535,6 +1186,89 @@ class TestTaskPool(TestCase):
             self.assertEqual(task.process.exitcode, 0)
             self.assertFalse(task.process.is_alive())
 
+        # Without a timeout, the reaper is woken by the process sentinels and
+        # by notify():
+        pool = MockedTaskPool()
+        thread = threading.Thread(target=pool.reaper)
+        thread.start()
+        task = core.ActiveTask('baz', start_process(dummy_worker, 0.5), None)
+        start = time.monotonic()
+        pool.notify(task)
+        while not pool._forwards:
+            time.sleep(0.05)
+            self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(pool._forwards, [task])
+        self.assertLess(time.monotonic() - start, 1.5)
+        pool.notify(None)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+        # Metrics are merged from the task's pipe, which is then closed:
+        metrics.registry.reset()
+        pool = MockedTaskPool()
+        (reader, writer) = create_pipe()
+        process = start_process(metrics.run_task, writer, 'qux',
+            metrics.incr, 'reaped', 2
+        )
+        writer.close()
+        task = core.ActiveTask('qux', process, None, reader)
+        for item in (task, None):
+            pool.queue.put(item)
+        self.assertIsNone(pool.reaper(timeout=1))
+        self.assertEqual(pool._forwards, [task])
+        self.assertIs(reader.closed, True)
+        self.assertEqual(metrics.registry.counters, {'reaped': 2})
+        metrics.registry.reset()
+
+    def test_notify(self):
+        pool = core.TaskPool()
+        self.assertIsNone(pool.drain_wakeup())
+        self.assertIsNone(pool.notify('foo'))
+        self.assertIsNone(pool.notify('bar'))
+        self.assertEqual(pool.queue.get_nowait(), 'foo')
+        self.assertEqual(pool.queue.get_nowait(), 'bar')
+        self.assertEqual(os.read(pool.wakeup_r, 4096), b'\x00\x00')
+        pool.notify(None)
+        self.assertIsNone(pool.drain_wakeup())
+        with self.assertRaises(BlockingIOError):
+            os.read(pool.wakeup_r, 4096)
+
+    def test_collect_metrics(self):
+        pool = core.TaskPool()
+        metrics.registry.reset()
+        try:
+            # A task without a pipe:
+            task = core.ActiveTask('foo', None, None)
+            self.assertIsNone(pool.collect_metrics(task))
+            self.assertEqual(metrics.registry.counters, {})
+
+            (reader, writer) = create_pipe()
+            process = start_process(metrics.run_task, writer,
+                ('foo',), metrics.incr, 'bar', 3
+            )
+            writer.close()
+            task = core.ActiveTask(('foo',), process, None, reader)
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+            self.assertIsNone(pool.collect_metrics(task))
+            self.assertEqual(metrics.registry.counters, {'bar': 3})
+            self.assertIs(reader.closed, True)
+            self.assertIsNone(pool.collect_metrics(task))
+            self.assertEqual(metrics.registry.counters, {'bar': 3})
+
+            # Killed in the middle of a send:
+            (reader, writer) = create_pipe()
+            writer.send(('baz', {'counters': {'bar': 1}, 'gauges': {},
+                'histograms': {}}))
+            os.write(writer.fileno(), b'\x00\x00\x01\x00partial')
+            writer.close()
+            task = core.ActiveTask('baz', None, None, reader)
+            self.assertIsNone(pool.collect_metrics(task))
+            self.assertIs(reader.closed, True)
+            self.assertEqual(metrics.registry.counters, {'bar': 4})
+        finally:
+            metrics.registry.reset()
+
     def test_on_task_completed(self):
         class MockedTaskPool(core.TaskPool):
             def __init__(self, *restart_always):
@@ -819,6 +1553,186 @@ class TestTaskPool(TestCase):
         self.assertEqual(pool.active_tasks, {})
         self.assertTrue(pool.queue.empty())
 
+    def test_get_usage(self):
+        pool = core.TaskPool()
+        self.assertEqual(pool.get_usage(), {})
+        pool.active_tasks.update({'a': None, 'b': None, 'c': None})
+        pool.held.update({
+            'a': frozenset(['drive:1', 'couchdb']),
+            'b': frozenset(['couchdb']),
+        })
+        self.assertEqual(pool.get_usage(), {'drive:1': 1, 'couchdb': 2})
+
+    def test_admit(self):
+        class MockedTaskPool(core.TaskPool):
+            def __init__(self):
+                super().__init__()
+                self._calls = []
+
+            def launch_task(self, key):
+                self._calls.append(key)
+                self.active_tasks[key] = None
+                self.held[key] = self.resources[key]
+
+        pool = MockedTaskPool()
+        self.assertEqual(pool.admit(), [])
+        pool.limits['couchdb'] = 2
+        pool.resources.update({
+            'backup': frozenset(['drive:1', 'drive:2', 'couchdb']),
+            'fs1': frozenset(['drive:1', 'couchdb']),
+            'fs2': frozenset(['drive:2', 'couchdb']),
+            'fs3': frozenset(['drive:3', 'couchdb']),
+            'fs4': frozenset(['drive:4', 'couchdb']),
+            'repl': frozenset(['network']),
+        })
+        pool.priorities.update({
+            'backup': 0, 'fs1': 2, 'fs2': 2, 'fs3': 2, 'fs4': 2, 'repl': 1,
+        })
+        for key in ('fs1', 'fs3', 'backup', 'fs2', 'fs4', 'repl'):
+            pool.add_pending(key)
+        self.assertEqual(pool.admit(), ['backup', 'repl', 'fs3'])
+        self.assertEqual(pool._calls, ['backup', 'repl', 'fs3'])
+        self.assertEqual(set(pool.pending), {'fs1', 'fs2', 'fs4'})
+        self.assertEqual(pool.get_usage(), {
+            'drive:1': 1, 'drive:2': 1, 'drive:3': 1, 'couchdb': 2, 'network': 1,
+        })
+        self.assertEqual(pool.admit(), [])
+
+        # When backup is restarted, it goes ahead of the filestore tasks:
+        del pool.active_tasks['backup']
+        del pool.held['backup']
+        pool.add_pending('backup')
+        self.assertEqual(pool.admit(), ['backup'])
+
+        # Once backup is done, the filestore tasks on its drives can start,
+        # up to the couchdb limit:
+        del pool.active_tasks['backup']
+        del pool.held['backup']
+        self.assertEqual(pool.admit(), ['fs1'])
+        del pool.active_tasks['fs3']
+        del pool.held['fs3']
+        self.assertEqual(pool.admit(), ['fs2'])
+        self.assertEqual(set(pool.pending), {'fs4'})
+
+    def test_admit_leased(self):
+        class MockedTaskPool(core.TaskPool):
+            def __init__(self, leased):
+                super().__init__()
+                self._leased = leased
+                self._calls = []
+
+            def is_leased(self, resource, usage):
+                return resource in self._leased
+
+            def queue_admit_retry(self):
+                self._calls.append('retry')
+
+            def launch_task(self, key):
+                self._calls.append(key)
+                self.active_tasks[key] = None
+                self.held[key] = self.resources[key]
+
+        pool = MockedTaskPool({'drive:1'})
+        pool.resources.update({
+            'fs1': frozenset(['drive:1', 'couchdb']),
+            'fs2': frozenset(['drive:2', 'couchdb']),
+            'downgrade': frozenset(['drive:1', 'drive:2', 'couchdb']),
+        })
+        pool.priorities.update({'fs1': 2, 'fs2': 2, 'downgrade': 3})
+        for key in ('downgrade', 'fs1', 'fs2'):
+            pool.add_pending(key)
+
+        # fs1 waits for the lease on its drive, and a retry is queued:
+        self.assertEqual(pool.admit(), ['fs2'])
+        self.assertEqual(pool._calls, ['fs2', 'retry'])
+        self.assertEqual(set(pool.pending), {'fs1', 'downgrade'})
+
+        # Once the lease is released, the retry admits fs1:
+        pool._leased.clear()
+        pool._calls = []
+        pool.running = True
+        self.assertIs(pool.on_admit_retry(), False)
+        self.assertEqual(pool._calls, ['fs1'])
+        self.assertEqual(set(pool.pending), {'downgrade'})
+
+        # But not when the pool isn't running:
+        del pool.active_tasks['fs1']
+        del pool.held['fs1']
+        pool.running = False
+        pool._calls = []
+        self.assertIs(pool.on_admit_retry(), False)
+        self.assertEqual(pool._calls, [])
+
+    def test_is_leased(self):
+        tmp = TempDir()
+        use_runtime_dir(self, tmp.dir)
+        pool = core.TaskPool()
+        resource = core.drive_resource('8:16')
+        self.assertIs(pool.is_leased(resource, {}), False)
+        with iobudget.DriveLease(['8:16']):
+            self.assertIs(pool.is_leased(resource, {}), True)
+            self.assertIs(pool.is_leased('couchdb', {}), False)
+            # The lease is held by one of our own tasks:
+            self.assertIs(pool.is_leased(resource, {resource: 1}), False)
+        self.assertIs(pool.is_leased(resource, {}), False)
+
+    def test_start_task_pending(self):
+        class MockedTaskPool(core.TaskPool):
+            def launch_task(self, key):
+                self.active_tasks[key] = None
+                self.held[key] = self.resources[key]
+
+        pool = MockedTaskPool()
+        pool.running = True
+        pool.tasks.update({'a': 'foo', 'b': 'bar'})
+        pool.resources.update({
+            'a': frozenset(['drive:1']),
+            'b': frozenset(['drive:1']),
+        })
+        self.assertIs(pool.start_task('a'), True)
+        self.assertIs(pool.start_task('b'), False)
+        self.assertEqual(set(pool.pending), {'b'})
+        self.assertIs(pool.start_task('b'), False)
+        self.assertEqual(pool.pending, {'b': 2})
+
+        # restart_task() leaves a pending task alone:
+        self.assertIs(pool.restart_task('b'), False)
+        self.assertEqual(pool.pending, {'b': 2})
+
+        # stop_task() removes a pending task:
+        self.assertIs(pool.stop_task('b'), False)
+        self.assertEqual(pool.pending, {})
+
+        # on_task_completed() admits waiting tasks:
+        self.assertIs(pool.start_task('b'), False)
+        process = DummyProcess()
+        task = core.ActiveTask('a', process, None)
+        pool.active_tasks['a'] = task
+        pool.on_task_completed(task)
+        self.assertEqual(process._calls, ['join'])
+        self.assertEqual(set(pool.active_tasks), {'b'})
+        self.assertEqual(pool.pending, {})
+        self.assertEqual(pool.held, {'b': frozenset(['drive:1'])})
+
+        # stop() clears the pending tasks:
+        pool.pending['a'] = 17
+        pool.active_tasks.clear()
+        self.assertIs(pool.stop(), True)
+        self.assertEqual(pool.pending, {})
+
+    def test_set_resources(self):
+        pool = core.TaskPool()
+        pool.set_resources('foo', ['couchdb'])
+        self.assertEqual(pool.resources, {})
+        pool.add_task('foo', print, resources=['network'], priority=3)
+        self.assertEqual(pool.resources, {'foo': frozenset(['network'])})
+        self.assertEqual(pool.priorities, {'foo': 3})
+        pool.set_resources('foo', ['couchdb'])
+        self.assertEqual(pool.resources, {'foo': frozenset(['couchdb'])})
+        self.assertIs(pool.remove_task('foo'), True)
+        self.assertEqual(pool.resources, {})
+        self.assertEqual(pool.priorities, {})
+
     def test_stop_task(self):
         pool = core.TaskPool()
         key = random_id()
@@ -920,7 +1834,7 @@ class TestTaskPool(TestCase):
             def start_reaper(self):
                 self._calls.append('start_reaper')
 
-            def start_task(self, key):
+            def launch_task(self, key):
                 self._calls.append(key)
 
         pool = MockedTaskPool()
@@ -948,6 +1862,20 @@ class TestTaskPool(TestCase):
         )
         self.assertEqual(pool.tasks, {key1: 'foo', key2: 'bar', key3: 'baz'})
         self.assertIs(pool.running, True)
+        self.assertEqual(pool.pending, {})
+
+        # Tasks are admitted in order of priority, not in order of key:
+        pool = MockedTaskPool()
+        pool.tasks.update({'a': 'foo', 'b': 'bar', 'c': 'baz'})
+        pool.resources.update({
+            'a': frozenset(['drive:1']),
+            'b': frozenset(['drive:1', 'drive:2']),
+            'c': frozenset(['drive:2']),
+        })
+        pool.priorities.update({'a': 2, 'b': 0, 'c': 2})
+        self.assertIs(pool.start(), True)
+        self.assertEqual(pool._calls, ['start_reaper', 'b'])
+        self.assertEqual(set(pool.pending), {'a', 'c'})
 
     def test_stop(self):
         class MockedTaskPool(core.TaskPool):
@@ -993,21 +1921,73 @@ class TestTaskMaster(TestCase):
         self.assertEqual(master.pool.tasks, {})
         self.assertEqual(master.pool.active_tasks, {})
         self.assertIs(master.pool.running, False)
+        self.assertEqual(master.drives, {})
+        self.assertEqual(master.get_shared_resources(), {'couchdb', 'network'})
 
     def test_add_filestore_task(self):
         env = random_id()
         ssl_config = random_id()
         master = core.TaskMaster(env, ssl_config)
         fs = TempFileStore()
+        self.assertIsNone(master.add_vigilance_task())
         self.assertIsNone(master.add_filestore_task(fs))
-        self.assertEqual(master.pool.tasks, {
-            ('filestore', fs.parentdir): core.TaskInfo(
+        key = ('filestore', fs.parentdir)
+        self.assertEqual(master.pool.tasks[key],
+            core.TaskInfo(
                 core.filestore_worker,
                 (env, fs.parentdir, fs.id),
             ),
-        })
+        )
         self.assertEqual(master.pool.active_tasks, {})
         self.assertIs(master.pool.running, False)
+        drive = core.drive_resource(get_drive_id(fs.parentdir))
+        self.assertEqual(master.drives, {fs.id: get_drive_id(fs.parentdir)})
+        self.assertEqual(master.pool.resources[key], {drive, 'couchdb'})
+        self.assertEqual(master.pool.priorities[key], core.PRIORITY_FILESTORE)
+        self.assertEqual(master.pool.resources[core.VIGILANCE], {'network'})
+
+        # The downgrade task needs every drive:
+        self.assertIsNone(master.add_downgrade_task())
+        self.assertEqual(master.pool.resources[core.DOWNGRADE],
+            {drive, 'couchdb', 'network'}
+        )
+
+        # Removing the store updates the downgrade resources:
+        self.assertIsNone(master.remove_filestore_task(fs))
+        self.assertEqual(master.drives, {})
+        self.assertEqual(master.pool.resources[core.DOWNGRADE],
+            {'couchdb', 'network'}
+        )
+
+    def test_filestore_task_with_vigilance(self):
+        class MockedTaskPool(core.TaskPool):
+            def launch_task(self, key):
+                self.active_tasks[key] = None
+                self.held[key] = self.resources[key]
+
+        master = core.TaskMaster(random_id(), random_id())
+        master.pool = MockedTaskPool(core.VIGILANCE)
+        fs1 = TempFileStore()
+        fs2 = TempFileStore()
+        self.assertIsNone(master.add_vigilance_task())
+        self.assertIsNone(master.add_filestore_task(fs1))
+        self.assertIsNone(master.add_filestore_task(fs2))
+        self.assertIsNone(master.add_downgrade_task())
+        pool = master.pool
+        pool.running = True
+
+        # Vigilance is running, yet a filestore task is still admitted:
+        self.assertIs(pool.start_task(core.VIGILANCE), True)
+        key1 = ('filestore', fs1.parentdir)
+        self.assertIs(pool.start_task(key1), True)
+        self.assertEqual(set(pool.active_tasks), {core.VIGILANCE, key1})
+
+        # The downgrade waits for the filestore task, but not for Vigilance:
+        self.assertIs(pool.start_task(core.DOWNGRADE), False)
+        del pool.active_tasks[key1]
+        del pool.held[key1]
+        self.assertEqual(pool.admit(), [core.DOWNGRADE])
+        self.assertEqual(pool.pending, {})
 
     def test_remove_filestore_task(self):
         env = random_id()
@@ -0,0 +1,275 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Unit tests for `dmedia.iobudget`.
+"""
+
+from unittest import TestCase
+import os
+from os import path
+import time
+import threading
+
+from dbase32 import random_id
+
+from .base import TempDir
+
+from dmedia import iobudget
+
+
+class RuntimeDirCase(TestCase):
+    def setUp(self):
+        self.tmp = TempDir()
+        self.saved = os.environ.get('XDG_RUNTIME_DIR')
+        os.environ['XDG_RUNTIME_DIR'] = self.tmp.dir
+        iobudget._last_marked.clear()
+
+    def tearDown(self):
+        if self.saved is None:
+            del os.environ['XDG_RUNTIME_DIR']
+        else:
+            os.environ['XDG_RUNTIME_DIR'] = self.saved
+        self.tmp = None
+
+
+class TestFunctions(RuntimeDirCase):
+    def test_get_runtime_dir(self):
+        dirname = self.tmp.join('dmedia')
+        self.assertFalse(path.exists(dirname))
+        self.assertEqual(iobudget.get_runtime_dir(), dirname)
+        self.assertTrue(path.isdir(dirname))
+        self.assertEqual(iobudget.get_runtime_dir(), dirname)
+
+    def test_mark_foreground(self):
+        store_id = random_id()
+        filename = iobudget.foreground_filename(store_id)
+        self.assertEqual(iobudget.get_foreground_time(store_id), 0)
+        self.assertIsNone(iobudget.mark_foreground(store_id))
+        self.assertTrue(path.isfile(filename))
+        mtime = iobudget.get_foreground_time(store_id)
+        self.assertGreater(mtime, 0)
+        self.assertEqual(mtime, os.stat(filename).st_mtime)
+
+        # Only touched once per MARK_INTERVAL:
+        os.utime(filename, (1234, 1234))
+        iobudget.mark_foreground(store_id)
+        self.assertEqual(iobudget.get_foreground_time(store_id), 1234)
+        iobudget._last_marked.clear()
+        iobudget.mark_foreground(store_id)
+        self.assertGreater(iobudget.get_foreground_time(store_id), 1234)
+
+    def test_is_leased(self):
+        filename = iobudget.lease_filename('8:16')
+        self.assertEqual(filename, self.tmp.join('dmedia', 'drive-8:16.lock'))
+        self.assertIs(iobudget.is_leased('8:16'), False)
+        self.assertFalse(path.exists(filename))
+        lease = iobudget.DriveLease(['8:16'])
+        lease.acquire()
+        self.assertIs(iobudget.is_leased('8:16'), True)
+        lease.release()
+        self.assertIs(iobudget.is_leased('8:16'), False)
+        self.assertTrue(path.isfile(filename))
+
+
+class TestDriveLease(RuntimeDirCase):
+    def test_init(self):
+        lease = iobudget.DriveLease(['sdb', 'sda', 'sdb'])
+        self.assertEqual(lease.drive_ids, ('sda', 'sdb'))
+        self.assertEqual(lease.fds, [])
+        self.assertEqual(repr(lease), "DriveLease(['sda', 'sdb'])")
+
+    def test_with(self):
+        with iobudget.DriveLease(['sda', 'sdb']) as lease:
+            self.assertEqual(len(lease.fds), 2)
+            self.assertIs(iobudget.is_leased('sda'), True)
+            self.assertIs(iobudget.is_leased('sdb'), True)
+            self.assertIs(iobudget.is_leased('sdc'), False)
+        self.assertEqual(lease.fds, [])
+        self.assertIs(iobudget.is_leased('sda'), False)
+        self.assertIs(iobudget.is_leased('sdb'), False)
+
+        # Released when the with block raises:
+        with self.assertRaises(ValueError):
+            with iobudget.DriveLease(['sda']) as lease:
+                raise ValueError('nope')
+        self.assertEqual(lease.fds, [])
+        self.assertIs(iobudget.is_leased('sda'), False)
+
+    def test_wait(self):
+        lease = iobudget.DriveLease(['sda'])
+        lease.acquire()
+        acquired = threading.Event()
+
+        def worker():
+            with iobudget.DriveLease(['sda', 'sdb']):
+                acquired.set()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        lease.release()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+
+class TestTokenBucket(TestCase):
+    def test_take(self):
+        bucket = iobudget.TokenBucket(1000, now=10)
+        self.assertEqual(bucket.rate, 1000)
+        self.assertEqual(bucket.tokens, 1000)
+        self.assertEqual(bucket.stamp, 10)
+        self.assertEqual(repr(bucket), 'TokenBucket(1000)')
+
+        # Burst of up to one second:
+        self.assertEqual(bucket.take(1000, now=10), 0)
+        self.assertEqual(bucket.take(500, now=10), 0.5)
+        self.assertEqual(bucket.tokens, -500)
+
+        # Debt is paid off over time:
+        self.assertEqual(bucket.take(500, now=11), 0)
+        self.assertEqual(bucket.tokens, 0)
+        self.assertEqual(bucket.take(0, now=11.5), 0)
+        self.assertEqual(bucket.tokens, 500)
+
+        # Never more than one second worth of tokens:
+        self.assertEqual(bucket.take(0, now=100), 0)
+        self.assertEqual(bucket.tokens, 1000)
+
+        # A scale reduces the rate and the capacity:
+        self.assertEqual(bucket.take(500, scale=0.25, now=100), 1.0)
+        self.assertEqual(bucket.tokens, -250)
+
+
+class TestIOBudget(RuntimeDirCase):
+    def test_init(self):
+        store_id = random_id()
+        inst = iobudget.IOBudget(store_id)
+        self.assertEqual(inst.store_id, store_id)
+        self.assertIsNone(inst.bytes)
+        self.assertIsNone(inst.iops)
+        self.assertIs(inst.active, False)
+        self.assertIsNone(inst.checked)
+        self.assertEqual(repr(inst),
+            'IOBudget({!r}, 0, 0)'.format(store_id)
+        )
+        self.assertEqual(inst.consume(10**12, 10**6), 0)
+
+        inst = iobudget.IOBudget(store_id, 1000, 10)
+        self.assertEqual(inst.bytes.rate, 1000)
+        self.assertEqual(inst.iops.rate, 10)
+        self.assertEqual(repr(inst),
+            'IOBudget({!r}, 1000, 10)'.format(store_id)
+        )
+
+        # Zero means unlimited:
+        inst = iobudget.IOBudget(store_id, 0, 0)
+        self.assertIsNone(inst.bytes)
+        self.assertIsNone(inst.iops)
+        self.assertEqual(inst.consume(10**12, 10**6), 0)
+
+    def test_from_doc(self):
+        store_id = random_id()
+        inst = iobudget.IOBudget.from_doc({'_id': store_id})
+        self.assertEqual(inst.store_id, store_id)
+        self.assertIsNone(inst.bytes)
+        self.assertIsNone(inst.iops)
+        doc = {
+            '_id': store_id,
+            'io_budget': {'bytes_per_sec': 1000},
+        }
+        inst = iobudget.IOBudget.from_doc(doc)
+        self.assertEqual(inst.bytes.rate, 1000)
+        self.assertIsNone(inst.iops)
+        doc['io_budget']['iops'] = 200
+        inst = iobudget.IOBudget.from_doc(doc)
+        self.assertEqual(inst.bytes.rate, 1000)
+        self.assertEqual(inst.iops.rate, 200)
+        doc['io_budget']['bytes_per_sec'] = 0
+        inst = iobudget.IOBudget.from_doc(doc)
+        self.assertIsNone(inst.bytes)
+        self.assertEqual(inst.iops.rate, 200)
+
+    def test_get_scale(self):
+        store_id = random_id()
+        inst = iobudget.IOBudget(store_id)
+        self.assertEqual(inst.get_scale(100), 1.0)
+        self.assertEqual(inst.checked, 100)
+        iobudget.mark_foreground(store_id)
+
+        # Foreground file is only checked once per MARK_INTERVAL:
+        self.assertEqual(inst.get_scale(100.5), 1.0)
+        self.assertEqual(inst.get_scale(101), iobudget.FOREGROUND_SCALE)
+        self.assertIs(inst.active, True)
+
+        # Back to full speed after FOREGROUND_WINDOW:
+        old = time.time() - iobudget.FOREGROUND_WINDOW - 1
+        os.utime(iobudget.foreground_filename(store_id), (old, old))
+        self.assertEqual(inst.get_scale(101.5), iobudget.FOREGROUND_SCALE)
+        self.assertEqual(inst.get_scale(102), 1.0)
+        self.assertIs(inst.active, False)
+
+    def test_consume_foreground(self):
+        # Unlimited, but held to the FOREGROUND_* defaults during foreground
+        # reads:
+        store_id = random_id()
+        inst = iobudget.IOBudget(store_id)
+        self.assertEqual(inst.consume(10**12, 10**6), 0)
+        iobudget.mark_foreground(store_id)
+        now = inst.fg_iops.stamp
+        self.assertEqual(inst.get_scale(now + 2), iobudget.FOREGROUND_SCALE)
+        self.assertEqual(
+            inst.take(inst.iops, inst.fg_iops, 10, 1.0, now + 2), 0
+        )
+        self.assertEqual(
+            inst.take(inst.iops, inst.fg_iops, 2 * iobudget.FOREGROUND_IOPS,
+                1.0, now + 2
+            ),
+            1.2
+        )
+
+        # A configured limit is scaled down instead:
+        inst = iobudget.IOBudget(store_id, 1000, 10)
+        now = inst.iops.stamp
+        scale = inst.get_scale(now)
+        self.assertEqual(scale, iobudget.FOREGROUND_SCALE)
+        self.assertEqual(
+            inst.take(inst.iops, inst.fg_iops, 5, scale, now), 1.0
+        )
+        self.assertEqual(inst.fg_iops.tokens, iobudget.FOREGROUND_IOPS)
+
+        # And the FOREGROUND_* defaults are unused without foreground reads:
+        inst = iobudget.IOBudget(random_id())
+        self.assertEqual(inst.get_scale(now), 1.0)
+        self.assertEqual(
+            inst.take(inst.iops, inst.fg_iops, 10**6, 1.0, now), 0
+        )
+        self.assertEqual(inst.fg_iops.tokens, iobudget.FOREGROUND_IOPS)
+
+    def test_consume(self):
+        inst = iobudget.IOBudget(random_id(), 1000, 10)
+        self.assertEqual(inst.consume(500), 0)
+        self.assertEqual(inst.consume(0, 9), 0)
+        start = time.monotonic()
+        delay = inst.consume(0, 1)
+        self.assertGreater(delay, 0)
+        self.assertLessEqual(delay, 0.1)
+        self.assertGreaterEqual(time.monotonic() - start, delay)
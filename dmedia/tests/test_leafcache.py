@@ -0,0 +1,182 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Unit tests for `dmedia.leafcache`.
+"""
+
+from unittest import TestCase
+import os
+import threading
+
+import filestore
+from filestore import ContentHash, DIGEST_BYTES
+
+from .base import TempDir, random_file_id
+
+from dmedia import leafcache
+
+
+def random_ch(count=3):
+    leaf_hashes = os.urandom(DIGEST_BYTES * count)
+    return ContentHash(random_file_id(), count * 1000, leaf_hashes)
+
+
+class TestFunctions(TestCase):
+    def test_unpack_leaf_hashes(self):
+        self.assertEqual(leafcache.unpack_leaf_hashes(b''), tuple())
+        leaf_hashes = os.urandom(DIGEST_BYTES * 3)
+        result = leafcache.unpack_leaf_hashes(memoryview(leaf_hashes))
+        self.assertEqual(len(result), 3)
+        for (i, item) in enumerate(result):
+            self.assertIsInstance(item, memoryview)
+            self.assertEqual(item,
+                leaf_hashes[i*DIGEST_BYTES:(i+1)*DIGEST_BYTES]
+            )
+        self.assertEqual(
+            leafcache.unpack_leaf_hashes(leaf_hashes),
+            tuple(filestore.iter_leaf_hashes(leaf_hashes))
+        )
+
+
+class TestLeafHashCache(TestCase):
+    def test_init(self):
+        tmp = TempDir()
+        filename = tmp.join('leaf-hashes')
+        inst = leafcache.LeafHashCache(filename)
+        self.assertEqual(inst.filename, filename)
+        self.assertIsInstance(inst.lock, type(threading.Lock()))
+        self.assertEqual(inst.index, {})
+        self.assertEqual(inst.end, 0)
+        self.assertIsNone(inst.buf)
+        self.assertEqual(len(inst), 0)
+        self.assertEqual(os.stat(filename).st_size, 0)
+        self.assertEqual(repr(inst), 'LeafHashCache({!r})'.format(filename))
+
+    def test_add_and_get(self):
+        tmp = TempDir()
+        filename = tmp.join('leaf-hashes')
+        inst = leafcache.LeafHashCache(filename)
+        chs = [random_ch(i + 1) for i in range(5)]
+        for ch in chs:
+            self.assertIsNone(inst.get(ch.id, ch.file_size))
+            self.assertIsNone(inst.add(ch))
+        self.assertEqual(len(inst), 5)
+        for ch in chs:
+            leaf_hashes = inst.get(ch.id, ch.file_size)
+            self.assertIsInstance(leaf_hashes, memoryview)
+            self.assertEqual(leaf_hashes, ch.leaf_hashes)
+            self.assertEqual(inst.content_hash(ch.id, ch.file_size, False), ch)
+            self.assertEqual(inst.content_hash(ch.id, ch.file_size),
+                ContentHash(ch.id, ch.file_size,
+                    tuple(filestore.iter_leaf_hashes(ch.leaf_hashes))
+                )
+            )
+            # Wrong file_size is a miss:
+            self.assertIsNone(inst.get(ch.id, ch.file_size + 1))
+            self.assertIsNone(inst.content_hash(ch.id, ch.file_size + 1))
+
+        # Adding again is a no-op:
+        size = os.stat(filename).st_size
+        inst.add(chs[0])
+        self.assertEqual(os.stat(filename).st_size, size)
+
+        # Persists across instances:
+        inst.close()
+        inst = leafcache.LeafHashCache(filename)
+        self.assertEqual(len(inst), 5)
+        for ch in chs:
+            self.assertEqual(inst.get(ch.id, ch.file_size), ch.leaf_hashes)
+
+        # Unpacked leaf_hashes can be added too:
+        ch = random_ch(4)
+        unpacked = ContentHash(ch.id, ch.file_size,
+            tuple(filestore.iter_leaf_hashes(ch.leaf_hashes))
+        )
+        inst.add(unpacked)
+        self.assertEqual(inst.content_hash(ch.id, ch.file_size, False), ch)
+
+    def test_shared(self):
+        tmp = TempDir()
+        filename = tmp.join('leaf-hashes')
+        inst1 = leafcache.LeafHashCache(filename)
+        inst2 = leafcache.LeafHashCache(filename)
+        ch1 = random_ch()
+        ch2 = random_ch()
+        inst1.add(ch1)
+        inst2.add(ch2)
+        self.assertEqual(inst2.get(ch1.id, ch1.file_size), ch1.leaf_hashes)
+        self.assertEqual(inst1.get(ch2.id, ch2.file_size), ch2.leaf_hashes)
+        self.assertEqual(len(inst1), 2)
+        self.assertEqual(len(inst2), 2)
+
+    def test_threads(self):
+        tmp = TempDir()
+        filename = tmp.join('leaf-hashes')
+        inst = leafcache.LeafHashCache(filename)
+        chs = [random_ch(i % 5 + 1) for i in range(200)]
+
+        def worker(i):
+            for ch in chs[i::4]:
+                inst.add(ch)
+                inst.get(ch.id, ch.file_size)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(inst), 200)
+        self.assertEqual(inst.end, os.stat(filename).st_size)
+        for ch in chs:
+            self.assertEqual(inst.get(ch.id, ch.file_size), ch.leaf_hashes)
+
+        # Every record was appended whole:
+        inst = leafcache.LeafHashCache(filename)
+        self.assertEqual(len(inst), 200)
+        for ch in chs:
+            self.assertEqual(inst.get(ch.id, ch.file_size), ch.leaf_hashes)
+
+    def test_partial_record(self):
+        tmp = TempDir()
+        filename = tmp.join('leaf-hashes')
+        inst = leafcache.LeafHashCache(filename)
+        ch1 = random_ch()
+        inst.add(ch1)
+        end = inst.end
+
+        # Simulate a crash part way through appending a record:
+        with open(filename, 'ab') as fp:
+            fp.write(leafcache.HEADER.pack(random_file_id().encode(), 1, 90))
+            fp.write(b'X' * 17)
+        inst = leafcache.LeafHashCache(filename)
+        self.assertEqual(len(inst), 1)
+        self.assertEqual(inst.end, end)
+
+        # The partial record is truncated by the next add():
+        ch2 = random_ch()
+        inst.add(ch2)
+        self.assertEqual(len(inst), 2)
+        self.assertEqual(inst.get(ch1.id, ch1.file_size), ch1.leaf_hashes)
+        self.assertEqual(inst.get(ch2.id, ch2.file_size), ch2.leaf_hashes)
+        inst = leafcache.LeafHashCache(filename)
+        self.assertEqual(len(inst), 2)
+        self.assertEqual(inst.end, os.stat(filename).st_size)
@@ -24,6 +24,8 @@ Unit tests for `dmedia.local`.
 """
 
 from unittest import TestCase
+import os
+from os import path
 from random import Random
 import time
 
@@ -40,6 +42,27 @@ from dmedia import local, schema, util
 
 
 class TestFunctions(TestCase):
+    def test_get_drive_id(self):
+        tmp = TempDir()
+        sysdir = tmp.makedirs('sys')
+        st_dev = os.stat(tmp.dir).st_dev
+        name = '{}:{}'.format(os.major(st_dev), os.minor(st_dev))
+
+        # Not a block device:
+        self.assertEqual(local.get_drive_id(tmp.dir, sysdir), name)
+
+        # A whole disk:
+        disk = tmp.makedirs('devices', 'sdb')
+        os.symlink(disk, path.join(sysdir, name))
+        self.assertEqual(local.get_drive_id(tmp.dir, sysdir), 'sdb')
+
+        # A partition:
+        part = tmp.makedirs('devices', 'sdb', 'sdb2')
+        open(path.join(part, 'partition'), 'w').write('2\n')
+        os.remove(path.join(sysdir, name))
+        os.symlink(part, path.join(sysdir, name))
+        self.assertEqual(local.get_drive_id(tmp.dir, sysdir), 'sdb')
+
     def test_choose_local_store(self):
         fast = tuple(random_id() for i in range(3))
         slow = tuple(random_id() for i in range(3))
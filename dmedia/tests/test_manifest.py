@@ -0,0 +1,106 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Unit tests for `dmedia.manifest`.
+"""
+
+from unittest import TestCase
+import time
+
+from filestore import DIGEST_BYTES
+
+from .base import TempDir, random_file_id
+
+from dmedia import manifest
+
+
+class TestFunctions(TestCase):
+    def test_pack_ids(self):
+        self.assertEqual(manifest.pack_ids([]), b'')
+        ids = [random_file_id() for i in range(5)]
+        data = manifest.pack_ids(ids)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(len(data), 5 * DIGEST_BYTES)
+        self.assertEqual(manifest.pack_ids(set(ids)), data)
+        self.assertEqual(manifest.unpack_ids(data), set(ids))
+        self.assertEqual(manifest.unpack_ids(b''), set())
+
+
+class TestRelinkManifest(TestCase):
+    def test_init(self):
+        tmp = TempDir()
+        filename = tmp.join('manifest')
+        start = time.time()
+        inst = manifest.RelinkManifest(filename)
+        self.assertEqual(inst.filename, filename)
+        self.assertGreaterEqual(inst.created, start)
+        self.assertEqual(inst.dirs, {})
+        self.assertEqual(len(inst), 0)
+        self.assertEqual(repr(inst), 'RelinkManifest({!r})'.format(filename))
+
+        # A corrupt manifest is ignored:
+        open(filename, 'wb').write(b'nope')
+        inst = manifest.RelinkManifest(filename)
+        self.assertEqual(inst.dirs, {})
+        open(filename, 'wb').write(manifest.HEADER.pack(b'DMRELNK0', 1.0, 0))
+        inst = manifest.RelinkManifest(filename)
+        self.assertEqual(inst.dirs, {})
+        open(filename, 'wb').write(
+            manifest.HEADER.pack(manifest.MAGIC, 1.0, 1)
+            + manifest.DIR.pack(b'3A', 17, 2)
+            + b'X' * DIGEST_BYTES
+        )
+        inst = manifest.RelinkManifest(filename)
+        self.assertEqual(inst.dirs, {})
+
+    def test_update_and_save(self):
+        tmp = TempDir()
+        filename = tmp.join('manifest')
+        inst = manifest.RelinkManifest(filename)
+        self.assertIs(inst.is_clean('3A', 17), False)
+        self.assertEqual(inst.get_ids('3A'), set())
+
+        ids1 = set('3A' + random_file_id()[2:] for i in range(3))
+        ids2 = set('YY' + random_file_id()[2:] for i in range(5))
+        inst.update('3A', 1234567890123456789, ids1)
+        inst.update('YY', None, ids2)
+        inst.update('44', 17, [])
+        self.assertEqual(len(inst), 8)
+        self.assertIs(inst.is_clean('3A', 1234567890123456789), True)
+        self.assertIs(inst.is_clean('3A', 1234567890123456788), False)
+        self.assertIs(inst.is_clean('YY', manifest.DIRTY), False)
+        self.assertIs(inst.is_clean('44', 17), True)
+        self.assertEqual(inst.get_ids('3A'), ids1)
+        self.assertEqual(inst.get_ids('YY'), ids2)
+        self.assertEqual(inst.get_ids('44'), set())
+
+        inst.save()
+        inst2 = manifest.RelinkManifest(filename)
+        self.assertEqual(inst2.created, inst.created)
+        self.assertEqual(inst2.dirs, inst.dirs)
+        self.assertIs(inst2.is_clean('3A', 1234567890123456789), True)
+        self.assertIs(inst2.is_clean('YY', manifest.DIRTY), False)
+        self.assertEqual(inst2.get_ids('YY'), ids2)
+
+        inst2.reset()
+        self.assertEqual(inst2.dirs, {})
+        self.assertGreater(inst2.created, inst.created)
@@ -33,7 +33,7 @@ import shutil
 
 import filestore
 from filestore.misc import TempFileStore
-from dbase32 import random_id, isdb32
+from dbase32 import random_id, isdb32, log_id
 import microfiber
 from microfiber import Conflict
 
@@ -41,7 +41,10 @@ from dmedia.tests.base import TempDir, write_random, random_file_id
 from dmedia.tests.couch import CouchCase
 from dmedia.local import LocalStores
 from dmedia import util, schema, metastore
-from dmedia.metastore import create_stored, get_mtime
+from dmedia.metastore import create_stored, create_stored_value, get_mtime
+from dmedia.leafcache import LeafHashCache
+from dmedia.iobudget import IOBudget
+from dmedia.manifest import RelinkManifest
 from dmedia.constants import TYPE_ERROR
 from dmedia.units import bytes10
 
@@ -194,6 +197,36 @@ class DummyDatabase:
         doc[key] = value
 
 
+class CountingBudget:
+    def __init__(self):
+        self.calls = []
+
+    def consume(self, nbytes=0, ops=1):
+        self.calls.append((nbytes, ops))
+        return 0
+
+
+class RaceDatabase:
+    """
+    Wraps a Database, calling *callback* once after the first view() request.
+    """
+
+    def __init__(self, db, callback):
+        self._db = db
+        self._callback = callback
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def view(self, *args, **kw):
+        result = self._db.view(*args, **kw)
+        if self._callback is not None:
+            callback = self._callback
+            self._callback = None
+            callback()
+        return result
+
+
 class TestConstants(TestCase):
     def test_order_of_time_constants(self):
         """
@@ -475,6 +508,56 @@ class TestFunctions(TestCase):
             },
         })
 
+    def test_is_fragile(self):
+        store_ids = tuple(random_id() for i in range(3))
+        doc = {
+            'type': 'dmedia/file',
+            'origin': 'user',
+            'stored': {
+                store_ids[0]: {'copies': 2},
+                store_ids[1]: {'copies': -1},
+            },
+        }
+        self.assertIs(metastore.is_fragile(doc), True)
+        doc['stored'][store_ids[2]] = {'copies': 1}
+        self.assertIs(metastore.is_fragile(doc), False)
+        doc['stored'][store_ids[2]] = {'copies': 0}
+        self.assertIs(metastore.is_fragile(doc), True)
+        doc['origin'] = 'render'
+        self.assertIs(metastore.is_fragile(doc), False)
+        doc['origin'] = 'user'
+        doc['type'] = 'dmedia/store'
+        self.assertIs(metastore.is_fragile(doc), False)
+        self.assertIs(metastore.is_fragile({}), False)
+        self.assertIs(
+            metastore.is_fragile({'type': 'dmedia/file', 'origin': 'user'}),
+            True
+        )
+
+    def test_filter_fragile_rows(self):
+        store_id = random_id()
+        ids = tuple(random_file_id() for i in range(4))
+
+        def row(_id, copies):
+            doc = {
+                '_id': _id,
+                'type': 'dmedia/file',
+                'origin': 'user',
+                'stored': {store_id: {'copies': copies}},
+            }
+            return {'id': _id, 'doc': doc}
+
+        self.assertEqual(metastore.filter_fragile_rows([]), [])
+        rows = [
+            row(ids[0], 1),
+            row(ids[1], 3),
+            row(ids[2], 1),
+            {'id': ids[3], 'deleted': True, 'doc': {'_id': ids[3], '_deleted': True}},
+            row(ids[0], 2),
+            row(ids[2], 3),
+        ]
+        self.assertEqual(metastore.filter_fragile_rows(rows), [rows[4]])
+
     def test_get_mtime(self):
         fs = TempFileStore()
         _id = random_file_id()
@@ -1608,6 +1691,325 @@ class TestFunctions(TestCase):
             ]
         )
 
+    def test_list_filestore(self):
+        fs = TempFileStore()
+
+        # Test when empty
+        self.assertEqual(metastore.list_filestore(fs), {})
+
+        expected = {}
+        for i in range(100):
+            _id = random_file_id()
+            data = b'N' * random.randint(1, 1776)
+            open(fs.path(_id), 'wb').write(data)
+            st = fs.stat(_id)
+            expected[_id] = (len(data), int(st.mtime))
+        self.assertEqual(metastore.list_filestore(fs), expected)
+
+        # Junk names and directories should be ignored:
+        _id = random_file_id()
+        os.mkdir(fs.path(_id))
+        junk = path.join(path.dirname(fs.path(_id)), 'junk')
+        open(junk, 'wb').write(b'junk')
+        self.assertEqual(metastore.list_filestore(fs), expected)
+
+        # Each directory listing draws one op from the budget:
+        budget = CountingBudget()
+        self.assertEqual(metastore.list_filestore(fs, budget), expected)
+        self.assertEqual(budget.calls, [(0, 1)] * 1024)
+
+    def test_walk_filestore(self):
+        fs = TempFileStore()
+
+        # Test when empty:
+        dirs = metastore.walk_filestore(fs)
+        self.assertEqual(len(dirs), 1024)
+        for (prefix, mtime_ns, listing) in dirs:
+            self.assertEqual(listing, {})
+
+        expected = {}
+        for i in range(100):
+            _id = random_file_id()
+            data = b'N' * random.randint(1, 1776)
+            open(fs.path(_id), 'wb').write(data)
+            st = fs.stat(_id)
+            expected[_id] = (len(data), int(st.mtime))
+        budget = CountingBudget()
+        dirs = metastore.walk_filestore(fs, budget)
+        self.assertEqual(budget.calls, [(0, 1)] * 1024)
+        self.assertEqual(
+            [prefix for (prefix, mtime_ns, listing) in dirs],
+            [prefix for (prefix, dirname) in metastore.iter_prefixes(fs)]
+        )
+        combined = {}
+        for (prefix, mtime_ns, listing) in dirs:
+            dirname = path.join(fs.parentdir, metastore.DOTNAME, 'files',
+                prefix
+            )
+            self.assertEqual(mtime_ns, os.stat(dirname).st_mtime_ns)
+            self.assertEqual(listing, metastore.list_dir(dirname, prefix))
+            combined.update(listing)
+        self.assertEqual(combined, expected)
+
+    def test_get_physical_offset(self):
+        tmp = TempDir()
+        filename = tmp.write(b'D' * 4096, 'foo')
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            offset = metastore.get_physical_offset(fd)
+        finally:
+            os.close(fd)
+        # Not all filesystems support FIEMAP:
+        if offset is not None:
+            self.assertIsInstance(offset, int)
+            self.assertGreaterEqual(offset, 0)
+
+        # Bad file descriptor:
+        fd = os.open(filename, os.O_RDONLY)
+        os.close(fd)
+        self.assertIsNone(metastore.get_physical_offset(fd))
+
+    def test_get_layout_key(self):
+        fs = TempFileStore()
+        _id = random_file_id()
+        self.assertEqual(metastore.get_layout_key(fs, _id), (2, 0))
+        open(fs.path(_id), 'wb').write(b'D' * 4096)
+        key = metastore.get_layout_key(fs, _id)
+        self.assertIn(key[0], (0, 1))
+        if key[0] == 1:
+            self.assertEqual(key[1], os.stat(fs.path(_id)).st_ino)
+
+    def test_order_rows(self):
+        fs = TempFileStore()
+        ids = [random_file_id() for i in range(20)]
+        for _id in ids:
+            open(fs.path(_id), 'wb').write(b'D' * 4096)
+        rows = [{'id': _id} for _id in ids]
+
+        # Default is shuffled:
+        shuffled = list(rows)
+        self.assertIsNone(metastore.order_rows(fs, shuffled))
+        self.assertEqual(sorted(r['id'] for r in shuffled), sorted(ids))
+
+        # Sorted by layout key, in a random direction:
+        budget = CountingBudget()
+        ordered = list(rows)
+        self.assertIsNone(metastore.order_rows(fs, ordered, True, budget))
+        self.assertEqual(budget.calls, [(0, 20)])
+        keys = [metastore.get_layout_key(fs, r['id']) for r in ordered]
+        self.assertIn(keys, [sorted(keys), sorted(keys, reverse=True)])
+        directions = set()
+        for i in range(50):
+            metastore.order_rows(fs, ordered, True)
+            keys = [metastore.get_layout_key(fs, r['id']) for r in ordered]
+            self.assertIn(keys, [sorted(keys), sorted(keys, reverse=True)])
+            directions.add(keys == sorted(keys))
+        self.assertEqual(directions, {True, False})
+
+        # Empty:
+        empty = []
+        metastore.order_rows(fs, empty, True)
+        self.assertEqual(empty, [])
+
+    def test_verify_with_budget(self):
+        tmp = TempDir()
+        fs = TempFileStore()
+        (file, ch) = tmp.random_file()
+        self.assertEqual(fs.import_file(open(file.name, 'rb')), ch)
+        budget = CountingBudget()
+        self.assertEqual(metastore.verify_with_budget(fs, ch.id, budget), ch)
+        leaves = len(ch.leaf_hashes) // filestore.DIGEST_BYTES
+        self.assertEqual(len(budget.calls), leaves + 1)
+        self.assertEqual(sum(c[0] for c in budget.calls), ch.file_size)
+        self.assertEqual(budget.calls[-1], (0, 1))
+
+        # Missing file:
+        _id = random_file_id()
+        with self.assertRaises(filestore.FileNotFound) as cm:
+            metastore.verify_with_budget(fs, _id, CountingBudget())
+        self.assertEqual(cm.exception.id, _id)
+
+        # Corrupt file is handled by FileStore.verify():
+        with open(fs.path(ch.id), 'rb+') as fp:
+            fp.seek(ch.file_size // 2)
+            fp.write(os.urandom(16))
+        with self.assertRaises(filestore.CorruptFile) as cm:
+            metastore.verify_with_budget(fs, ch.id, CountingBudget())
+        self.assertFalse(path.exists(fs.path(ch.id)))
+
+    def test_iter_prefetch(self):
+        self.assertEqual(list(metastore.iter_prefetch([])), [])
+        items = [random_file_id() for i in range(23)]
+        self.assertEqual(list(metastore.iter_prefetch(items)), items)
+
+        # Exceptions raised by the iterable are raised in the consumer:
+        def gen():
+            yield 'foo'
+            raise ValueError('bar')
+        result = []
+        with self.assertRaises(ValueError) as cm:
+            for item in metastore.iter_prefetch(gen()):
+                result.append(item)
+        self.assertEqual(str(cm.exception), 'bar')
+        self.assertEqual(result, ['foo'])
+
+        # Stopping early:
+        it = metastore.iter_prefetch(iter(items))
+        self.assertEqual(next(it), items[0])
+        self.assertIsNone(it.close())
+
+    def test_get_bytes(self):
+        self.assertEqual(metastore.get_bytes({}), 0)
+        self.assertEqual(metastore.get_bytes({'bytes': -1}), 0)
+        self.assertEqual(metastore.get_bytes({'bytes': '1776'}), 0)
+        self.assertEqual(metastore.get_bytes({'bytes': 1776}), 1776)
+        doc = {'bytes': 'junk'}
+        self.assertEqual(metastore.get_bytes(doc), 0)
+        self.assertEqual(doc, {'bytes': 'junk'})
+
+    def test_is_reclaimable(self):
+        fs_id = random_id()
+        store_ids = tuple(random_id() for i in range(3))
+        doc = {
+            'type': 'dmedia/file',
+            'origin': 'user',
+            'stored': {
+                fs_id: {'copies': 1},
+                store_ids[0]: {'copies': 1},
+                store_ids[1]: {'copies': 1},
+                store_ids[2]: {'copies': 1},
+            },
+        }
+        self.assertIs(metastore.is_reclaimable(doc, fs_id), True)
+        self.assertIs(metastore.is_reclaimable(doc, random_id()), False)
+        doc['stored'][fs_id]['pinned'] = True
+        self.assertIs(metastore.is_reclaimable(doc, fs_id), False)
+        del doc['stored'][fs_id]['pinned']
+        doc['stored'][store_ids[2]]['copies'] = 0
+        self.assertIs(metastore.is_reclaimable(doc, fs_id), False)
+        doc['stored'][store_ids[2]]['copies'] = 2
+        self.assertIs(metastore.is_reclaimable(doc, fs_id), True)
+        doc['origin'] = 'cache'
+        self.assertIs(metastore.is_reclaimable(doc, fs_id), False)
+        doc['origin'] = 'user'
+        doc['stored'][fs_id] = 'junk'
+        self.assertIs(metastore.is_reclaimable(doc, fs_id), False)
+
+        # Negative copies, with the same arithmetic as the view: the total
+        # clamps each store at zero, but the raw copies are subtracted:
+        doc['stored'] = {
+            fs_id: {'copies': -1},
+            store_ids[0]: {'copies': 1},
+            store_ids[1]: {'copies': 1},
+            store_ids[2]: {'copies': 1},
+        }
+        self.assertIs(metastore.is_reclaimable(doc, fs_id), True)
+        self.assertIs(metastore.is_reclaimable(doc, store_ids[0]), False)
+        doc['stored'][store_ids[2]]['copies'] = 0
+        self.assertIs(metastore.is_reclaimable(doc, fs_id), False)
+        doc['stored'][fs_id]['copies'] = -2
+        self.assertIs(metastore.is_reclaimable(doc, fs_id), False)
+
+        # Floats count, but not bools:
+        doc['stored'] = {
+            fs_id: {'copies': 1},
+            store_ids[0]: {'copies': 1.0},
+            store_ids[1]: {'copies': 1},
+            store_ids[2]: {'copies': True},
+        }
+        self.assertIs(metastore.is_reclaimable(doc, fs_id), False)
+        doc['stored'][store_ids[2]]['copies'] = 1
+        self.assertIs(metastore.is_reclaimable(doc, fs_id), True)
+
+    def test_migrate_mtime(self):
+        doc = {}
+        self.assertIs(metastore.migrate_mtime(doc), False)
+        self.assertEqual(doc, {'stored': {}})
+        doc = {
+            'stored': {
+                'foo': {'copies': 1, 'mtime': 1234567890},
+                'bar': 'junk',
+            },
+        }
+        self.assertIs(metastore.migrate_mtime(doc), False)
+        doc['stored']['baz'] = {'copies': 2, 'mtime': 1234567890.5}
+        self.assertIs(metastore.migrate_mtime(doc), True)
+        self.assertEqual(doc['stored']['baz'], {'copies': 2, 'mtime': 1234567890})
+        self.assertIs(metastore.migrate_mtime(doc), False)
+
+    def test_check_file_worker(self):
+        tmp = TempDir()
+        (file, ch) = tmp.random_file()
+        stored = {random_id(): {'copies': 1, 'mtime': int(time.time())}}
+        doc = schema.create_file(time.time(), ch, stored)
+        self.assertEqual(
+            metastore.check_file_worker((doc, ch.leaf_hashes)),
+            (ch.id, [])
+        )
+
+        # Missing leaf_hashes:
+        self.assertEqual(
+            metastore.check_file_worker((doc, None)),
+            (ch.id, ['missing leaf_hashes'])
+        )
+
+        # Wrong leaf_hashes:
+        bad = os.urandom(len(ch.leaf_hashes))
+        (_id, errors) = metastore.check_file_worker((doc, bad))
+        self.assertEqual(_id, ch.id)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('RootHashError: '))
+
+        # Schema error and wrong doc['bytes']:
+        doc['bytes'] = str(ch.file_size)
+        (_id, errors) = metastore.check_file_worker((doc, ch.leaf_hashes))
+        self.assertEqual(_id, ch.id)
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(errors[0].startswith('TypeError: '))
+
+    def test_sweep_downgrade_by_view(self):
+        doc = {'stored': {'foo': {'copies': 1, 'verified': 123}, 'bar': 1}}
+        self.assertIsNone(
+            metastore.sweep_downgrade_by_view(doc, {'value': 'foo'})
+        )
+        self.assertEqual(doc,
+            {'stored': {'foo': {'copies': 0, 'verified': 123}, 'bar': 1}}
+        )
+
+        # Missing and broken values should be left alone:
+        metastore.sweep_downgrade_by_view(doc, {'value': 'baz'})
+        metastore.sweep_downgrade_by_view(doc, {'value': 'bar'})
+        self.assertEqual(doc,
+            {'stored': {'foo': {'copies': 0, 'verified': 123}, 'bar': 1}}
+        )
+        doc = {}
+        metastore.sweep_downgrade_by_view(doc, {'value': 'foo'})
+        self.assertEqual(doc, {'stored': {}})
+
+    def test_sweep_downgrade_store(self):
+        doc = {'stored': {'foo': {'copies': 1, 'verified': 123}, 'bar': 1}}
+        self.assertIsNone(
+            metastore.sweep_downgrade_store(doc, {'key': 'foo'})
+        )
+        self.assertEqual(doc, {'stored': {'foo': {'copies': 0}, 'bar': 1}})
+        metastore.sweep_downgrade_store(doc, {'key': 'bar'})
+        self.assertEqual(doc, {'stored': {'foo': {'copies': 0}, 'bar': 1}})
+
+    def test_sweep_purge_store(self):
+        doc = {'stored': {'foo': {'copies': 1}, 'bar': {'copies': 2}}}
+        self.assertIsNone(metastore.sweep_purge_store(doc, {'key': 'foo'}))
+        self.assertEqual(doc, {'stored': {'bar': {'copies': 2}}})
+        metastore.sweep_purge_store(doc, {'key': 'foo'})
+        self.assertEqual(doc, {'stored': {'bar': {'copies': 2}}})
+
+    def test_apply_rows(self):
+        doc = {'stored': {'foo': {'copies': 1}, 'bar': {'copies': 2}}}
+        rows = [{'key': 'foo'}, {'key': 'bar'}]
+        self.assertIsNone(
+            metastore.apply_rows(doc, metastore.sweep_purge_store, rows)
+        )
+        self.assertEqual(doc, {'stored': {}})
+
 
 class TestBufferedSave(CouchCase):
     def test_init(self):
@@ -1701,6 +2103,291 @@ class TestBufferedSave(CouchCase):
                 self.assertEqual(db.get(doc['_id']), doc)
 
 
+class TestLogWriter(CouchCase):
+    def test_init(self):
+        db = util.get_db(self.env, True)
+        writer = metastore.LogWriter(db)
+        self.assertIs(writer.db, db)
+        self.assertEqual(writer.size, 50)
+        self.assertEqual(writer.timeout, 5)
+        self.assertEqual(writer.docs, [])
+        self.assertEqual(writer.count, 0)
+        self.assertIsNone(writer.timer)
+
+    def test_write(self):
+        db = util.get_db(self.env, True)
+        writer = metastore.LogWriter(db, size=10, timeout=60)
+        base = time.time()
+        docs = [
+            {'_id': log_id(base + i), 'time': base + i} for i in range(10)
+        ]
+        ids = [doc['_id'] for doc in docs]
+        self.assertEqual(ids, sorted(ids))
+
+        # Written out of order, and not saved till the 10th is written:
+        for doc in reversed(docs[1:]):
+            writer.write(doc)
+            self.assertIsNotNone(writer.timer)
+        self.assertEqual(db.get_many(ids), [None for doc in docs])
+        self.assertEqual(writer.count, 0)
+        writer.write(docs[0])
+        self.assertEqual(writer.docs, [])
+        self.assertIsNone(writer.timer)
+        self.assertEqual(writer.count, 10)
+        self.assertEqual(db.get_many(ids), docs)
+
+        # Saved in order of _id:
+        changes = db.get('_changes')['results']
+        self.assertEqual([row['id'] for row in changes], ids)
+
+        # Explicit flush:
+        doc = {'_id': log_id(), 'time': time.time()}
+        writer.write(doc)
+        self.assertEqual(writer.docs, [doc])
+        self.assertIsNone(writer.flush())
+        self.assertEqual(writer.docs, [])
+        self.assertIsNone(writer.timer)
+        self.assertEqual(writer.count, 11)
+        self.assertEqual(db.get(doc['_id']), doc)
+        writer.flush()
+        self.assertEqual(writer.count, 11)
+
+        # Written with flush, along with those already buffered:
+        docs = [
+            {'_id': log_id(base + 20 + i), 'time': base + 20 + i}
+            for i in range(2)
+        ]
+        writer.write(docs[1])
+        self.assertIsNotNone(writer.timer)
+        writer.write(docs[0], flush=True)
+        self.assertEqual(writer.docs, [])
+        self.assertIsNone(writer.timer)
+        self.assertEqual(writer.count, 13)
+        self.assertEqual(db.get_many([d['_id'] for d in docs]), docs)
+        changes = db.get('_changes')['results']
+        self.assertEqual([row['id'] for row in changes[-2:]],
+            [d['_id'] for d in docs]
+        )
+
+    def test_timeout(self):
+        db = util.get_db(self.env, True)
+        writer = metastore.LogWriter(db, timeout=0.25)
+        doc = {'_id': log_id(), 'time': time.time()}
+        writer.write(doc)
+        timer = writer.timer
+        self.assertIsNotNone(timer)
+        timer.join()
+        self.assertEqual(writer.docs, [])
+        self.assertEqual(writer.count, 1)
+        self.assertEqual(db.get(doc['_id']), doc)
+
+
+class TestCouchFunctions(CouchCase):
+    def test_iter_view_pages(self):
+        db = util.get_db(self.env, True)
+        fs = TempFileStore()
+
+        # Test when empty:
+        self.assertEqual(
+            list(metastore.iter_view_pages(db, 'file', 'stored', key=fs.id)),
+            []
+        )
+
+        docs = [create_random_file(fs, db) for i in range(40)]
+        ids = sorted(d['_id'] for d in docs)
+        pages = list(
+            metastore.iter_view_pages(db, 'file', 'stored', 17, key=fs.id)
+        )
+        self.assertEqual([len(rows) for rows in pages], [17, 16, 7])
+        self.assertEqual([r['id'] for rows in pages for r in rows], ids)
+
+        # Rows dropping out of the view mid-iteration shouldn't shift pages:
+        seen = []
+        for rows in metastore.iter_view_pages(db, 'file', 'stored', 10,
+                key=fs.id, include_docs=True):
+            for row in rows:
+                seen.append(row['id'])
+                doc = row['doc']
+                doc['stored'] = {}
+                db.save(doc)
+        self.assertEqual(seen, ids)
+        self.assertEqual(
+            db.view('file', 'stored', key=fs.id)['rows'],
+            []
+        )
+
+        # Range views use startkey + startkey_docid:
+        docs = [create_random_file(fs, db) for i in range(30)]
+        ids = sorted(d['_id'] for d in docs)
+        pages = list(metastore.iter_view_pages(db, 'file', 'store-mtime', 8,
+            startkey=[fs.id, None],
+            endkey=[fs.id, int(time.time()) + 1],
+        ))
+        self.assertEqual(
+            sorted(r['id'] for rows in pages for r in rows),
+            ids
+        )
+
+    def test_bulk_update(self):
+        db = util.get_db(self.env, True)
+        fs = TempFileStore()
+
+        # Test when empty:
+        self.assertEqual(metastore.bulk_update(db, metastore.mark_removed, []), 0)
+
+        docs = [create_random_file(fs, db) for i in range(10)]
+        for doc in docs[:3]:
+            db.save(deepcopy(doc))
+        items = [(doc, (fs.id,)) for doc in docs]
+        self.assertEqual(
+            metastore.bulk_update(db, metastore.mark_removed, items), 3
+        )
+        for (i, doc) in enumerate(docs):
+            doc = db.get(doc['_id'])
+            rev = ('3-' if i < 3 else '2-')
+            self.assertTrue(doc['_rev'].startswith(rev))
+            self.assertEqual(doc['stored'], {})
+
+
+class TestSweep(CouchCase):
+    def test_run(self):
+        db = util.get_db(self.env, True)
+        store_id1 = random_id()
+        store_id2 = random_id()
+
+        # Test when empty:
+        sweep = metastore.Sweep(db, 'file', 'stored',
+            metastore.sweep_purge_store, batch_size=7, key=store_id1
+        )
+        self.assertEqual(sweep.run(), 0)
+        self.assertEqual(sweep.rows, 0)
+        self.assertEqual(sweep.conflicts, 0)
+
+        docs = []
+        for i in range(50):
+            doc = {
+                '_id': random_file_id(),
+                'type': 'dmedia/file',
+                'bytes': 1776,
+                'stored': {
+                    store_id1: {'copies': 1, 'mtime': 123},
+                    store_id2: {'copies': 2, 'mtime': 456},
+                },
+            }
+            docs.append(doc)
+        db.save_many(docs)
+
+        # Several pages, and only the store_id1 entries should be removed:
+        sweep = metastore.Sweep(db, 'file', 'stored',
+            metastore.sweep_purge_store, batch_size=7, key=store_id1
+        )
+        self.assertEqual(sweep.run(), 50)
+        self.assertEqual(sweep.rows, 50)
+        self.assertEqual(sweep.conflicts, 0)
+        self.assertIsInstance(sweep.delta, float)
+        self.assertIsInstance(sweep.rate(), int)
+        for doc in docs:
+            doc = db.get(doc['_id'])
+            self.assertTrue(doc['_rev'].startswith('2-'))
+            self.assertEqual(doc['stored'],
+                {store_id2: {'copies': 2, 'mtime': 456}}
+            )
+        self.assertEqual(
+            db.view('file', 'stored', key=store_id1)['rows'], []
+        )
+
+        # Nothing left in the view:
+        sweep = metastore.Sweep(db, 'file', 'stored',
+            metastore.sweep_purge_store, batch_size=7, key=store_id1
+        )
+        self.assertEqual(sweep.run(), 0)
+
+
+class TestVerifyPipeline(CouchCase):
+    def test_run(self):
+        db = util.get_db(self.env, True)
+        ms = metastore.MetaStore(db)
+        fs = TempFileStore()
+        curtime = int(time.time())
+
+        # Test when empty:
+        pipeline = metastore.VerifyPipeline(ms, fs)
+        self.assertEqual(pipeline.run(curtime), (0, 0))
+        self.assertEqual(pipeline.read_stats.count, 0)
+        self.assertEqual(pipeline.commit_stats.count, 0)
+
+        # Some downgraded files:
+        downgraded = [create_random_file(fs, db) for i in range(20)]
+        for doc in downgraded:
+            doc['stored'][fs.id]['copies'] = 0
+        db.save_many(downgraded)
+
+        # A missing file:
+        missing = create_random_file(fs, db)
+        missing['stored'][fs.id]['copies'] = 0
+        db.save(missing)
+        fs.remove(missing['_id'])
+
+        # A corrupt file:
+        corrupt = create_random_file(fs, db)
+        corrupt['stored'][fs.id]['copies'] = 0
+        db.save(corrupt)
+        with open(fs.path(corrupt['_id']), 'rb+') as fp:
+            fp.write(b'corrupt')
+
+        everything = downgraded + [missing, corrupt]
+        pipeline = metastore.VerifyPipeline(ms, fs, readahead=2, batch_size=7)
+        self.assertEqual(pipeline.run(curtime),
+            (22, sum(d['bytes'] for d in everything))
+        )
+        self.assertEqual(pipeline.fetch_stats.count, 22)
+        self.assertEqual(pipeline.read_stats.count, 22)
+        self.assertEqual(pipeline.read_stats.size,
+            sum(d['bytes'] for d in everything)
+        )
+        self.assertEqual(pipeline.commit_stats.count, 22)
+        self.assertEqual(pipeline.pending, [])
+        for doc in downgraded:
+            doc = db.get(doc['_id'])
+            self.assertTrue(doc['_rev'].startswith('3-'))
+            value = doc['stored'][fs.id]
+            self.assertEqual(value['copies'], 1)
+            self.assertGreaterEqual(value['verified'], curtime)
+        doc = db.get(missing['_id'])
+        self.assertEqual(doc['stored'], {})
+        doc = db.get(corrupt['_id'])
+        self.assertEqual(doc['stored'], {})
+        self.assertEqual(set(doc['corrupt']), set([fs.id]))
+
+        # Nothing left to verify:
+        pipeline = metastore.VerifyPipeline(ms, fs)
+        self.assertEqual(pipeline.run(curtime), (0, 0))
+
+    def test_flush(self):
+        db = util.get_db(self.env, True)
+        ms = metastore.MetaStore(db)
+        fs = TempFileStore()
+        docs = [create_random_file(fs, db) for i in range(4)]
+        for doc in docs:
+            doc['stored'][fs.id]['copies'] = 0
+
+        # A conflicting change should be re-tried with Database.update():
+        db.save(deepcopy(docs[0]))
+        pipeline = metastore.VerifyPipeline(ms, fs)
+        for doc in docs:
+            value = create_stored_value(doc['_id'], fs, time.time())
+            pipeline.pending.append((doc, value))
+        pipeline.flush()
+        self.assertEqual(pipeline.pending, [])
+        self.assertEqual(pipeline.commit_stats.count, 4)
+        for (i, doc) in enumerate(docs):
+            doc = db.get(doc['_id'])
+            rev = ('3-' if i == 0 else '2-')
+            self.assertTrue(doc['_rev'].startswith(rev))
+            self.assertEqual(doc['stored'][fs.id]['copies'], 1)
+            self.assertIsInstance(doc['stored'][fs.id]['verified'], int)
+
+
 class TestMetaStore(CouchCase):
     def test_init(self):
         db = util.get_db(self.env, True)
@@ -1719,6 +2406,30 @@ class TestMetaStore(CouchCase):
         self.assertEqual(repr(ms), 'MetaStore({!r})'.format(db))
         self.assertIs(ms.machine_id, self.env['machine_id'])
 
+    def test_get_budget(self):
+        db = util.get_db(self.env, True)
+        ms = metastore.MetaStore(db)
+        self.assertEqual(ms.budgets, {})
+
+        # When the store doc isn't in the DB, fs.doc is used:
+        fs1 = TempFileStore()
+        budget = ms.get_budget(fs1)
+        self.assertIsInstance(budget, IOBudget)
+        self.assertEqual(budget.store_id, fs1.id)
+        self.assertIsNone(budget.bytes)
+        self.assertIsNone(budget.iops)
+        self.assertIs(ms.get_budget(fs1), budget)
+
+        # Config from the store doc in the DB:
+        fs2 = TempFileStore()
+        doc = deepcopy(fs2.doc)
+        doc['io_budget'] = {'bytes_per_sec': 1000, 'iops': 0}
+        db.save(doc)
+        budget = ms.get_budget(fs2)
+        self.assertEqual(budget.bytes.rate, 1000)
+        self.assertIsNone(budget.iops)
+        self.assertEqual(ms.budgets, {fs1.id: ms.budgets[fs1.id], fs2.id: budget})
+
     def test_log(self):
         db = util.get_db(self.env, True)
         log_db = db.database('log-1')
@@ -1727,6 +2438,9 @@ class TestMetaStore(CouchCase):
 
         ts = time.time()
         doc = ms.log(ts, 'dmedia/test')
+        with self.assertRaises(microfiber.NotFound):
+            log_db.get(doc['_id'])
+        ms.flush_log()
         self.assertEqual(doc, log_db.get(doc['_id']))
         self.assertEqual(doc['_rev'][:2], '1-')
         self.assertEqual(doc,
@@ -1741,6 +2455,7 @@ class TestMetaStore(CouchCase):
 
         ts = time.time()
         doc = ms.log(ts, 'dmedia/test2', foo='bar', stuff='junk')
+        ms.flush_log()
         self.assertEqual(doc, log_db.get(doc['_id']))
         self.assertEqual(doc['_rev'][:2], '1-')
         self.assertEqual(doc,
@@ -1765,6 +2480,7 @@ class TestMetaStore(CouchCase):
 
         ts = time.time()
         doc = ms.log_file_corrupt(ts, fs, _id)
+        # Saved right away, without a flush_log():
         self.assertEqual(doc, log_db.get(doc['_id']))
         self.assertEqual(doc['_rev'][:2], '1-')
         self.assertEqual(doc,
@@ -1790,6 +2506,7 @@ class TestMetaStore(CouchCase):
         store_id = random_id()
         timestamp = time.time()
         doc = ms.log_store_purge(timestamp, store_id, 3469)
+        # Saved right away, without a flush_log():
         self.assertEqual(doc, log_db.get(doc['_id']))
         self.assertEqual(doc['_rev'][:2], '1-')
         self.assertEqual(doc,
@@ -1812,6 +2529,7 @@ class TestMetaStore(CouchCase):
         store_id = random_id()
         timestamp = time.time()
         doc = ms.log_store_downgrade(timestamp, store_id, 3469)
+        # Saved right away, without a flush_log():
         self.assertEqual(doc, log_db.get(doc['_id']))
         self.assertEqual(doc['_rev'][:2], '1-')
         self.assertEqual(doc,
@@ -1903,6 +2621,37 @@ class TestMetaStore(CouchCase):
         with self.assertRaises(filestore.RootHashError):
             ms.content_hash(doc)
 
+    def test_content_hash_with_leaf_cache(self):
+        db = util.get_db(self.env, True)
+        tmp = TempDir()
+        cache = LeafHashCache(tmp.join('leaf-hashes'))
+        ms = metastore.MetaStore(db, leaf_cache=cache)
+        self.assertIs(ms.leaf_cache, cache)
+        fs = TempFileStore()
+        doc = create_random_file(fs, db)
+        _id = doc['_id']
+        leaf_hashes = db.get_att(_id, 'leaf_hashes').data
+        unpacked = tuple(filestore.iter_leaf_hashes(leaf_hashes))
+        ch = ms.content_hash(doc)
+        self.assertEqual(ch, filestore.ContentHash(_id, doc['bytes'], unpacked))
+        self.assertEqual(len(cache), 1)
+
+        # Now served from the cache, even with the attachment gone:
+        doc = db.get(_id)
+        db.delete(_id, 'leaf_hashes', rev=doc['_rev'])
+        ch = ms.content_hash(doc)
+        self.assertEqual(ch, filestore.ContentHash(_id, doc['bytes'], unpacked))
+        self.assertIsInstance(ch.leaf_hashes[0], memoryview)
+        ch = ms.content_hash(doc, unpack=False)
+        self.assertEqual(ch,
+            filestore.ContentHash(_id, doc['bytes'], leaf_hashes)
+        )
+
+        # Wrong doc['bytes'] misses the cache:
+        doc['bytes'] += 1
+        with self.assertRaises(microfiber.NotFound):
+            ms.content_hash(doc)
+
     def test_get_machine(self):
         db = util.get_db(self.env, True)
         ms = metastore.MetaStore(db)
@@ -2043,6 +2792,8 @@ class TestMetaStore(CouchCase):
         db = util.get_db(self.env, True)
         ms = metastore.MetaStore(db)
         self.assertEqual(ms.schema_check(), 0)
+        with self.assertRaises(microfiber.NotFound):
+            db.get('_local/schema-check')
         store_id1 = random_id()
         store_id2 = random_id()
 
@@ -2150,6 +2901,32 @@ class TestMetaStore(CouchCase):
         # Once more with feeling:
         self.assertEqual(ms.schema_check(), 0)
 
+        # The checkpoint should be saved:
+        checkpoint = db.get('_local/schema-check')
+        self.assertEqual(checkpoint['last_seq'], db.get()['update_seq'])
+
+        # None of these docs have leaf_hashes, so all should be logged:
+        rows = ms.log_db.get('_all_docs', include_docs=True)['rows']
+        invalid = [
+            r['doc'] for r in rows if r['doc']['type'] == 'dmedia/file/invalid'
+        ]
+        self.assertEqual(
+            set(d['file_id'] for d in invalid),
+            set(d['_id'] for d in good + bad + tricky)
+        )
+        for doc in invalid:
+            self.assertIn('missing leaf_hashes', doc['errors'])
+
+        # Only docs changed since the checkpoint are checked:
+        doc = good[0]
+        doc['stored'][store_id1]['mtime'] = time.time()
+        db.save(doc)
+        self.assertEqual(ms.schema_check(), 1)
+        self.assertEqual(db.get(doc['_id'])['stored'][store_id1]['mtime'],
+            int(doc['stored'][store_id1]['mtime'])
+        )
+        self.assertEqual(ms.schema_check(), 0)
+
     def test_downgrade_by_mtime(self):
         db = util.get_db(self.env, True)
         ms = metastore.MetaStore(db)
@@ -3084,6 +3861,96 @@ class TestMetaStore(CouchCase):
         self.assertIsInstance(atime, int)
         self.assertLessEqual(atime, int(time.time()))
 
+    def test_scan_by_listing(self):
+        db = util.get_db(self.env, True)
+        ms = metastore.MetaStore(db)
+        fs = TempFileStore()
+        db.save(fs.doc)
+
+        # Test when empty:
+        self.assertEqual(ms.scan_by_listing(fs), 0)
+        doc = db.get(fs.id)
+        self.assertTrue(doc['_rev'].startswith('2-'))
+
+        # A few good files
+        good = [create_random_file(fs, db) for i in range(45)]
+
+        # A few files with bad mtime
+        bad_mtime = [create_random_file(fs, db) for i in range(20)]
+        for doc in bad_mtime:
+            value = doc['stored'][fs.id]
+            value['mtime'] -= 100
+            value['verified'] = 1234567890
+            value['pinned'] = True
+        db.save_many(bad_mtime)
+
+        # A few files with bad size
+        bad_size = [create_random_file(fs, db) for i in range(30)]
+        for doc in bad_size:
+            doc['bytes'] += 1776
+        db.save_many(bad_size)
+
+        # A few missing files
+        missing = [create_random_file(fs, db) for i in range(15)]
+        for doc in missing:
+            fs.remove(doc['_id'])
+
+        # Use a small page size so the rows moving out of the file/stored view
+        # are spread across several pages:
+        self.assertEqual(ms.scan_by_listing(fs, size=17), 110)
+
+        for doc in good:
+            self.assertEqual(db.get(doc['_id']), doc)
+            self.assertTrue(doc['_rev'].startswith('1-'))
+
+        for doc in bad_mtime:
+            _id = doc['_id']
+            doc = db.get(_id)
+            self.assertTrue(doc['_rev'].startswith('3-'))
+            self.assertEqual(doc['stored'],
+                {
+                    fs.id: {
+                        'copies': 0,
+                        'mtime': get_mtime(fs, _id),
+                        'pinned': True,
+                    },
+                }
+            )
+
+        for doc in bad_size:
+            _id = doc['_id']
+            doc = db.get(_id)
+            self.assertTrue(doc['_rev'].startswith('3-'))
+            self.assertEqual(doc['stored'], {})
+            ts = doc['corrupt'][fs.id]['time']
+            self.assertIsInstance(ts, float)
+            self.assertLessEqual(ts, time.time())
+            self.assertFalse(path.exists(fs.path(_id)))
+            self.assertTrue(path.isfile(fs.corrupt_path(_id)))
+
+        for doc in missing:
+            _id = doc['_id']
+            doc = db.get(_id)
+            self.assertTrue(doc['_rev'].startswith('2-'))
+            self.assertEqual(doc['stored'], {})
+
+        doc = db.get(fs.id)
+        self.assertTrue(doc['_rev'].startswith('3-'))
+        self.assertIn('bytes_avail', doc)
+        self.assertLessEqual(doc['atime'], int(time.time()))
+
+        # Everything should now be consistent:
+        self.assertEqual(ms.scan_by_listing(fs), 65)
+        for doc in good:
+            self.assertEqual(db.get(doc['_id']), doc)
+
+        # A file added after the listing was made isn't wrongly removed:
+        listing = metastore.list_filestore(fs)
+        late = create_random_file(fs, db)
+        self.assertNotIn(late['_id'], listing)
+        self.assertEqual(ms._scan_listing(fs, listing), 66)
+        self.assertEqual(db.get(late['_id']), late)
+
     def test_relink(self):
         db = util.get_db(self.env, True)
         ms = metastore.MetaStore(db)
@@ -3118,6 +3985,145 @@ class TestMetaStore(CouchCase):
             )
         self.assertEqual(ms.relink(fs), 0)
 
+    def test_relink_with_manifest(self):
+        db = util.get_db(self.env, True)
+        ms = metastore.MetaStore(db)
+        fs = TempFileStore()
+        tmp = TempDir()
+        manifest = RelinkManifest(tmp.join('manifest'))
+
+        def backdate_dirs():
+            old = time.time() - 10
+            for (prefix, dirname) in metastore.iter_prefixes(fs):
+                os.utime(dirname, (old, old))
+
+        good = [create_random_file(fs, db) for i in range(8)]
+        missing = [create_random_file(fs, db) for i in range(18)]
+        for doc in missing:
+            doc['stored'] = {}
+            db.save(doc)
+        backdate_dirs()
+
+        # First run lists every directory:
+        self.assertEqual(ms.relink(fs, manifest), 18)
+        self.assertTrue(path.isfile(manifest.filename))
+        for doc in missing:
+            doc = db.get(doc['_id'])
+            self.assertTrue(doc['_rev'].startswith('3-'))
+            self.assertEqual(doc['stored'],
+                {fs.id: {'copies': 0, 'mtime': get_mtime(fs, doc['_id'])}}
+            )
+
+        # Relinked files are confirmed by the next run:
+        self.assertEqual(len(manifest), 8)
+        self.assertEqual(ms.relink(fs, manifest), 0)
+        self.assertEqual(len(manifest), 26)
+        self.assertEqual(RelinkManifest(manifest.filename).dirs, manifest.dirs)
+
+        # Now every directory is clean, so nothing is listed or requested:
+        class NoGetMany:
+            def __init__(self, db):
+                self._db = db
+
+            def __getattr__(self, name):
+                return getattr(self._db, name)
+
+            def get_many(self, ids):
+                raise Exception('get_many() called')
+
+        ms.db = NoGetMany(db)
+        self.assertEqual(ms.relink(fs, manifest), 0)
+
+        # A new file changes its directory mtime, so only it gets requested:
+        ms.db = db
+        doc = create_random_file(fs, db)
+        doc['stored'] = {}
+        db.save(doc)
+        self.assertEqual(ms.relink(fs, manifest), 1)
+        self.assertEqual(db.get(doc['_id'])['stored'],
+            {fs.id: {'copies': 0, 'mtime': get_mtime(fs, doc['_id'])}}
+        )
+
+        # A doc unlinked while its file remains is found after RELINK_FULL:
+        doc = db.get(good[0]['_id'])
+        doc['stored'] = {}
+        db.save(doc)
+        backdate_dirs()
+        self.assertEqual(ms.relink(fs, manifest), 0)
+        self.assertEqual(ms.relink(fs, manifest), 0)
+        manifest.created -= metastore.RELINK_FULL + 1
+        self.assertEqual(ms.relink(fs, manifest), 1)
+        self.assertEqual(db.get(doc['_id'])['stored'],
+            {fs.id: {'copies': 0, 'mtime': get_mtime(fs, doc['_id'])}}
+        )
+
+    def test_scan_relink_verify(self):
+        db = util.get_db(self.env, True)
+        ms = metastore.MetaStore(db)
+        fs = TempFileStore()
+        db.save(fs.doc)
+        tmp = TempDir()
+        manifest = RelinkManifest(tmp.join('manifest'))
+        curtime = int(time.time())
+
+        # Test when empty:
+        times = ms.scan_relink_verify(fs, curtime)
+        self.assertEqual(set(times),
+            {'walk', 'scan', 'relink', 'verify', 'total'}
+        )
+        for delta in times.values():
+            self.assertIsInstance(delta, float)
+            self.assertGreaterEqual(delta, 0)
+            self.assertLessEqual(delta, times['total'])
+
+        # A few good files
+        good = [create_random_file(fs, db) for i in range(10)]
+
+        # A few files already downgraded
+        downgraded = [create_random_file(fs, db) for i in range(10)]
+        for doc in downgraded:
+            doc['stored'][fs.id]['copies'] = 0
+        db.save_many(downgraded)
+
+        # A few files with bad mtime, downgraded by the scan
+        bad_mtime = [create_random_file(fs, db) for i in range(10)]
+        for doc in bad_mtime:
+            doc['stored'][fs.id]['mtime'] -= 100
+        db.save_many(bad_mtime)
+
+        # A few files to relink
+        unlinked = [create_random_file(fs, db) for i in range(10)]
+        for doc in unlinked:
+            doc['stored'] = {}
+        db.save_many(unlinked)
+
+        # A few missing files
+        missing = [create_random_file(fs, db) for i in range(5)]
+        for doc in missing:
+            fs.remove(doc['_id'])
+
+        times = ms.scan_relink_verify(fs, curtime, manifest=manifest)
+        self.assertEqual(set(times),
+            {'walk', 'scan', 'relink', 'verify', 'total'}
+        )
+        self.assertTrue(path.isfile(manifest.filename))
+        for doc in good:
+            self.assertEqual(db.get(doc['_id']), doc)
+        for doc in downgraded + bad_mtime + unlinked:
+            _id = doc['_id']
+            doc = db.get(_id)
+            value = doc['stored'][fs.id]
+            self.assertEqual(value['copies'], 1)
+            self.assertEqual(value['mtime'], get_mtime(fs, _id))
+            self.assertGreaterEqual(value['verified'], curtime)
+        for doc in missing:
+            self.assertEqual(db.get(doc['_id'])['stored'], {})
+
+        # Everything should now be consistent:
+        ms.scan_relink_verify(fs, curtime, manifest=manifest)
+        for doc in good:
+            self.assertEqual(db.get(doc['_id']), doc)
+
     def test_remove(self):
         db = util.get_db(self.env, True)
         ms = metastore.MetaStore(db)
@@ -3241,6 +4247,8 @@ class TestMetaStore(CouchCase):
         self.assertEqual(fs1.verify(ch.id), ch)
         self.assertEqual(fs2.verify(ch.id), ch)
         self.assertEqual(fs3.verify(ch.id), ch)
+        self.assertEqual(ms.copy_stats.count, 1)
+        self.assertEqual(ms.copy_stats.size, ch.file_size)
 
         # File is corrupt:
         filename = fs1.path(ch.id)
@@ -3845,6 +4853,20 @@ class TestMetaStore(CouchCase):
         self.assertEqual(ms.verify_all(fs, 0), (0, 0))
         self.assertEqual(db.get_many(ids), docs)
 
+        # Same again, but with the batches ordered by layout:
+        for doc in docs:
+            doc['stored'][fs.id]['copies'] = 0
+            del doc['stored'][fs.id]['verified']
+        db.save_many(docs)
+        self.assertEqual(ms.verify_all(fs, 0, layout=True),
+            (6, sum(d['bytes'] for d in docs))
+        )
+        for doc in db.get_many(ids):
+            self.assertTrue(doc['_rev'].startswith('11-'))
+            self.assertEqual(doc['stored'][fs.id]['copies'], 1)
+            self.assertIsInstance(doc['stored'][fs.id]['verified'], int)
+        self.assertEqual(ms.verify_all(fs, 0, layout=True), (0, 0))
+
     def test_finish_download(self):
         db = util.get_db(self.env, True)
         ms = metastore.MetaStore(db)
@@ -4142,6 +5164,98 @@ class TestMetaStore(CouchCase):
             self.assertEqual(sorted(result, key=doc_id), docs_n)
             self.assertEqual(list(ms.iter_files_at_rank(n)), [])
 
+    def test_recheck_ranks(self):
+        db = util.get_db(self.env, True)
+        ms = metastore.MetaStore(db)
+        self.assertEqual(ms.recheck_ranks([]), [])
+        store_ids = tuple(random_id() for i in range(3))
+        docs = [
+            build_file_at_rank(random_file_id(), 1, store_ids)
+            for i in range(4)
+        ]
+        db.save_many(docs)
+        stale = deepcopy(docs)
+        self.assertEqual(ms.recheck_ranks(stale, 1),
+            [db.get(doc['_id']) for doc in docs]
+        )
+
+        # docs[0]: rank increased since the doc was read
+        # docs[1]: rank decreased, so the current doc is returned
+        # docs[2]: deleted
+        # docs[3]: unchanged
+        docs[0]['stored'] = build_stored_at_rank(2, store_ids)
+        docs[1]['stored'] = build_stored_at_rank(0, store_ids)
+        docs[2]['_deleted'] = True
+        db.save_many(docs[:3])
+        self.assertEqual(ms.recheck_ranks(stale, 1),
+            [None, db.get(docs[1]['_id']), None, db.get(docs[3]['_id'])]
+        )
+        self.assertEqual(ms.recheck_ranks(stale, 2),
+            [
+                db.get(docs[0]['_id']),
+                db.get(docs[1]['_id']),
+                None,
+                db.get(docs[3]['_id']),
+            ]
+        )
+
+        # Without *rank*, each doc is checked against its own stale rank:
+        stale[3]['stored'] = build_stored_at_rank(0, store_ids)
+        self.assertEqual(ms.recheck_ranks(stale),
+            [None, db.get(docs[1]['_id']), None, None]
+        )
+
+        # One request for the whole batch:
+        calls = []
+        get_many = db.get_many
+        db.get_many = lambda ids: calls.append(ids) or get_many(ids)
+        ms.recheck_ranks(stale)
+        self.assertEqual(calls, [[doc['_id'] for doc in stale]])
+
+    def test_iter_rank_pages(self):
+        db = util.get_db(self.env, True)
+        ms = metastore.MetaStore(db)
+        self.assertEqual(list(ms.iter_rank_pages(0)), [])
+        with self.assertRaises(ValueError) as cm:
+            list(ms.iter_rank_pages(6))
+        self.assertEqual(str(cm.exception), 'Need 0 <= rank <= 5; got 6')
+
+        docs = [
+            {
+                '_id': random_file_id(),
+                'type': 'dmedia/file',
+                'origin': 'user',
+                'stored': {},
+            }
+            for i in range(120)
+        ]
+        db.save_many(docs)
+        docs.sort(key=doc_id)
+        ids = [d['_id'] for d in docs]
+
+        pages = list(ms.iter_rank_pages(0))
+        self.assertEqual([last_id for (last_id, page) in pages],
+            [ids[49], ids[98], ids[119]]
+        )
+        self.assertEqual([len(page) for (last_id, page) in pages], [50, 49, 21])
+        result = []
+        for (last_id, page) in pages:
+            result.extend(page)
+        self.assertEqual(sorted(result, key=doc_id), docs)
+
+        # Resume after the first page:
+        pages = list(ms.iter_rank_pages(0, ids[49]))
+        self.assertEqual([last_id for (last_id, page) in pages],
+            [ids[98], ids[119]]
+        )
+        result = []
+        for (last_id, page) in pages:
+            result.extend(page)
+        self.assertEqual(sorted(result, key=doc_id), docs[50:])
+
+        # Resume after the last page:
+        self.assertEqual(list(ms.iter_rank_pages(0, ids[119])), [])
+
         # Double check that rank 0 through 5 are still returning no docs:
         self.assertEqual(list(ms.iter_files_at_rank(0)), [])
         self.assertEqual(list(ms.iter_files_at_rank(1)), [])
@@ -4178,21 +5292,18 @@ class TestMetaStore(CouchCase):
             self.assertNotEqual(result, docs)  # Due to random.shuffle()
             self.assertEqual(sorted(result, key=doc_id), docs)
 
-            # Adjust 17 files to rank+1 after the first doc is yielded:
-            include = None
-            result = []
-            for doc in ms.iter_files_at_rank(rank):
-                result.append(doc)
-                if include is None:
-                    include = {doc['_id']}
-                    remaining = set(ids) - include
-                    remove = random.sample(remaining, 17)
-                    include.update(remaining - set(remove))
-                    rdocs = [dmap[_id] for _id in remove]
-                    for rdoc in rdocs:
-                        rdoc['stored'] = build_stored_at_rank(rank + 1, store_ids)
-                        self.assertEqual(metastore.get_rank(rdoc), rank + 1)
-                    db.save_many(rdocs)
+            # Adjust 17 files to rank+1 after the view is read, but before the
+            # docs are fetched:
+            remove = random.sample(ids, 17)
+            include = set(ids) - set(remove)
+            rdocs = [dmap[_id] for _id in remove]
+            for rdoc in rdocs:
+                rdoc['stored'] = build_stored_at_rank(rank + 1, store_ids)
+                self.assertEqual(metastore.get_rank(rdoc), rank + 1)
+            racing = metastore.MetaStore(
+                RaceDatabase(db, lambda: db.save_many(rdocs))
+            )
+            result = list(racing.iter_files_at_rank(rank))
             expected = [dmap[_id] for _id in include]
             expected.sort(key=doc_id)
             self.assertEqual(len(expected), 33)
@@ -4334,6 +5445,31 @@ class TestMetaStore(CouchCase):
             })
             last_seq = result['last_seq']
 
+        # Several changes in one batch, only fragile docs are returned, and
+        # only once each:
+        for doc in docs:
+            doc['stored'][stores[0]] = {'copies': 1}
+        db.save_many(docs)
+        docs[0]['stored'][stores[0]]['copies'] = 0
+        db.save(docs[0])
+        db.save({'_id': random_id(), 'type': 'dmedia/store'})
+        result = ms.wait_for_fragile_files(last_seq)
+        self.assertEqual(result['last_seq'], last_seq + 6)
+        self.assertEqual(result['results'], [
+            {
+                'changes': [{'rev': docs[0]['_rev']}],
+                'doc': docs[0],
+                'id': docs[0]['_id'],
+                'seq': last_seq + 5,
+            }
+        ])
+
+        # When limited to fewer changes than are pending (docs[0] has moved to
+        # a later seq):
+        result = ms.wait_for_fragile_files(last_seq, limit=2)
+        self.assertEqual(result['last_seq'], last_seq + 3)
+        self.assertEqual(result['results'], [])
+
     def test_iter_preempt_files(self):
         db = util.get_db(self.env, True)
         ms = metastore.MetaStore(db)
@@ -4372,6 +5508,49 @@ class TestMetaStore(CouchCase):
         fs = TempFileStore()
         self.assertEqual(ms.reclaim(fs), (0, 0))
 
+    def test_plan_reclaim(self):
+        db = util.get_db(self.env, True)
+        ms = metastore.MetaStore(db)
+        fs = TempFileStore()
+        store_ids = tuple(random_id() for i in range(3))
+        self.assertEqual(ms.plan_reclaim(fs, 1776), [])
+
+        base = int(time.time()) - 1000
+        docs = []
+        for i in range(30):
+            doc = {
+                '_id': random_file_id(),
+                'type': 'dmedia/file',
+                'origin': 'user',
+                'atime': base + i,
+                'bytes': 100,
+                'stored': {fs.id: {'copies': 1}},
+            }
+            for store_id in store_ids:
+                doc['stored'][store_id] = {'copies': 1}
+            docs.append(doc)
+        docs[3]['stored'][fs.id]['pinned'] = True
+        db.save_many(docs)
+        reclaimable = docs[:3] + docs[4:]
+
+        # Least recently accessed first, stopping once `need` is reached:
+        self.assertEqual(ms.plan_reclaim(fs, 0), [])
+        self.assertEqual(ms.plan_reclaim(fs, 1), reclaimable[:1])
+        self.assertEqual(ms.plan_reclaim(fs, 100), reclaimable[:1])
+        self.assertEqual(ms.plan_reclaim(fs, 101), reclaimable[:2])
+        self.assertEqual(ms.plan_reclaim(fs, 1050, batch_size=4),
+            reclaimable[:11]
+        )
+        self.assertEqual(ms.plan_reclaim(fs, 10 ** 9, batch_size=4),
+            reclaimable
+        )
+
+        # A dry run shouldn't change anything:
+        threshold = fs.statvfs().avail + 10 ** 12
+        self.assertEqual(ms.reclaim(fs, threshold, dry_run=True), (29, 2900))
+        for doc in docs:
+            self.assertEqual(db.get(doc['_id']), doc)
+
     def test_reclaim_all(self):
         # FIXME: Till we have a nice way of mocking FileStore.statvfs(), this is
         # a lame test that covers gross function without doing anything real:
@@ -0,0 +1,171 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Unit tests for `dmedia.metrics`.
+"""
+
+from unittest import TestCase
+import time
+
+from dmedia.parallel import start_process, create_pipe
+from dmedia import metrics
+
+
+def dummy_target(name, value):
+    metrics.incr(name, value)
+    metrics.observe(name + '.seconds', 0.2)
+
+
+def sleepy_target(name, value):
+    metrics.incr(name, value)
+    time.sleep(30)
+
+
+class TestRegistry(TestCase):
+    def test_init(self):
+        r = metrics.Registry()
+        self.assertEqual(r.counters, {})
+        self.assertEqual(r.gauges, {})
+        self.assertEqual(r.histograms, {})
+        self.assertEqual(r.snapshot(),
+            {'counters': {}, 'gauges': {}, 'histograms': {}}
+        )
+        self.assertIs(metrics.is_empty(r.snapshot()), True)
+
+    def test_observe(self):
+        r = metrics.Registry()
+        r.observe('foo', 0.0005)
+        r.observe('foo', 0.5)
+        r.observe('foo', 7200)
+        h = r.histograms['foo']
+        self.assertEqual(h['count'], 3)
+        self.assertAlmostEqual(h['sum'], 7200.5005)
+        self.assertEqual(h['buckets'], [1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 1])
+        self.assertEqual(len(h['buckets']), len(metrics.BUCKETS) + 1)
+
+    def test_drain_and_merge(self):
+        r = metrics.Registry()
+        r.incr('foo')
+        r.incr('foo', 2)
+        r.gauge('bar', 17)
+        r.observe('baz', 1)
+        snapshot = r.drain()
+        self.assertIs(metrics.is_empty(snapshot), False)
+        self.assertEqual(snapshot['counters'], {'foo': 3})
+        self.assertEqual(snapshot['gauges'], {'bar': 17})
+        self.assertEqual(snapshot['histograms']['baz']['count'], 1)
+        self.assertIs(metrics.is_empty(r.snapshot()), True)
+
+        main = metrics.Registry()
+        main.incr('foo', 10)
+        main.gauge('bar', 3)
+        main.merge(snapshot)
+        main.merge(snapshot)
+        self.assertEqual(main.counters, {'foo': 16})
+        self.assertEqual(main.gauges, {'bar': 17})
+        self.assertEqual(main.histograms['baz']['count'], 2)
+        self.assertEqual(main.histograms['baz']['sum'], 2.0)
+        self.assertEqual(main.histograms['baz']['buckets'][4], 2)
+
+
+class TestFunctions(TestCase):
+    def setUp(self):
+        metrics.registry.reset()
+
+    def tearDown(self):
+        metrics.registry.reset()
+
+    def test_report(self):
+        metrics.report('verify', 2.0, 3, 4000, 'store')
+        snapshot = metrics.registry.snapshot()
+        self.assertEqual(snapshot['counters'],
+            {'verify.count:store': 3, 'verify.bytes:store': 4000}
+        )
+        self.assertEqual(snapshot['gauges'],
+            {'verify.bytes_per_sec:store': 2000.0}
+        )
+        self.assertEqual(
+            snapshot['histograms']['verify.seconds:store']['count'], 1
+        )
+
+        metrics.registry.reset()
+        metrics.report('scan', 0, 5)
+        snapshot = metrics.registry.snapshot()
+        self.assertEqual(snapshot['counters'], {'scan.count': 5})
+        self.assertEqual(snapshot['gauges'], {})
+
+    def test_forward(self):
+        (reader, writer) = create_pipe()
+        metrics.registry.reset()
+        self.assertIs(metrics.forward(writer, 'foo'), True)
+        self.assertIs(reader.poll(), False)
+        metrics.incr('bar')
+        self.assertIs(metrics.forward(writer, 'foo'), True)
+        (key, snapshot) = reader.recv()
+        self.assertEqual(key, 'foo')
+        self.assertEqual(snapshot['counters'], {'bar': 1})
+        self.assertIs(reader.poll(), False)
+
+        # Another send in progress:
+        metrics.incr('bar')
+        metrics._send_lock.acquire()
+        try:
+            self.assertIs(metrics.forward(writer, 'foo', timeout=0.1), False)
+        finally:
+            metrics._send_lock.release()
+        self.assertIs(reader.poll(), False)
+        self.assertEqual(metrics.registry.counters, {'bar': 1})
+        metrics.registry.reset()
+
+    def test_run_task(self):
+        metrics.incr('parent')
+        (reader, writer) = create_pipe()
+        p = start_process(metrics.run_task, writer, ('task', 1),
+            dummy_target, 'child', 7
+        )
+        writer.close()
+        (key, snapshot) = reader.recv()
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        self.assertEqual(key, ('task', 1))
+        self.assertEqual(snapshot['counters'], {'child': 7})
+        self.assertEqual(snapshot['histograms']['child.seconds']['count'], 1)
+        self.assertEqual(metrics.registry.counters, {'parent': 1})
+        with self.assertRaises(EOFError):
+            reader.recv()
+
+        # Metrics are still forwarded when the task is terminated:
+        (reader, writer) = create_pipe()
+        p = start_process(metrics.run_task, writer, ('task', 2),
+            sleepy_target, 'child', 3
+        )
+        writer.close()
+        time.sleep(1)
+        p.terminate()
+        p.join()
+        self.assertEqual(p.exitcode, -15)
+        (key, snapshot) = reader.recv()
+        self.assertEqual(key, ('task', 2))
+        self.assertEqual(snapshot['counters'], {'child': 3})
+        with self.assertRaises(EOFError):
+            reader.recv()
+        metrics.registry.reset()
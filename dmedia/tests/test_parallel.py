@@ -0,0 +1,242 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Unit tests for `dmedia.parallel`.
+"""
+
+from unittest import TestCase
+import threading
+import time
+import os
+import logging
+
+from dmedia import parallel
+
+
+def put_pid(q, *args, **kw):
+    q.put((os.getpid(), args, kw, len(logging.getLogger().handlers)))
+
+
+def send_pid(conn, *args):
+    conn.send((os.getpid(), args))
+
+
+class TestFunctions(TestCase):
+    def tearDown(self):
+        parallel._context = parallel.multiprocessing
+        parallel._log_config = None
+
+    def test_get_log_config(self):
+        root = logging.getLogger()
+        saved = (root.level, root.handlers)
+        try:
+            root.handlers = []
+            self.assertEqual(parallel.get_log_config(),
+                {'level': root.level, 'format': None, 'handlers': []}
+            )
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            root.handlers = [handler, logging.NullHandler()]
+            root.setLevel(logging.INFO)
+            self.assertEqual(parallel.get_log_config(),
+                {'level': logging.INFO, 'format': '%(message)s',
+                    'handlers': [None]}
+            )
+        finally:
+            (root.level, root.handlers) = saved
+
+    def test_start_process(self):
+        q = parallel.create_queue()
+        p = parallel.start_process(put_pid, q, 'foo', bar='baz')
+        (pid, args, kw, handlers) = q.get(timeout=5)
+        p.join()
+        self.assertIs(p.daemon, True)
+        self.assertEqual(p.exitcode, 0)
+        self.assertEqual(pid, p.pid)
+        self.assertEqual(args, ('foo',))
+        self.assertEqual(kw, {'bar': 'baz'})
+
+    def test_create_pipe(self):
+        (reader, writer) = parallel.create_pipe()
+        p = parallel.start_process(send_pid, writer, 'foo')
+        writer.close()
+        self.assertEqual(reader.recv(), (p.pid, ('foo',)))
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        with self.assertRaises(EOFError):
+            reader.recv()
+        reader.close()
+
+    def test_drain_queue(self):
+        q = parallel.SmartQueue(3)
+        self.assertEqual(parallel.drain_queue(q), 0)
+        q.put('foo')
+        q.put(ValueError('bar'))
+        q.put(None)
+        self.assertEqual(parallel.drain_queue(q), 3)
+        self.assertEqual(q.qsize(), 0)
+        q.put('baz')
+        self.assertEqual(q.get(), 'baz')
+
+    def test_start_launcher(self):
+        if not parallel.start_launcher(preload=['dmedia.units']):
+            self.skipTest('forkserver not available')
+        self.assertEqual(parallel.get_context().get_start_method(),
+            'forkserver'
+        )
+        self.assertIsInstance(parallel._log_config, dict)
+        parallel._log_config = {
+            'level': logging.DEBUG,
+            'format': '%(message)s',
+            'handlers': [None],
+        }
+        q = parallel.create_queue()
+        p = parallel.start_process(put_pid, q, 'foo', bar='baz')
+        (pid, args, kw, handlers) = q.get(timeout=10)
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        self.assertEqual(pid, p.pid)
+        self.assertEqual(args, ('foo',))
+        self.assertEqual(kw, {'bar': 'baz'})
+        self.assertEqual(handlers, 1)
+
+
+class TestLanes(TestCase):
+    def test_init(self):
+        lanes = parallel.Lanes(3)
+        self.assertEqual(lanes.maxpending, 64)
+        self.assertEqual(lanes.pending, [])
+        self.assertEqual(lanes.busy, set())
+        self.assertEqual(lanes.running, 0)
+        self.assertIs(lanes.closed, False)
+        self.assertEqual(len(lanes.threads), 3)
+        lanes.close()
+        for thread in lanes.threads:
+            self.assertFalse(thread.is_alive())
+        with self.assertRaises(ValueError) as cm:
+            lanes.submit(['a'], print)
+        self.assertEqual(str(cm.exception), 'Lanes are closed')
+
+    def test_next_job(self):
+        lanes = parallel.Lanes(1)
+        lanes.close()
+        job1 = (frozenset(['a', 'b']), None, ())
+        job2 = (frozenset(['b']), None, ())
+        job3 = (frozenset(['c']), None, ())
+        job4 = (frozenset(), None, ())
+        lanes.pending.extend([job1, job2, job3, job4])
+        lanes.busy.add('a')
+        self.assertIs(lanes.next_job(), job3)
+        self.assertIs(lanes.next_job(), job4)
+        self.assertIsNone(lanes.next_job())
+        self.assertEqual(lanes.pending, [job1, job2])
+        lanes.busy.clear()
+        self.assertIs(lanes.next_job(), job1)
+        self.assertIs(lanes.next_job(), job2)
+        self.assertEqual(lanes.pending, [])
+
+    def test_parallel(self):
+        lock = threading.Lock()
+        events = []
+        active = set()
+        overlaps = []
+
+        def job(lane, i):
+            with lock:
+                if lane in active:
+                    overlaps.append(lane)
+                active.add(lane)
+                events.append((lane, i))
+            time.sleep(0.05)
+            with lock:
+                active.remove(lane)
+
+        lanes = parallel.Lanes(4, maxpending=2)
+        start = time.monotonic()
+        for i in range(3):
+            for lane in ('a', 'b', 'c', 'd'):
+                lanes.submit([lane], job, lane, i)
+        lanes.join()
+        elapsed = time.monotonic() - start
+        self.assertEqual(lanes.pending, [])
+        self.assertEqual(lanes.running, 0)
+        self.assertEqual(overlaps, [])
+        self.assertEqual(len(events), 12)
+        for lane in ('a', 'b', 'c', 'd'):
+            self.assertEqual([i for (l, i) in events if l == lane], [0, 1, 2])
+        self.assertLess(elapsed, 12 * 0.05)
+
+        # join() can time out:
+        event = threading.Event()
+        lanes.submit(['a'], event.wait)
+        self.assertIs(lanes.join(0.05), False)
+        event.set()
+        self.assertIs(lanes.join(5), True)
+
+        # Errors are logged and don't kill the workers:
+        def broken():
+            raise ValueError('nope')
+        lanes.submit(['a'], broken)
+        lanes.submit(['a'], job, 'a', 3)
+        lanes.close()
+        self.assertEqual(events[-1], ('a', 3))
+
+    def test_resubmit(self):
+        done = []
+        lanes = parallel.Lanes(1, maxpending=1)
+
+        def job(i):
+            if i == 0:
+                # Goes past maxpending, which submit() would wait on forever:
+                for j in range(1, 6):
+                    lanes.resubmit(['a'], job, j)
+                assert len(lanes.pending) == 5
+            done.append(i)
+
+        event = threading.Event()
+        lanes.submit(['a'], event.wait)
+        lanes.submit(['a'], job, 0)
+        event.set()
+        self.assertIs(lanes.join(5), True)
+        self.assertEqual(done, [0, 1, 2, 3, 4, 5])
+        lanes.close()
+        with self.assertRaises(ValueError):
+            lanes.resubmit(['a'], job, 0)
+
+    def test_cancel(self):
+        done = []
+        event = threading.Event()
+        lanes = parallel.Lanes(1)
+        lanes.submit(['a'], event.wait)
+        lanes.submit(['a'], done.append, 1)
+        lanes.submit(['b'], done.append, 2)
+        self.assertIs(lanes.join(0.05), False)
+        self.assertEqual(lanes.cancel(), 2)
+        self.assertIs(lanes.closed, True)
+        self.assertEqual(lanes.pending, [])
+        with self.assertRaises(ValueError):
+            lanes.submit(['a'], done.append, 3)
+        event.set()
+        for thread in lanes.threads:
+            thread.join(5)
+            self.assertIs(thread.is_alive(), False)
+        self.assertEqual(done, [])
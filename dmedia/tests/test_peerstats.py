@@ -0,0 +1,185 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Unit tests for `dmedia.peerstats`.
+"""
+
+from unittest import TestCase
+import os
+import json
+
+from .base import TempDir
+
+from dmedia import peerstats
+
+
+class TestFunctions(TestCase):
+    def test_ewma(self):
+        self.assertEqual(peerstats.ewma(None, 7), 7.0)
+        self.assertIsInstance(peerstats.ewma(None, 7), float)
+        self.assertEqual(peerstats.ewma(10.0, 10.0), 10.0)
+        self.assertAlmostEqual(peerstats.ewma(10.0, 0.0), 7.0)
+        self.assertAlmostEqual(peerstats.ewma(10.0, 0.0, 0.5), 5.0)
+
+
+class TestPeerStats(TestCase):
+    def test_init(self):
+        stats = peerstats.PeerStats()
+        self.assertIsNone(stats.filename)
+        self.assertEqual(stats.peers, {})
+        self.assertIsNone(stats.save())
+
+        tmp = TempDir()
+        filename = tmp.join('peer-stats.json')
+        stats = peerstats.PeerStats(filename)
+        self.assertEqual(stats.filename, filename)
+        self.assertEqual(stats.peers, {})
+        self.assertEqual(repr(stats),
+            'PeerStats({!r})'.format(filename)
+        )
+
+        # Corrupt file is ignored:
+        open(filename, 'w').write('[1, 2, 3]')
+        stats = peerstats.PeerStats(filename)
+        self.assertEqual(stats.peers, {})
+        open(filename, 'w').write('{"foo":')
+        stats = peerstats.PeerStats(filename)
+        self.assertEqual(stats.peers, {})
+
+    def test_save_and_load(self):
+        tmp = TempDir()
+        filename = tmp.join('peer-stats.json')
+        stats = peerstats.PeerStats(filename)
+        stats.record_download('a', 2000, 2.0)
+        stats.record_latency('a', 0.25)
+        stats.record_failure('b')
+        self.assertIsNone(stats.save())
+        self.assertEqual(sorted(os.listdir(tmp.dir)),
+            ['peer-stats.json', 'peer-stats.json.lock']
+        )
+        self.assertEqual(json.load(open(filename, 'r')), stats.peers)
+
+        stats2 = peerstats.PeerStats(filename)
+        self.assertEqual(stats2.peers, stats.peers)
+        self.assertEqual(stats2.get('a')['rate'], 1000.0)
+        self.assertEqual(stats2.get('a')['latency'], 0.25)
+        self.assertEqual(stats2.get('b')['failures'], 1)
+
+        # Missing keys get defaults:
+        json.dump({'c': {'rate': 5.0}}, open(filename, 'w'))
+        stats3 = peerstats.PeerStats(filename)
+        self.assertEqual(stats3.get('c'), {
+            'rate': 5.0,
+            'latency': None,
+            'downloads': 0,
+            'failures': 0,
+            'time': None,
+        })
+
+    def test_merge(self):
+        tmp = TempDir()
+        filename = tmp.join('peer-stats.json')
+
+        # Two processes with the same stats file:
+        stats1 = peerstats.PeerStats(filename)
+        stats2 = peerstats.PeerStats(filename)
+        stats1.record_download('a', 1000, 1.0)
+        stats1.record_download('b', 1000, 1.0)
+        stats2.record_download('c', 3000, 1.0)
+        stats2.record_download('b', 2000, 1.0)
+        stats1.save()
+        stats2.save()
+
+        # Nothing saved by stats1 was lost, and stats2's newer 'b' won:
+        saved = json.load(open(filename, 'r'))
+        self.assertEqual(sorted(saved), ['a', 'b', 'c'])
+        self.assertEqual(saved['a']['rate'], 1000.0)
+        self.assertEqual(saved['b']['rate'], 2000.0)
+        self.assertEqual(saved['c']['rate'], 3000.0)
+        self.assertEqual(saved, stats2.peers)
+
+        # stats1 picks up the others' entries on its next save, but keeps its
+        # own newer entry:
+        stats1.record_download('c', 5000, 1.0)
+        stats1.save()
+        saved = json.load(open(filename, 'r'))
+        self.assertEqual(saved['b']['rate'], 2000.0)
+        self.assertEqual(saved['c']['rate'], 5000.0)
+        self.assertEqual(saved, stats1.peers)
+        self.assertEqual(sorted(os.listdir(tmp.dir)),
+            ['peer-stats.json', 'peer-stats.json.lock']
+        )
+
+        # A corrupt file is replaced:
+        open(filename, 'w').write('{"foo":')
+        stats1.save()
+        self.assertEqual(json.load(open(filename, 'r')), stats1.peers)
+
+    def test_record_download(self):
+        stats = peerstats.PeerStats()
+        stats.record_download('a', 1000, 1.0)
+        entry = stats.get('a')
+        self.assertEqual(entry['rate'], 1000.0)
+        self.assertEqual(entry['downloads'], 1)
+        self.assertIsInstance(entry['time'], float)
+        stats.record_download('a', 2000, 1.0)
+        self.assertAlmostEqual(stats.get('a')['rate'], 1300.0)
+        self.assertEqual(stats.get('a')['downloads'], 2)
+
+        # A success clears the failures:
+        stats.record_failure('a')
+        stats.record_failure('a')
+        self.assertEqual(stats.get('a')['failures'], 2)
+        stats.record_download('a', 1300, 1.0)
+        self.assertEqual(stats.get('a')['failures'], 0)
+
+        # Empty downloads are ignored:
+        stats.record_download('b', 0, 1.0)
+        stats.record_download('b', 1000, 0)
+        self.assertNotIn('b', stats.peers)
+
+    def test_estimate_and_rank(self):
+        stats = peerstats.PeerStats()
+        size = 10 ** 8
+        self.assertAlmostEqual(stats.estimate('a', size),
+            peerstats.DEFAULT_LATENCY + size / peerstats.DEFAULT_RATE
+        )
+        stats.record_download('a', size, 1.0)
+        stats.record_latency('a', 0.5)
+        self.assertAlmostEqual(stats.estimate('a', size), 1.5)
+
+        # Failures double the estimate, up to MAX_PENALTY:
+        stats.record_failure('a')
+        self.assertAlmostEqual(stats.estimate('a', size), 3.0)
+        for i in range(20):
+            stats.record_failure('a')
+        self.assertAlmostEqual(stats.estimate('a', size),
+            1.5 * 2 ** peerstats.MAX_PENALTY
+        )
+
+        stats.record_download('b', size, 2.0)
+        stats.record_download('c', size, 50.0)
+        self.assertEqual(stats.rank(['a', 'b', 'c', 'd'], size),
+            ['b', 'd', 'c', 'a']
+        )
+        self.assertEqual(stats.rank(['e', 'd'], size), ['d', 'e'])
+        self.assertEqual(stats.rank([], size), [])
@@ -676,6 +676,28 @@ class TestFunctions(TestCase):
             "doc['copies'] must be >= 0; got -2"
         )
 
+        # Test with optional io_budget:
+        g = deepcopy(good)
+        g['io_budget'] = {}
+        self.assertIsNone(schema.check_store(g))
+        g['io_budget'] = {'bytes_per_sec': 50000000, 'iops': 0}
+        self.assertIsNone(schema.check_store(g))
+        bad = deepcopy(good)
+        bad['io_budget'] = 17
+        with self.assertRaises(TypeError) as cm:
+            schema.check_store(bad)
+        self.assertEqual(
+            str(cm.exception),
+            TYPE_ERROR.format("doc['io_budget']", dict, int, 17)
+        )
+        bad['io_budget'] = {'iops': -1}
+        with self.assertRaises(ValueError) as cm:
+            schema.check_store(bad)
+        self.assertEqual(
+            str(cm.exception),
+            "doc['io_budget']['iops'] must be >= 0; got -1"
+        )
+
     def test_create_file(self):
         timestamp = time.time()
         _id = random_id(DIGEST_BYTES)
@@ -0,0 +1,308 @@
+# dmedia: distributed media library
+# Copyright (C) 2011 Novacut Inc
+#
+# This file is part of `dmedia`.
+#
+# `dmedia` is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# `dmedia` is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along
+# with `dmedia`.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#   Jason Gerard DeRose <jderose@novacut.com>
+
+"""
+Unit tests for `dmedia.shadow`.
+"""
+
+from unittest import TestCase
+from random import SystemRandom
+import threading
+
+from dbase32 import random_id
+
+from .base import TempDir, random_file_id
+from .couch import CouchCase
+
+from dmedia import util, shadow
+from dmedia.metastore import MetaStore
+
+
+random = SystemRandom()
+
+
+def random_doc(store_ids):
+    stored = {}
+    count = random.randint(0, len(store_ids))
+    for store_id in random.sample(store_ids, count):
+        value = {
+            'copies': random.choice([0, 1, 2, None, 'one', False, 0.0]),
+            'mtime': random.choice([None, random.randint(1000, 1009)]),
+        }
+        if random.random() < 0.5:
+            value['verified'] = random.randint(2000, 2009)
+        if random.random() < 0.2:
+            value['pinned'] = True
+        stored[store_id] = value
+    return {
+        '_id': random_file_id(),
+        'type': 'dmedia/file',
+        'origin': random.choice(['user', 'user', 'render']),
+        'atime': random.choice([None, random.randint(3000, 3009)]),
+        'bytes': random.randint(1, 1000),
+        'stored': stored,
+    }
+
+
+class TestFunctions(TestCase):
+    def test_iszero(self):
+        self.assertIs(shadow.iszero(0), True)
+        self.assertIs(shadow.iszero(0.0), True)
+        self.assertIs(shadow.iszero(False), False)
+        self.assertIs(shadow.iszero(None), False)
+        self.assertIs(shadow.iszero('0'), False)
+        self.assertIs(shadow.iszero(1), False)
+
+    def test_map_nonzero(self):
+        store_id = random_id()
+        for copies in (0, 0.0):
+            doc = {'stored': {store_id: {'copies': copies}}}
+            self.assertEqual(list(shadow.map_nonzero(doc)), [])
+            self.assertEqual(list(shadow.map_store_downgraded(doc)),
+                [(store_id, None)]
+            )
+        for copies in (False, None, 1):
+            doc = {'stored': {store_id: {'copies': copies}}}
+            self.assertEqual(list(shadow.map_nonzero(doc)), [(store_id, None)])
+            self.assertEqual(list(shadow.map_store_downgraded(doc)), [])
+
+    def test_map_rank(self):
+        doc = {'type': 'dmedia/file', 'origin': 'user'}
+        self.assertEqual(list(shadow.map_rank(doc)), [(0, None)])
+        doc['stored'] = {
+            random_id(): {'copies': 1},
+            random_id(): {'copies': 0},
+        }
+        self.assertEqual(list(shadow.map_rank(doc)), [(3, None)])
+        doc['stored'][random_id()] = {'copies': 2}
+        self.assertEqual(list(shadow.map_rank(doc)), [(6, None)])
+        doc['origin'] = 'render'
+        self.assertEqual(list(shadow.map_rank(doc)), [])
+
+    def test_map_store_reclaimable(self):
+        (id1, id2, id3) = sorted(random_id() for i in range(3))
+        doc = {
+            'type': 'dmedia/file',
+            'origin': 'user',
+            'atime': 1234,
+            'stored': {
+                id1: {'copies': 1},
+                id2: {'copies': 1},
+                id3: {'copies': 1},
+            },
+        }
+        self.assertEqual(list(shadow.map_store_reclaimable(doc)), [])
+        doc['stored'][id3]['copies'] = 2
+        self.assertEqual(sorted(shadow.map_store_reclaimable(doc)), [
+            ([id1, 1234], None),
+            ([id2, 1234], None),
+        ])
+        doc['stored'][id1]['pinned'] = True
+        self.assertEqual(list(shadow.map_store_reclaimable(doc)), [
+            ([id2, 1234], None),
+        ])
+
+    def test_encode_key(self):
+        store_id = random_id()
+        self.assertEqual(shadow.encode_key('k1', store_id),
+            (store_id, shadow.NULL)
+        )
+        self.assertEqual(shadow.encode_key('k2', 17), ('', 17))
+        self.assertEqual(shadow.encode_key('k2', None), ('', shadow.NULL))
+        self.assertEqual(shadow.encode_key('k1k2', [store_id, 17]),
+            (store_id, 17)
+        )
+        self.assertEqual(shadow.decode_key('k1', store_id, shadow.NULL),
+            store_id
+        )
+        self.assertEqual(shadow.decode_key('k2', '', 17.0), 17)
+        self.assertEqual(shadow.decode_key('k2', '', 17.5), 17.5)
+        self.assertEqual(shadow.decode_key('k1k2', store_id, shadow.NULL),
+            [store_id, None]
+        )
+
+
+class TestShadowIndex(TestCase):
+    def test_init(self):
+        tmp = TempDir()
+        filename = tmp.join('shadow.sqlite3')
+        inst = shadow.ShadowIndex(filename)
+        self.assertEqual(inst.filename, filename)
+        self.assertEqual(repr(inst), 'ShadowIndex({!r})'.format(filename))
+        self.assertEqual(inst.get_last_seq(), 0)
+        self.assertEqual(inst.query('rank'), [])
+
+    def test_threads(self):
+        tmp = TempDir()
+        inst = shadow.ShadowIndex(tmp.join('shadow.sqlite3'))
+        store_ids = [random_id() for i in range(3)]
+        errors = []
+
+        def writer(i):
+            try:
+                for seq in range(i * 100, (i + 1) * 100):
+                    doc = random_doc(store_ids)
+                    inst.apply_changes({
+                        'last_seq': seq,
+                        'results': [{'id': doc['_id'], 'doc': doc}],
+                    })
+                    inst.query('rank', limit=10)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        count = inst.conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        self.assertEqual(count, 400)
+
+    def test_apply_changes(self):
+        tmp = TempDir()
+        inst = shadow.ShadowIndex(tmp.join('shadow.sqlite3'))
+        store_id = random_id()
+        doc = {
+            '_id': random_file_id(),
+            'type': 'dmedia/file',
+            'origin': 'user',
+            'bytes': 17,
+            'stored': {store_id: {'copies': 1, 'mtime': 1234}},
+        }
+        store_doc = {'_id': store_id, 'type': 'dmedia/store'}
+        inst.apply_changes({
+            'last_seq': 1,
+            'results': [
+                {'id': doc['_id'], 'doc': doc},
+                {'id': store_id, 'doc': store_doc},
+            ],
+        })
+        self.assertEqual(inst.get_last_seq(), 1)
+        self.assertEqual(inst.query('rank'), [
+            {'key': 2, 'id': doc['_id'], 'value': None},
+        ])
+        self.assertEqual(inst.query('stored', key=store_id), [
+            {'key': store_id, 'id': doc['_id'], 'value': 17},
+        ])
+        self.assertEqual(inst.query('store-mtime',
+                startkey=[store_id, None], endkey=[store_id, 1234]), [
+            {'key': [store_id, 1234], 'id': doc['_id'], 'value': None},
+        ])
+        self.assertEqual(inst.query('store-mtime',
+                startkey=[store_id, None], endkey=[store_id, 1233]),
+            []
+        )
+
+        # Persists across instances:
+        inst = shadow.ShadowIndex(inst.filename)
+        self.assertEqual(inst.get_last_seq(), 1)
+        self.assertEqual(len(inst.query('rank')), 1)
+
+        # Deleted docs are removed:
+        inst.apply_changes({
+            'last_seq': 2,
+            'results': [{'id': doc['_id'], 'deleted': True}],
+        })
+        self.assertEqual(inst.get_last_seq(), 2)
+        for view in shadow.VIEWS:
+            self.assertEqual(inst.query(view), [])
+
+
+class TestCouchFunctions(CouchCase):
+    def test_views_match(self):
+        db = util.get_db(self.env, True)
+        store_ids = sorted(random_id() for i in range(4))
+        docs = [random_doc(store_ids) for i in range(200)]
+        db.save_many(docs)
+        index = shadow.ShadowIndex(TempDir().join('shadow.sqlite3'))
+        self.assertEqual(index.sync(db, limit=17), 200)
+        self.assertEqual(index.sync(db), 0)
+        sdb = shadow.ShadowDatabase(db, index)
+
+        def check(view, **kw):
+            expected = db.view('file', view, **kw)['rows']
+            self.assertEqual(sdb.view('file', view, **kw)['rows'], expected)
+
+        for view in shadow.VIEWS:
+            check(view)
+            check(view, limit=7)
+            check(view, descending=True, limit=7)
+        for store_id in store_ids:
+            check('stored', key=store_id)
+            check('nonzero', key=store_id, limit=5)
+            check('store-downgraded', key=store_id)
+            check('store-mtime',
+                startkey=[store_id, None], endkey=[store_id, 1005]
+            )
+            check('store-verified',
+                startkey=[store_id, None], endkey=[store_id, 2005]
+            )
+            check('store-reclaimable',
+                startkey=[store_id, None], endkey=[store_id, 3009], limit=3
+            )
+        for rank in range(7):
+            check('rank', key=rank)
+        check('downgrade-by-mtime', endkey=1005)
+        check('downgrade-by-verified', endkey=2005)
+        check('preempt', startkey=3003)
+        rows = db.view('file', 'rank', key=3, limit=3)['rows']
+        if rows:
+            last = rows[-1]
+            check('rank', key=3, startkey_docid=last['id'], limit=3)
+
+        # include_docs:
+        check('rank', key=4, include_docs=True)
+
+        # Changes are synced before each query:
+        doc = docs[0]
+        doc['stored'] = {store_ids[0]: {'copies': 1}}
+        doc['origin'] = 'user'
+        db.save(doc)
+        check('stored', key=store_ids[0])
+        check('rank')
+        db.delete(doc['_id'], doc['_rev'])
+        check('stored', key=store_ids[0])
+
+        # Other views and options pass through to CouchDB:
+        self.assertEqual(
+            sdb.view('file', 'stored', reduce=True, group=True),
+            db.view('file', 'stored', reduce=True, group=True),
+        )
+        self.assertEqual(sdb.view('file', 'origin'), db.view('file', 'origin'))
+
+    def test_metastore(self):
+        db = util.get_db(self.env, True)
+        index = shadow.ShadowIndex(TempDir().join('shadow.sqlite3'))
+        ms = MetaStore(db, shadow=index)
+        self.assertIsInstance(ms.db, shadow.ShadowDatabase)
+        self.assertEqual(repr(ms), 'MetaStore({!r})'.format(db))
+        self.assertIs(ms.db.ctx, db.ctx)
+        store_ids = sorted(random_id() for i in range(3))
+        docs = [random_doc(store_ids) for i in range(50)]
+        db.save_many(docs)
+        for rank in range(7):
+            self.assertEqual(
+                sorted(d['_id'] for d in ms.iter_files_at_rank(rank)),
+                sorted(
+                    r['id'] for r in db.view('file', 'rank', key=rank)['rows']
+                ),
+            )
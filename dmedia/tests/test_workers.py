@@ -173,6 +173,30 @@ class test_functions(TestCase):
             ]
         )
 
+        # Test when the class is passed explicitly, as for a process started
+        # by the forkserver, which hasn't inherited the registrations:
+        class ExportFiles(workers.Worker):
+            def run(self):
+                self.emit('word', *self.args)
+
+        q = DummyQueue()
+        f('ExportFiles', env, q, 'the key', ('hello',), ExportFiles)
+        self.assertEqual(
+            q.messages,
+            [
+                dict(
+                    signal='word',
+                    args=('the key', 'hello'),
+                    worker='ExportFiles',
+                ),
+                dict(
+                    signal='terminate',
+                    args=('the key',),
+                    worker='ExportFiles',
+                ),
+            ]
+        )
+
 
 class test_Worker(TestCase):
     klass = workers.Worker
@@ -497,7 +521,8 @@ class test_Manager(TestCase):
         self.assertTrue(p.is_alive())
         self.assertEqual(
             p._args,
-            ('ExampleWorker', inst.env, inst._q, 'foo', tuple())
+            ('ExampleWorker', inst.env, inst._q, 'foo', tuple(),
+                ExampleWorker)
         )
         self.assertEqual(p._kwargs, {})
         p.terminate()
@@ -514,7 +539,8 @@ class test_Manager(TestCase):
         self.assertTrue(p.is_alive())
         self.assertEqual(
             p._args,
-            ('ExampleWorker', inst.env, inst._q, 'bar', ('some', 'args'))
+            ('ExampleWorker', inst.env, inst._q, 'bar', ('some', 'args'),
+                ExampleWorker)
         )
         self.assertEqual(p._kwargs, {})
         p.terminate()
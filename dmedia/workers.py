@@ -26,12 +26,12 @@ This module implements the `Manager` and `Worker` classes that add some
 conveniences on top of the Python multiprocessing module.
 
 Any heavy lifting dmedia does (importing, downloading, uploading, verifying,
-etc) is done in a subprocess created with multiprocessing.Process().  This
-allows us to fully utilize multicore processors, plus makes dmedia more robust
-as things can go horribly wrong in a Worker without crashing the main process.
-It also keeps the memory footprint of the main process smaller and more stable
-over time, which is important as dmedia is a long running process (whether as a
-DBus service or a pure server).
+etc) is done in a subprocess started with `dmedia.parallel.start_process()`.
+This allows us to fully utilize multicore processors, plus makes dmedia more
+robust as things can go horribly wrong in a Worker without crashing the main
+process.  It also keeps the memory footprint of the main process smaller and
+more stable over time, which is important as dmedia is a long running process
+(whether as a DBus service or a pure server).
 
 To start a new `Worker`, a `Manager` launches a new process and passes that
 process a description of the job, plus a queue that the `Worker` uses to send
@@ -56,12 +56,12 @@ callback that is called to pass a signal to "higher level code", whatever that
 happens to be.
 """
 
-import multiprocessing
 from threading import Thread, Lock
 from queue import Empty
 import logging
 
 from .util import get_db
+from .parallel import start_process, create_queue
 
 
 log = logging.getLogger()
@@ -112,7 +112,7 @@ def exception_name(exception):
     return exception.__name__
 
 
-def dispatch(worker, env, q, key, args):
+def dispatch(worker, env, q, key, args, klass=None):
     """
     Dispatch a worker in this proccess.
 
@@ -132,10 +132,13 @@ def dispatch(worker, env, q, key, args):
     :param key: a key to uniquely identify this worker among active workers
         controlled by the `Manager` that launched this worker
     :param args: arguments to be passed to `Worker.run()`
+    :param klass: the registered `Worker` subclass, passed by the `Manager` as
+        a process started by the forkserver doesn't inherit the registrations
     """
     log.debug('** dispatch: worker=%r, key=%r, args=%r', worker, key, args)
     try:
-        klass = _workers[worker]
+        if klass is None:
+            klass = _workers[worker]
         inst = klass(env, q, key, args)
         inst.run()
     except Exception as e:
@@ -241,7 +244,7 @@ class Manager(object):
             )
         self.env = env
         self.callback = callback
-        self._q = multiprocessing.Queue()
+        self._q = create_queue()
         self._lock = Lock()
         self._workers = {}
         self._running = False
@@ -291,7 +294,7 @@ class Manager(object):
             p.terminate()
             p.join()
         self._workers.clear()
-        self._q = multiprocessing.Queue()
+        self._q = create_queue()
         log.error('%(name)s %(message)s', error)
         self.emit('error', error)
 
@@ -344,7 +347,7 @@ class Manager(object):
                 p.terminate()
                 p.join()
             self._workers.clear()
-            self._q = multiprocessing.Queue()
+            self._q = create_queue()
             return True
 
     def get_worker_env(self, worker, key, args):
@@ -373,13 +376,10 @@ class Manager(object):
             if len(self._workers) == 0:
                 self.first_worker_starting()
             env = self.get_worker_env(worker, key, args)
-            p = multiprocessing.Process(
-                target=dispatch,
-                args=(worker, env, self._q, key, args),
+            p = start_process(dispatch,
+                worker, env, self._q, key, args, _workers.get(worker)
             )
-            p.daemon = True
             self._workers[key] = p
-            p.start()
             if len(self._workers) == 1:
                 self._start_signal_thread()
             return True